@@ -0,0 +1,98 @@
+"""Measures the frames and CPU of a high-frequency room with the readers taking
+every message as a frame, batched and batched with latest-value-wins coalescing.
+
+A writer sends state updates cycling over a few keys, then a final message; the
+readers count the frames until they received it.
+
+Usage:
+    python benchmarks/batching_benchmark.py --readers 100 --messages 1000 --batch 50
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from common import configure_layer, create_room, setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+
+from channels_server.asgi import application  # noqa: E402
+from main.models import Endpoint  # noqa: E402
+
+
+def messages(frame):
+    """Returns the messages of a frame, a single message or a batch."""
+    data = json.loads(frame)
+    return data if isinstance(data, list) else [data]
+
+
+async def run(writer, readers, count, keys, query):
+    communicators = [
+        WebsocketCommunicator(application, f"/ws/endpoint/{code}/{query}")
+        for code in readers
+    ]
+    for communicator in communicators:
+        await communicator.connect(timeout=30)
+    sender = WebsocketCommunicator(application, f"/ws/endpoint/{writer}/")
+    await sender.connect(timeout=30)
+    frames = received = 0
+
+    async def drain(communicator):
+        nonlocal frames, received
+        while True:
+            batch = messages(await communicator.receive_from(timeout=120))
+            frames += 1
+            received += len(batch)
+            if batch[-1]["message"] == "end":
+                return
+
+    drains = [asyncio.ensure_future(drain(c)) for c in communicators]
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for i in range(count):
+        await sender.send_json_to({"message": {"value": i}, "key": f"k{i % keys}"})
+    await sender.send_json_to({"message": "end"})
+    await asyncio.gather(*drains)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    for communicator in communicators + [sender]:
+        await communicator.disconnect()
+    return {
+        "query": query or "none",
+        "readers": len(readers),
+        "messages": count + 1,
+        "frames_per_reader": round(frames / len(readers), 1),
+        "messages_per_reader": round(received / len(readers), 1),
+        "frames_per_sec": round(frames / elapsed, 1),
+        "seconds": round(elapsed, 3),
+        "cpu_ms_per_message": round(cpu / (count + 1) * 1e3, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--keys", type=int, default=10)
+    parser.add_argument("--batch", type=int, default=50, help="milliseconds")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--layer", choices=["memory", "redis"], default="memory")
+    args = parser.parse_args()
+
+    configure_layer(args.layer)
+    writer, *readers = create_room("bench", "batching", args.readers + 1)
+    Endpoint.objects.filter(code=writer).update(permissions="write")
+    Endpoint.objects.filter(code__in=readers).update(permissions="read")
+    batch = f"?batch={args.batch}&batch_size={args.batch_size}"
+    for query in ("", batch, batch + "&coalesce=1"):
+        result = async_to_sync(run)(writer, readers, args.messages, args.keys, query)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
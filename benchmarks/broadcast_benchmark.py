@@ -0,0 +1,112 @@
+"""Compares publishing notifications with one broadcast REST request against
+holding a websocket open as a write endpoint in every room.
+
+Every room has one reader; the time runs until all of them received their
+messages. The scenarios send N messages to one room and one message to each of
+N rooms.
+
+Usage:
+    python benchmarks/broadcast_benchmark.py --messages 100 1000 --layer redis
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from common import configure_layer, create_room, setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.test import AsyncClient  # noqa: E402
+
+from channels_server.asgi import application  # noqa: E402
+from main.models import Endpoint  # noqa: E402
+
+
+def create_rooms(prefix, count):
+    """Creates the rooms with a reader and a writer; returns (name, reader, writer)."""
+    rooms = []
+    for i in range(count):
+        name = f"{prefix}{i}"
+        reader, writer = create_room("bench", name, 2)
+        Endpoint.objects.filter(code=reader).update(permissions="read")
+        Endpoint.objects.filter(code=writer).update(permissions="write")
+        rooms.append((name, reader, writer))
+    return rooms
+
+
+async def run(rooms, per_room, mode):
+    readers = [
+        WebsocketCommunicator(application, f"/ws/endpoint/{reader}/")
+        for _, reader, _ in rooms
+    ]
+    writers = []
+    for communicator in readers:
+        await communicator.connect(timeout=30)
+
+    async def drain(communicator):
+        for _ in range(per_room):
+            await communicator.receive_from(timeout=120)
+
+    start = time.perf_counter()
+    if mode == "websocket":
+        # A publisher connects a write endpoint per room
+        writers = [
+            WebsocketCommunicator(application, f"/ws/endpoint/{writer}/")
+            for _, _, writer in rooms
+        ]
+        for communicator in writers:
+            await communicator.connect(timeout=30)
+    drains = [asyncio.ensure_future(drain(c)) for c in readers]
+    if mode == "websocket":
+        for communicator in writers:
+            for i in range(per_room):
+                await communicator.send_json_to({"message": {"notification": i}})
+    else:
+        messages = [
+            {"room_name": name, "message": {"notification": i}}
+            for name, _, _ in rooms
+            for i in range(per_room)
+        ]
+        response = await AsyncClient().post(
+            "/broadcast/",
+            {"messages": messages},
+            content_type="application/json",
+            headers={"API-KEY": "bench-key"},
+        )
+        assert response.status_code == 200, response.content
+    await asyncio.gather(*drains)
+    elapsed = time.perf_counter() - start
+
+    for communicator in readers + writers:
+        await communicator.disconnect()
+    total = len(rooms) * per_room
+    return {
+        "mode": mode,
+        "rooms": len(rooms),
+        "messages": total,
+        "seconds": round(elapsed, 3),
+        "messages_per_sec": round(total / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--layer", choices=["memory", "redis"], default="memory")
+    args = parser.parse_args()
+
+    configure_layer(args.layer)
+    for count in args.messages:
+        one_room = create_rooms(f"single{count}_", 1)
+        many_rooms = create_rooms(f"many{count}_", count)
+        for mode in ("websocket", "rest"):
+            print(json.dumps(async_to_sync(run)(one_room, count, mode)))
+            print(json.dumps(async_to_sync(run)(many_rooms, 1, mode)))
+
+
+if __name__ == "__main__":
+    main()
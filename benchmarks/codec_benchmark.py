@@ -0,0 +1,131 @@
+"""Micro-benchmarks of the json codecs on the receive -> broadcast -> send path.
+
+For every codec (the stdlib json and orjson when it is installed) and payload
+it reports the time per message of the steps the consumer takes: parsing the
+inbound text frame, encoding the broadcast frame to bytes and decoding it once
+to the str of the text frames. It also times a REST request body and a page of
+endpoint rows, and runs the RoomConsumer end to end to report the process CPU
+time per broadcast.
+
+Usage:
+    python benchmarks/codec_benchmark.py --readers 100 --repeats 2000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+
+from common import create_room, setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+
+from channels_server.asgi import application  # noqa: E402
+from main import codec  # noqa: E402
+
+PAYLOADS = {
+    "typical": {"type": "cursor", "user": "participant-42", "position": {"x": 1024.5, "y": 768.25}},
+    "snapshot_4k": {
+        "type": "snapshot",
+        "items": [
+            {"id": f"item-{i}", "owner": f"participant-{i % 50}", "x": i * 1.5, "y": i * 2.25}
+            for i in range(60)
+        ],
+    },
+}
+
+PAGE = {
+    "endpoints": [
+        {
+            "code": "x" * 100,
+            "permissions": "readwrite",
+            "identity": f"client{i}",
+            "room_name": "room",
+        }
+        for i in range(100)
+    ],
+    "next_cursor": 100,
+}
+
+
+def per_call_us(function, repeats):
+    start = time.process_time()
+    for _ in range(repeats):
+        function()
+    return round((time.process_time() - start) / repeats * 1e6, 2)
+
+
+def micro(message, repeats):
+    inbound = json.dumps({"message": message})
+    frame = {
+        "message": message,
+        "identity": "sender",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "seq": 1,
+    }
+    encoded = codec.dumps(frame)
+    return {
+        "loads_us": per_call_us(lambda: codec.loads(inbound), repeats),
+        "dumps_us": per_call_us(lambda: codec.dumps(frame), repeats),
+        "decode_us": per_call_us(encoded.decode, repeats),
+        "path_us": per_call_us(
+            lambda: codec.dumps(dict(frame, message=codec.loads(inbound)["message"])).decode(),
+            repeats,
+        ),
+        "rest_body_us": per_call_us(lambda: codec.loads(inbound.encode()), repeats),
+        "rest_page_us": per_call_us(lambda: codec.dumps(PAGE), repeats // 10 or 1),
+    }
+
+
+async def end_to_end(codes, message, messages):
+    communicators = [
+        WebsocketCommunicator(application, f"/ws/endpoint/{c}/") for c in codes
+    ]
+    for communicator in communicators:
+        await communicator.connect(timeout=30)
+    sender = communicators[0]
+
+    async def drain(communicator):
+        for _ in range(messages):
+            await communicator.receive_from(timeout=120)
+
+    drains = [asyncio.ensure_future(drain(c)) for c in communicators]
+    text = json.dumps({"message": message})
+    start = time.process_time()
+    for _ in range(messages):
+        await sender.send_to(text_data=text)
+    await asyncio.gather(*drains)
+    cpu = time.process_time() - start
+    for communicator in communicators:
+        await communicator.disconnect()
+    return round(cpu / messages * 1e3, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--repeats", type=int, default=2000)
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    args = parser.parse_args()
+
+    names = ["json"] + (["orjson"] if codec.orjson is not None else [])
+    codes = create_room("bench", "codec", args.readers + 1)
+    for payload, message in PAYLOADS.items():
+        for name in names:
+            codec.configure(name)
+            result = {"codec": name, "payload": payload}
+            result.update(micro(message, args.repeats))
+            if not args.skip_end_to_end:
+                result["end_to_end_cpu_ms"] = async_to_sync(end_to_end)(
+                    codes, message, args.messages
+                )
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
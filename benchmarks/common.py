@@ -0,0 +1,94 @@
+"""Shared helpers for the benchmark scripts.
+
+The benchmarks run the server in-process against a throwaway test database, so
+they only need the same config.yaml as the development server.
+"""
+
+import os
+import sys
+from pathlib import Path
+
+SERVER_DIR = Path(__file__).resolve().parent.parent / "channels_server"
+
+
+def setup_django():
+    """Configures django and creates an empty test database."""
+    sys.path.insert(0, str(SERVER_DIR))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "channels_server.settings")
+
+    import django
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    # Connection logs would dominate the measured time
+    settings.LOGGING["loggers"]["main"]["level"] = "WARNING"
+    django.setup()
+    settings.CHANNEL_LAYERS = {
+        "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+    }
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+
+def configure_layer(layer, hosts=None):
+    """Switches the channel layer to "memory" or "redis" (a local redis-server
+    or the given redis shards).
+
+    The redis layer also moves the history and sequence numbers to redis, as on
+    a production server.
+    """
+    from channels.layers import channel_layers
+    from django.conf import settings
+
+    if layer == "redis":
+        if hosts is not None:
+            settings.REDIS_HOSTS = hosts
+        settings.USE_REDIS = True
+        settings.CHANNEL_LAYERS = {
+            "default": {
+                "BACKEND": "channels_redis.core.RedisChannelLayer",
+                "CONFIG": {"hosts": settings.REDIS_HOSTS, "capacity": 10000},
+            }
+        }
+    else:
+        settings.USE_REDIS = False
+        settings.CHANNEL_LAYERS = {
+            "default": {
+                "BACKEND": "channels.layers.InMemoryChannelLayer",
+                "CONFIG": {"capacity": 10000},
+            }
+        }
+    # Layers are created on first use from the settings
+    channel_layers.backends.clear()
+
+
+def percentile(values, p):
+    """Returns the p-th percentile (0-100) of the values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def create_room(username, room_name, endpoints, permissions="readwrite"):
+    """Creates a user, a room and the given number of endpoints.
+
+    Returns the list of endpoint codes.
+    """
+    from django.contrib.auth import get_user_model
+    from main.models import Endpoint, Room
+
+    user, _ = get_user_model().objects.get_or_create(
+        username=username, defaults={"api_key": f"{username}-key"}
+    )
+    room = Room.objects.create(name=room_name, owner=user, webhook="")
+    codes = []
+    for i in range(endpoints):
+        code = f"{username}{room_name}{i}"
+        Endpoint.objects.create(
+            code=code, permissions=permissions, room=room, identity=f"client{i}"
+        )
+        codes.append(code)
+    return codes
@@ -0,0 +1,143 @@
+"""Measures the bandwidth and CPU trade-offs of the deflate subprotocol for
+typical and large payloads.
+
+The first part compresses a broadcast frame at the given zlib levels and reports
+the bytes saved, the compression time (once per broadcast on the server) and
+the decompression time (once per message on every client). The second part runs
+the RoomConsumer end to end with plain json readers and with deflate readers and
+reports the process CPU time and the bytes on the wire per broadcast.
+
+Usage:
+    python benchmarks/compression_benchmark.py --readers 100 --levels 1 6 9
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import zlib
+from datetime import datetime, timezone
+
+from common import create_room, setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+from channels_server.asgi import application  # noqa: E402
+
+
+def snapshot(items):
+    """Returns a state snapshot of the given number of items."""
+    rng = random.Random(items)
+    return {
+        "type": "snapshot",
+        "items": [
+            {
+                "id": f"item-{i}",
+                "owner": f"participant-{rng.randrange(50)}",
+                "position": {"x": round(rng.uniform(0, 2000), 2), "y": round(rng.uniform(0, 2000), 2)},
+                "color": rng.choice(["red", "green", "blue", "yellow"]),
+                "locked": rng.random() < 0.1,
+            }
+            for i in range(items)
+        ],
+    }
+
+
+PAYLOADS = {
+    "typical": {"type": "cursor", "user": "participant-42", "position": {"x": 1024.5, "y": 768.25}},
+    "snapshot_4k": snapshot(30),
+    "snapshot_64k": snapshot(500),
+}
+
+
+def frame(message):
+    return json.dumps(
+        {
+            "message": message,
+            "identity": "sender",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "seq": 1,
+        }
+    ).encode()
+
+
+def compression(message, level, repeats):
+    data = frame(message)
+    start = time.process_time()
+    for _ in range(repeats):
+        compressed = zlib.compress(data, level)
+    compress = time.process_time() - start
+    start = time.process_time()
+    for _ in range(repeats):
+        zlib.decompress(compressed)
+    decompress = time.process_time() - start
+    return {
+        "level": level,
+        "raw_bytes": len(data),
+        "compressed_bytes": len(compressed),
+        "ratio": round(len(compressed) / len(data), 3),
+        "compress_us": round(compress / repeats * 1e6, 1),
+        "decompress_us": round(decompress / repeats * 1e6, 1),
+    }
+
+
+async def end_to_end(codes, message, subprotocols, messages):
+    communicators = [
+        WebsocketCommunicator(application, f"/ws/endpoint/{c}/", subprotocols=subprotocols)
+        for c in codes
+    ]
+    for communicator in communicators:
+        await communicator.connect(timeout=30)
+    sender = communicators[0]
+    wire = 0
+
+    async def drain(communicator):
+        nonlocal wire
+        for _ in range(messages):
+            data = await communicator.receive_from(timeout=120)
+            wire += len(data if isinstance(data, bytes) else data.encode())
+
+    drains = [asyncio.ensure_future(drain(c)) for c in communicators]
+    start = time.process_time()
+    for _ in range(messages):
+        await sender.send_to(text_data=json.dumps({"message": message}))
+    await asyncio.gather(*drains)
+    cpu = time.process_time() - start
+    for communicator in communicators:
+        await communicator.disconnect()
+    return round(cpu / messages * 1e3, 3), wire // messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=100)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 6, 9])
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    args = parser.parse_args()
+
+    settings.COMPRESSION = True
+    codes = create_room("bench", "compression", args.readers + 1)
+    for name, message in PAYLOADS.items():
+        for level in args.levels:
+            result = {"payload": name}
+            result.update(compression(message, level, args.repeats))
+            if not args.skip_end_to_end:
+                settings.COMPRESSION_LEVEL = level
+                for mode, subprotocols in (("json", None), ("deflate", ["deflate"])):
+                    cpu_ms, wire = async_to_sync(end_to_end)(
+                        codes, message, subprotocols, args.messages
+                    )
+                    result[f"{mode}_end_to_end_cpu_ms"] = cpu_ms
+                    result[f"{mode}_end_to_end_wire_bytes"] = wire
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
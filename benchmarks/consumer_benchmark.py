@@ -0,0 +1,134 @@
+"""Compares the legacy sync RoomConsumer with the async RoomConsumer.
+
+Each run connects one sender and N receivers to the same room, sends a burst of
+messages and measures delivered messages/sec and the broadcast latency from
+send to receipt on every receiver.
+
+Usage:
+    python benchmarks/consumer_benchmark.py --receivers 10 50 --messages 200
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+
+from common import create_room, percentile, setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.generic.websocket import WebsocketConsumer  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.urls import re_path  # noqa: E402
+
+from main.consumers import RoomConsumer  # noqa: E402
+from main.models import Endpoint  # noqa: E402
+
+
+class LegacyRoomConsumer(WebsocketConsumer):
+    """The sync RoomConsumer as it was before the async rewrite (no webhook)."""
+
+    def connect(self):
+        code = self.scope["url_route"]["kwargs"]["endpoint_code"]
+        endpoint = Endpoint.objects.get(code=code)
+        # The legacy consumer scanned the permission names
+        self.permissions = str(endpoint.permissions)
+        self.endpoint_identity = endpoint.identity
+        self.room_group_name = f"{endpoint.room.owner.username}_{endpoint.room.name}"
+        async_to_sync(self.channel_layer.group_add)(
+            self.room_group_name, self.channel_name
+        )
+        self.accept()
+
+    def disconnect(self, close_code):
+        async_to_sync(self.channel_layer.group_discard)(
+            self.room_group_name, self.channel_name
+        )
+
+    def receive(self, text_data):
+        message = json.loads(text_data)["message"]
+        timestamp = datetime.now(timezone.utc).isoformat()
+        if "write" in self.permissions:
+            async_to_sync(self.channel_layer.group_send)(
+                self.room_group_name,
+                {
+                    "type": "room.message",
+                    "message": message,
+                    "identity": self.endpoint_identity,
+                    "timestamp": timestamp,
+                },
+            )
+
+    def room_message(self, event):
+        if "read" in self.permissions:
+            self.send(
+                text_data=json.dumps(
+                    {
+                        "message": event["message"],
+                        "identity": event["identity"],
+                        "timestamp": event["timestamp"],
+                    }
+                )
+            )
+
+
+application = URLRouter(
+    [
+        re_path(r"legacy/(?P<endpoint_code>\w+)/$", LegacyRoomConsumer.as_asgi()),
+        re_path(r"async/(?P<endpoint_code>\w+)/$", RoomConsumer.as_asgi()),
+    ]
+)
+
+
+async def run(kind, codes, messages):
+    communicators = [WebsocketCommunicator(application, f"/{kind}/{c}/") for c in codes]
+    for communicator in communicators:
+        connected, _ = await communicator.connect(timeout=10)
+        assert connected, "connection refused"
+    sender, receivers = communicators[0], communicators[1:]
+
+    latencies = []
+
+    async def drain(communicator):
+        for _ in range(messages):
+            payload = await communicator.receive_json_from(timeout=60)
+            latencies.append(time.perf_counter() - payload["message"])
+
+    # The sender is also a reader, drain it too so its queue does not grow
+    drains = [asyncio.ensure_future(drain(c)) for c in communicators]
+    start = time.perf_counter()
+    for _ in range(messages):
+        await sender.send_json_to({"message": time.perf_counter()})
+    await asyncio.gather(*drains)
+    elapsed = time.perf_counter() - start
+
+    for communicator in communicators:
+        await communicator.disconnect()
+    return {
+        "consumer": kind,
+        "receivers": len(receivers),
+        "messages_per_sec": round(messages / elapsed, 1),
+        "deliveries_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--receivers", type=int, nargs="+", default=[10, 50])
+    parser.add_argument("--messages", type=int, default=200)
+    args = parser.parse_args()
+
+    for size in args.receivers:
+        codes = create_room("bench", f"room{size}", size + 1)
+        for kind in ("legacy", "async"):
+            result = async_to_sync(run)(kind, codes, args.messages)
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
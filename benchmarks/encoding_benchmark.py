@@ -0,0 +1,115 @@
+"""Compares json and msgpack room traffic: CPU per message and bytes on the wire.
+
+The first part measures the encoding work per broadcast at the given subscriber
+counts: json encoded for every recipient, json encoded once, msgpack packed
+once. The second part runs the RoomConsumer end to end with json readers and
+with msgpack readers and reports the process CPU time per broadcast.
+
+Usage:
+    python benchmarks/encoding_benchmark.py --subscribers 1 100 1000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+
+from common import create_room, setup_django
+
+setup_django()
+
+import msgpack  # noqa: E402
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+
+from channels_server.asgi import application  # noqa: E402
+
+MESSAGE = {
+    "type": "cursor",
+    "user": "participant-42",
+    "position": {"x": 1024.5, "y": 768.25},
+    "selection": [3, 17, 42, 128],
+    "text": "A typical chat line with a few words in it.",
+}
+
+
+def frame(seq):
+    return {
+        "message": MESSAGE,
+        "identity": "sender",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "seq": seq,
+    }
+
+
+def encoding(subscribers, repeats):
+    data = frame(1)
+    results = {}
+    modes = {
+        "json_per_recipient": lambda: [json.dumps(data) for _ in range(subscribers)],
+        "json_once": lambda: json.dumps(data),
+        "msgpack_once": lambda: msgpack.packb(data),
+    }
+    for mode, encode in modes.items():
+        start = time.process_time()
+        for _ in range(repeats):
+            encode()
+        results[f"{mode}_cpu_us"] = round((time.process_time() - start) / repeats * 1e6, 2)
+    results["json_wire_bytes"] = len(json.dumps(data).encode()) * subscribers
+    results["msgpack_wire_bytes"] = len(msgpack.packb(data)) * subscribers
+    return results
+
+
+async def end_to_end(codes, subprotocols, messages):
+    communicators = [
+        WebsocketCommunicator(application, f"/ws/endpoint/{c}/", subprotocols=subprotocols)
+        for c in codes
+    ]
+    for communicator in communicators:
+        await communicator.connect(timeout=30)
+    sender = communicators[0]
+    wire = 0
+
+    async def drain(communicator):
+        nonlocal wire
+        for _ in range(messages):
+            data = await communicator.receive_from(timeout=120)
+            wire += len(data if isinstance(data, bytes) else data.encode())
+
+    drains = [asyncio.ensure_future(drain(c)) for c in communicators]
+    start = time.process_time()
+    for _ in range(messages):
+        if subprotocols:
+            await sender.send_to(bytes_data=msgpack.packb({"message": MESSAGE}))
+        else:
+            await sender.send_to(text_data=json.dumps({"message": MESSAGE}))
+    await asyncio.gather(*drains)
+    cpu = time.process_time() - start
+    for communicator in communicators:
+        await communicator.disconnect()
+    return round(cpu / messages * 1e3, 3), wire // messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[1, 100, 1000])
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--skip-end-to-end", action="store_true")
+    args = parser.parse_args()
+
+    for subscribers in args.subscribers:
+        result = {"subscribers": subscribers}
+        result.update(encoding(subscribers, args.repeats))
+        if not args.skip_end_to_end:
+            codes = create_room("bench", f"encoding{subscribers}", subscribers + 1)
+            for name, subprotocols in (("json", None), ("msgpack", ["msgpack"])):
+                cpu_ms, wire = async_to_sync(end_to_end)(codes, subprotocols, args.messages)
+                result[f"{name}_end_to_end_cpu_ms"] = cpu_ms
+                result[f"{name}_end_to_end_wire_bytes"] = wire
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Measures broadcast fan-out in a large room.
+
+Compares the RoomConsumer, which encodes every broadcast once on the sending
+side, with a variant that encodes the frame again for every reader as the
+consumer used to do. The variant rebuilds the frame from the packed event,
+so its numbers include a msgpack unpack per reader on top of the json encode.
+
+Usage:
+    python benchmarks/fanout_benchmark.py --readers 100 1000 --messages 20
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from common import create_room, percentile, setup_django
+
+setup_django()
+
+import msgpack  # noqa: E402
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.routing import URLRouter  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.urls import re_path  # noqa: E402
+
+from main.consumers import READ, RoomConsumer  # noqa: E402
+
+
+class PerReaderEncodingConsumer(RoomConsumer):
+    async def room_message(self, event):
+        if self.permissions & READ:
+            await self.send(text_data=json.dumps(msgpack.unpackb(event["msgpack"])))
+
+
+application = URLRouter(
+    [
+        re_path(r"once/(?P<endpoint_code>\w+)/$", RoomConsumer.as_asgi()),
+        re_path(r"per_reader/(?P<endpoint_code>\w+)/$", PerReaderEncodingConsumer.as_asgi()),
+    ]
+)
+
+MESSAGE = {"state": {"cells": [[i, i * 2, str(i)] for i in range(50)]}}
+
+
+async def run(kind, codes, messages):
+    communicators = [WebsocketCommunicator(application, f"/{kind}/{c}/") for c in codes]
+    for communicator in communicators:
+        await communicator.connect(timeout=30)
+    sender = communicators[0]
+    latencies = []
+    sent = {}
+
+    async def drain(communicator):
+        for _ in range(messages):
+            frame = json.loads(await communicator.receive_from(timeout=120))
+            latencies.append(time.perf_counter() - sent[frame["message"]["n"]])
+
+    drains = [asyncio.ensure_future(drain(c)) for c in communicators]
+    wall, cpu = time.perf_counter(), time.process_time()
+    for n in range(messages):
+        sent[n] = time.perf_counter()
+        await sender.send_json_to({"message": dict(MESSAGE, n=n)})
+    await asyncio.gather(*drains)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    for communicator in communicators:
+        await communicator.disconnect()
+    return {
+        "encoding": kind,
+        "readers": len(codes),
+        "deliveries_per_sec": round(len(latencies) / wall, 1),
+        "cpu_ms_per_broadcast": round(cpu / messages * 1e3, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1e3, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1e3, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+
+    for readers in args.readers:
+        codes = create_room("bench", f"fanout{readers}", readers)
+        for kind in ("per_reader", "once"):
+            print(json.dumps(async_to_sync(run)(kind, codes, args.messages)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""Measures the room deliveries saved by capability-based group membership and
+identity filters in mixed-permission rooms.
+
+A room of write-only endpoints (e.g. sensors) and read-only endpoints, where
+some of the writers broadcast. The modes compare:
+
+- legacy: every endpoint joins the room group, as before the capabilities
+- capabilities: only the readers join the room group
+- filtered: the readers also subscribe to a single writer each
+
+Usage:
+    python benchmarks/filter_benchmark.py --writers 900 --readers 100 --layer redis
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from unittest import mock
+
+from common import configure_layer, create_room, setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+from channels_server.asgi import application  # noqa: E402
+from main.consumers import READ, RoomConsumer  # noqa: E402
+from main.fanout import get_fanout  # noqa: E402
+from main.models import Endpoint, Room  # noqa: E402
+
+MODES = ("legacy", "capabilities", "filtered")
+
+
+def legacy_membership():
+    """Patches the consumer so write-only endpoints join the group as well."""
+    connect = RoomConsumer.connect
+    disconnect = RoomConsumer.disconnect
+
+    async def legacy_connect(consumer):
+        await connect(consumer)
+        if consumer.endpoint is not None and not consumer.permissions & READ:
+            if settings.LOCAL_FANOUT:
+                await get_fanout(consumer.channel_layer_alias).join(
+                    consumer.room_group_name, consumer
+                )
+            else:
+                await consumer.channel_layer.group_add(
+                    consumer.room_group_name, consumer.channel_name
+                )
+
+    async def legacy_disconnect(consumer, close_code):
+        if consumer.room_group_name is not None and consumer.outbox is None:
+            if settings.LOCAL_FANOUT:
+                await get_fanout(consumer.channel_layer_alias).leave(
+                    consumer.room_group_name, consumer
+                )
+            else:
+                await consumer.channel_layer.group_discard(
+                    consumer.room_group_name, consumer.channel_name
+                )
+        await disconnect(consumer, close_code)
+
+    return mock.patch.multiple(
+        RoomConsumer, connect=legacy_connect, disconnect=legacy_disconnect
+    )
+
+
+def count_calls(counter):
+    """Patches room_message to count its calls."""
+    room_message = RoomConsumer.room_message
+
+    async def counted(consumer, event):
+        counter[0] += 1
+        await room_message(consumer, event)
+
+    return mock.patch.object(RoomConsumer, "room_message", counted)
+
+
+async def run(mode, writer_codes, reader_codes, senders, messages):
+    writers = [
+        WebsocketCommunicator(application, f"/ws/endpoint/{code}/")
+        for code in writer_codes
+    ]
+    readers = []
+    expected = []
+    for i, code in enumerate(reader_codes):
+        path = f"/ws/endpoint/{code}/"
+        count = messages
+        if mode == "filtered":
+            path += f"?identities=writer{i % senders}"
+            count = len(range(i % senders, messages, senders))
+        readers.append(WebsocketCommunicator(application, path))
+        expected.append(count)
+    for communicator in writers + readers:
+        await communicator.connect(timeout=30)
+
+    async def drain(communicator, count):
+        for _ in range(count):
+            await communicator.receive_from(timeout=60)
+
+    calls = [0]
+    with count_calls(calls):
+        drains = [
+            asyncio.ensure_future(drain(c, n)) for c, n in zip(readers, expected)
+        ]
+        start = time.perf_counter()
+        for i in range(messages):
+            await writers[i % senders].send_json_to({"message": i})
+        await asyncio.gather(*drains)
+        elapsed = time.perf_counter() - start
+
+    for communicator in writers + readers:
+        await communicator.disconnect()
+    return {
+        "mode": mode,
+        "local_fanout": settings.LOCAL_FANOUT,
+        "writers": len(writer_codes),
+        "readers": len(reader_codes),
+        "room_message_calls_per_broadcast": round(calls[0] / messages, 1),
+        "frames_per_broadcast": round(sum(expected) / messages, 1),
+        "broadcasts_per_sec": round(messages / elapsed, 1),
+    }
+
+
+def create_writers(room_name, count):
+    room = Room.objects.get(name=room_name)
+    codes = []
+    for i in range(count):
+        code = f"{room_name}writer{i}"
+        Endpoint.objects.create(
+            code=code, permissions="write", room=room, identity=f"writer{i}"
+        )
+        codes.append(code)
+    return codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writers", type=int, default=900)
+    parser.add_argument("--readers", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--layer", choices=["memory", "redis"], default="memory")
+    parser.add_argument("--local-fanout", action="store_true")
+    args = parser.parse_args()
+
+    configure_layer(args.layer)
+    settings.LOCAL_FANOUT = args.local_fanout
+    reader_codes = create_room("bench", "filter", args.readers, "read")
+    writer_codes = create_writers("filter", args.writers)
+    senders = min(args.senders, args.writers)
+    for mode in MODES:
+        run_mode = async_to_sync(run)
+        if mode == "legacy":
+            with legacy_membership():
+                result = run_mode(mode, writer_codes, reader_codes, senders, args.messages)
+        else:
+            result = run_mode(mode, writer_codes, reader_codes, senders, args.messages)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
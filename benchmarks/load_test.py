@@ -0,0 +1,216 @@
+"""Load test of the websocket server: provisions rooms and endpoints through the
+REST API and drives messages through ws/endpoint/<code>/.
+
+Every room gets one writer sending at a fixed rate and the remaining endpoints
+reading. The run reports the connect rate, the delivered messages/sec and the
+p50/p99 end-to-end latency for every channel layer and saves the results as
+json. Comparing against a saved baseline exits with status 1 on regressions.
+
+Usage:
+    python benchmarks/load_test.py --rooms 10 --endpoints 20 --rate 50 --duration 5
+    python benchmarks/load_test.py --layers memory redis --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from common import configure_layer, percentile, setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.test import Client  # noqa: E402
+
+from channels_server.asgi import application  # noqa: E402
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+def provision(rooms, endpoints):
+    """Creates the rooms and endpoints through the REST API.
+
+    Returns the list of endpoint codes of every room.
+    """
+    get_user_model().objects.create(username="load", api_key="load-key")
+    client = Client(HTTP_API_KEY="load-key")
+    codes = []
+    for i in range(rooms):
+        room_name = f"load{i}"
+        response = client.post(
+            "/create_room/",
+            data=json.dumps({"room_name": room_name}),
+            content_type="application/json",
+        )
+        assert response.status_code == 200, response.content
+        specs = [
+            {"identity": f"client{j}", "permissions": "readwrite" if j == 0 else "read"}
+            for j in range(endpoints)
+        ]
+        response = client.post(
+            "/add_endpoints/",
+            data=json.dumps({"room_name": room_name, "endpoints": specs}),
+            content_type="application/json",
+        )
+        assert response.status_code == 200, response.content
+        codes.append([endpoint["code"] for endpoint in response.json()["endpoints"]])
+    return codes
+
+
+async def connect(codes):
+    communicators = [
+        WebsocketCommunicator(application, f"/ws/endpoint/{code}/") for code in codes
+    ]
+    results = await asyncio.gather(
+        *(communicator.connect(timeout=30) for communicator in communicators)
+    )
+    assert all(connected for connected, _ in results), "connection refused"
+    return communicators
+
+
+async def run(layer, room_codes, rate, duration):
+    start = time.perf_counter()
+    rooms = [await connect(codes) for codes in room_codes]
+    connect_elapsed = time.perf_counter() - start
+    connections = sum(len(room) for room in rooms)
+    count = int(rate * duration)
+
+    latencies = []
+    lost = 0
+
+    async def drain(communicator):
+        nonlocal lost
+        for received in range(count):
+            try:
+                payload = await communicator.receive_json_from(timeout=30)
+            except asyncio.TimeoutError:
+                lost += count - received
+                return
+            latencies.append(time.perf_counter() - payload["message"])
+
+    async def write(communicator):
+        begin = time.perf_counter()
+        for i in range(count):
+            delay = begin + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await communicator.send_json_to({"message": time.perf_counter()})
+
+    start = time.perf_counter()
+    # The writer of every room is the first endpoint, all of them read
+    await asyncio.gather(
+        *(write(room[0]) for room in rooms),
+        *(drain(communicator) for room in rooms for communicator in room),
+    )
+    elapsed = time.perf_counter() - start
+
+    for room in rooms:
+        for communicator in room:
+            await communicator.disconnect()
+    return {
+        "layer": layer,
+        "rooms": len(rooms),
+        "endpoints_per_room": len(rooms[0]),
+        "rate": rate,
+        "connections": connections,
+        "connects_per_sec": round(connections / connect_elapsed, 1),
+        "messages_sent": count * len(rooms),
+        "deliveries": len(latencies),
+        "lost": lost,
+        "deliveries_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def compare(results, baseline_path, tolerance):
+    """Prints the regressions against the baseline results and returns them."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+
+    def key(result):
+        return (
+            result["layer"],
+            result["rooms"],
+            result["endpoints_per_room"],
+            result["rate"],
+        )
+
+    previous = {key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        for metric, higher_is_better in (
+            ("connects_per_sec", True),
+            ("deliveries_per_sec", True),
+            ("p99_ms", False),
+        ):
+            change = (result[metric] - old[metric]) / (old[metric] or 1)
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(
+                    f"{result['layer']} {metric}: {old[metric]} -> {result[metric]}"
+                )
+        if result["lost"] > old["lost"]:
+            regressions.append(
+                f"{result['layer']} lost: {old['lost']} -> {result['lost']}"
+            )
+    for regression in regressions:
+        print("REGRESSION", regression)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--endpoints", type=int, default=20, help="per room")
+    parser.add_argument("--rate", type=float, default=50, help="messages/sec per room")
+    parser.add_argument("--duration", type=float, default=5, help="seconds")
+    parser.add_argument(
+        "--layers", nargs="+", choices=["memory", "redis"], default=["memory"]
+    )
+    parser.add_argument("--output", help="json file, by default in benchmarks/results")
+    parser.add_argument("--compare", help="json file of a previous run")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed relative change"
+    )
+    args = parser.parse_args()
+
+    room_codes = provision(args.rooms, args.endpoints)
+    results = []
+    for layer in args.layers:
+        configure_layer(layer)
+        result = async_to_sync(run)(layer, room_codes, args.rate, args.duration)
+        print(json.dumps(result))
+        results.append(result)
+
+    timestamp = datetime.now(timezone.utc)
+    output = args.output
+    if output is None:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        output = RESULTS_DIR / f"load_{timestamp:%Y%m%d_%H%M%S}.json"
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "timestamp": timestamp.isoformat(),
+                "args": vars(args),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Saved results to {output}")
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Compares room broadcasts with the process-local fan-out against every
+connection joining the room group on the channel layer.
+
+One writer and N readers in a room of this process; with the local fan-out the
+channel layer delivers every broadcast once to the process relay instead of
+once per reader.
+
+Usage:
+    python benchmarks/local_fanout_benchmark.py --readers 100 1000 --layer redis
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from common import configure_layer, create_room, percentile, setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+from channels_server.asgi import application  # noqa: E402
+
+
+async def run(codes, messages):
+    communicators = [
+        WebsocketCommunicator(application, f"/ws/endpoint/{code}/") for code in codes
+    ]
+    for communicator in communicators:
+        await communicator.connect(timeout=30)
+
+    latencies = []
+
+    async def drain(communicator):
+        for _ in range(messages):
+            payload = await communicator.receive_json_from(timeout=60)
+            latencies.append(time.perf_counter() - payload["message"])
+
+    drains = [asyncio.ensure_future(drain(c)) for c in communicators]
+    start = time.perf_counter()
+    for _ in range(messages):
+        await communicators[0].send_json_to({"message": time.perf_counter()})
+    await asyncio.gather(*drains)
+    elapsed = time.perf_counter() - start
+
+    for communicator in communicators:
+        await communicator.disconnect()
+    return {
+        "local_fanout": settings.LOCAL_FANOUT,
+        "readers": len(codes),
+        "layer_deliveries_per_message": 1 if settings.LOCAL_FANOUT else len(codes),
+        "deliveries_per_sec": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--layer", choices=["memory", "redis"], default="memory")
+    args = parser.parse_args()
+
+    configure_layer(args.layer)
+    for readers in args.readers:
+        codes = create_room("bench", f"local{readers}", readers)
+        for local_fanout in (False, True):
+            settings.LOCAL_FANOUT = local_fanout
+            print(json.dumps(async_to_sync(run)(codes, args.messages)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Measures endpoint resolution (websocket connect) and api key authentication
+latency against the table size.
+
+The lookups go through the unique index of the fixed-width code/api_key
+digests. A lookup on the unindexed identity column (filled with values of the
+same width) stands in for the full table scan done before the index was added.
+
+Usage:
+    python benchmarks/lookup_benchmark.py --sizes 1000 10000 100000
+"""
+
+import argparse
+import json
+import random
+import string
+import time
+
+from common import percentile, setup_django
+
+setup_django()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+
+from main.cache import (  # noqa: E402
+    endpoint_cache,
+    load_endpoint,
+    resolve_tenant,
+    tenant_cache,
+)
+from main.models import Endpoint, Room, key_digest  # noqa: E402
+
+CHARS = string.ascii_letters + string.digits
+User = get_user_model()
+
+
+def random_key():
+    return "".join(random.choices(CHARS, k=100))
+
+
+def fill(size):
+    """Grows the endpoint and user tables to the given size."""
+    owner = User.objects.first() or User.objects.create(username="owner", api_key="k")
+    room = Room.objects.first() or Room.objects.create(name="room", owner=owner)
+    missing = size - Endpoint.objects.count()
+    codes = [random_key() for _ in range(missing)]
+    Endpoint.objects.bulk_create(
+        [
+            Endpoint(
+                code=c, code_digest=key_digest(c), permissions="readwrite",
+                room=room, identity=random_key(),
+            )
+            for c in codes
+        ],
+        batch_size=5000,
+    )
+    missing = size - User.objects.count()
+    keys = [random_key() for _ in range(missing)]
+    User.objects.bulk_create(
+        [
+            User(username=f"user{size}_{i}", api_key=k, api_key_digest=key_digest(k))
+            for i, k in enumerate(keys)
+        ],
+        batch_size=5000,
+    )
+
+
+def measure(function, values):
+    timings = []
+    for value in values:
+        start = time.perf_counter()
+        function(value)
+        timings.append(time.perf_counter() - start)
+    return {
+        "p50_us": round(percentile(timings, 50) * 1e6, 1),
+        "p99_us": round(percentile(timings, 99) * 1e6, 1),
+    }
+
+
+def connect(code):
+    endpoint_cache.clear()
+    assert load_endpoint(code) is not None
+
+
+def authenticate(api_key):
+    tenant_cache.clear()
+    assert resolve_tenant(api_key) is not None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--lookups", type=int, default=500)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        fill(size)
+        endpoints = list(Endpoint.objects.order_by("?")[: args.lookups])
+        codes = [e.code for e in endpoints]
+        identities = [e.identity for e in endpoints]
+        keys = list(
+            User.objects.order_by("?").values_list("api_key", flat=True)[: args.lookups]
+        )
+        result = {"size": size}
+        result["scan_unindexed"] = measure(
+            lambda v: Endpoint.objects.get(identity=v), identities
+        )
+        result["connect"] = measure(connect, codes)
+        result["api_auth"] = measure(authenticate, keys)
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Measures the presence queries: the occupancy of many rooms in one call
+compared with one call per room, and the heartbeat refreshing the members of
+all the connections of a process.
+
+Usage:
+    python benchmarks/presence_benchmark.py --rooms 10 100 1000 --layer redis
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from common import configure_layer, setup_django
+
+setup_django()
+
+from main.presence import get_presence, member  # noqa: E402
+
+
+async def run(rooms, members, repeats):
+    presence = get_presence()
+    groups = [f"bench_presence{i}" for i in range(rooms)]
+    present = {
+        group: [member(f"conn{i}-{j}", f"client{j}") for j in range(members)]
+        for i, group in enumerate(groups)
+    }
+
+    start = time.perf_counter()
+    await presence.refresh(present, 60)
+    heartbeat = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        occupancy = await presence.occupancy(groups)
+    batched = (time.perf_counter() - start) / repeats
+    assert all(len(identities) == members for identities in occupancy.values())
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for group in groups:
+            await presence.occupancy([group])
+    per_room = (time.perf_counter() - start) / repeats
+
+    for group in groups:
+        for m in present[group]:
+            await presence.remove(group, m)
+    return {
+        "backend": type(presence).__name__,
+        "rooms": rooms,
+        "members_per_room": members,
+        "heartbeat_ms": round(heartbeat * 1000, 2),
+        "batched_occupancy_ms": round(batched * 1000, 2),
+        "per_room_occupancy_ms": round(per_room * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rooms", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--layer", choices=["memory", "redis"], default="memory")
+    args = parser.parse_args()
+
+    configure_layer(args.layer)
+    for rooms in args.rooms:
+        print(json.dumps(asyncio.run(run(rooms, args.members, args.repeats))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compares creating N endpoints with one add_endpoints request against N
+sequential add_endpoint requests, through the django test client.
+
+Usage:
+    python benchmarks/provisioning_benchmark.py --counts 10 100 500
+"""
+
+import argparse
+import json
+import time
+
+from common import setup_django
+
+setup_django()
+
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+
+from main.models import Room  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--counts", type=int, nargs="+", default=[10, 100, 500])
+    args = parser.parse_args()
+
+    user = get_user_model().objects.create(username="bench", api_key="bench-key")
+    client = Client(HTTP_API_KEY="bench-key")
+
+    for count in args.counts:
+        room_name = f"provision{count}"
+        Room.objects.create(name=room_name, owner=user)
+        specs = [{"identity": f"student{i}", "permissions": "read"} for i in range(count)]
+
+        with CaptureQueriesContext(connection) as sequential_queries:
+            start = time.perf_counter()
+            for spec in specs:
+                response = client.post(
+                    "/add_endpoint/",
+                    data=json.dumps(dict(spec, room_name=room_name)),
+                    content_type="application/json",
+                )
+                assert response.status_code == 200
+            sequential = time.perf_counter() - start
+
+        with CaptureQueriesContext(connection) as bulk_queries:
+            start = time.perf_counter()
+            response = client.post(
+                "/add_endpoints/",
+                data=json.dumps({"room_name": room_name, "endpoints": specs}),
+                content_type="application/json",
+            )
+            assert response.status_code == 200
+            bulk = time.perf_counter() - start
+
+        print(
+            json.dumps(
+                {
+                    "endpoints": count,
+                    "sequential_ms": round(sequential * 1e3, 1),
+                    "sequential_queries": len(sequential_queries),
+                    "bulk_ms": round(bulk * 1e3, 1),
+                    "bulk_queries": len(bulk_queries),
+                    "speedup": round(sequential / bulk, 1),
+                }
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
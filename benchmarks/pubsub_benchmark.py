@@ -0,0 +1,73 @@
+"""Compares a room broadcast over the redis group layer with the redis pub/sub
+layer at growing numbers of subscribers.
+
+Subscribes N channels of this process to a group directly on the layer and
+measures the time of group_send and until every channel received the message.
+The group layer does one redis operation per channel of the group, the pub/sub
+layer one PUBLISH per message. Needs a redis-server on the first REDIS_HOSTS.
+
+Usage:
+    python benchmarks/pubsub_benchmark.py --subscribers 10 1000 10000
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from common import percentile, setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels_redis.core import RedisChannelLayer  # noqa: E402
+from channels_redis.pubsub import RedisPubSubChannelLayer  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+LAYERS = {"groups": RedisChannelLayer, "pubsub": RedisPubSubChannelLayer}
+
+
+async def run(kind, subscribers, messages):
+    layer = LAYERS[kind](hosts=settings.REDIS_HOSTS, capacity=messages + 10)
+    group = f"bench_{kind}_{subscribers}"
+    channels = [await layer.new_channel() for _ in range(subscribers)]
+    for channel in channels:
+        await layer.group_add(group, channel)
+
+    send_times, delivery_times = [], []
+    start = time.perf_counter()
+    for i in range(messages):
+        sent = time.perf_counter()
+        await layer.group_send(group, {"type": "room.message", "text": str(i)})
+        send_times.append(time.perf_counter() - sent)
+        await asyncio.gather(*(layer.receive(channel) for channel in channels))
+        delivery_times.append(time.perf_counter() - sent)
+    elapsed = time.perf_counter() - start
+
+    for channel in channels:
+        await layer.group_discard(group, channel)
+    await layer.flush()
+    return {
+        "layer": kind,
+        "subscribers": subscribers,
+        "group_send_p50_ms": round(percentile(send_times, 50) * 1000, 2),
+        "delivered_p50_ms": round(percentile(delivery_times, 50) * 1000, 2),
+        "delivered_p99_ms": round(percentile(delivery_times, 99) * 1000, 2),
+        "deliveries_per_sec": round(subscribers * messages / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+
+    for subscribers in args.subscribers:
+        for kind in LAYERS:
+            result = async_to_sync(run)(kind, subscribers, args.messages)
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Measures the REST API under concurrent load: requests/sec and database queries
+per request with the tenant cache disabled (every request authenticates its api
+key against the database) and enabled.
+
+Worker threads send the requests through the django test client, so the numbers
+cover the middleware and the views without the network. The sqlite test database
+does not take concurrent writers, so the views writing to it run on one worker.
+
+Usage:
+    python benchmarks/rest_benchmark.py --workers 8 --requests 2000
+"""
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import create_room, setup_django
+
+setup_django()
+
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+
+from main.cache import tenant_cache  # noqa: E402
+from main.models import Endpoint  # noqa: E402
+
+API_KEY = "bench-key"
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+def scenarios(room_name):
+    """Returns the (name, writes, request function) of every measured API call."""
+    return [
+        ("list_rooms", False, lambda client, i: client.get("/list_rooms/")),
+        (
+            "list_endpoints",
+            False,
+            lambda client, i: client.get(f"/list_endpoints/{room_name}/", {"limit": 10}),
+        ),
+        (
+            "add_endpoint",
+            True,
+            lambda client, i: client.post(
+                "/add_endpoint/",
+                data=json.dumps(
+                    {"room_name": room_name, "permissions": "read", "identity": f"c{i}"}
+                ),
+                content_type="application/json",
+            ),
+        ),
+    ]
+
+
+def run(request, requests, workers):
+    counter = QueryCounter()
+    local = threading.local()
+    statuses = []
+
+    def call(i):
+        if not hasattr(local, "client"):
+            local.client = Client(HTTP_API_KEY=API_KEY)
+        with connection.execute_wrapper(counter):
+            statuses.append(request(local.client, i).status_code)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(workers) as executor:
+        list(executor.map(call, range(requests)))
+    elapsed = time.perf_counter() - start
+    assert all(status == 200 for status in statuses), set(statuses)
+    return {
+        "requests_per_sec": round(requests / elapsed, 1),
+        "queries_per_request": round(counter.count / requests, 2),
+    }
+
+
+def delete_endpoints(room_name, requests, workers):
+    """Deletes endpoints of the room, one request each."""
+    codes = list(
+        Endpoint.objects.filter(room__name=room_name).values_list("code", flat=True)
+    )[:requests]
+    return run(
+        lambda client, i: client.get(f"/delete_endpoint/{room_name}/{codes[i]}/"),
+        len(codes),
+        workers,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--endpoints", type=int, default=100)
+    args = parser.parse_args()
+
+    create_room("bench", "rest", args.endpoints)
+    ttl = tenant_cache.ttl
+    for cache in (False, True):
+        tenant_cache.clear()
+        tenant_cache.ttl = ttl if cache else 0
+        for name, writes, request in scenarios("rest"):
+            workers = 1 if writes else args.workers
+            result = {"tenant_cache": cache, "view": name, "workers": workers}
+            result.update(run(request, args.requests, workers))
+            print(json.dumps(result))
+        result = {"tenant_cache": cache, "view": "delete_endpoint", "workers": 1}
+        result.update(delete_endpoints("rest", args.requests // 2, 1))
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
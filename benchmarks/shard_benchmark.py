@@ -0,0 +1,126 @@
+"""Measures the broadcast throughput of the redis channel layer against the
+number of redis shards.
+
+Starts the given number of local redis-server instances and runs several
+server processes at once, each with its own rooms of one writer and readers
+sending bursts of messages. The rooms are spread over the shards by the
+consistent hash of their group names. Needs redis-server on the PATH.
+
+Usage:
+    python benchmarks/shard_benchmark.py --shards 1 2 4 --processes 4
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import subprocess
+import time
+
+from common import configure_layer, create_room, setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from channels.testing import WebsocketCommunicator  # noqa: E402
+
+from channels_server.asgi import application  # noqa: E402
+
+BASE_PORT = 6400
+
+
+def start_redis(count):
+    servers = []
+    for i in range(count):
+        servers.append(
+            subprocess.Popen(
+                ["redis-server", "--port", str(BASE_PORT + i), "--save", ""],
+                stdout=subprocess.DEVNULL,
+            )
+        )
+    time.sleep(0.5)
+    return servers
+
+
+async def broadcast(room_codes, messages):
+    rooms = []
+    for codes in room_codes:
+        room = [
+            WebsocketCommunicator(application, f"/ws/endpoint/{code}/") for code in codes
+        ]
+        for communicator in room:
+            await communicator.connect(timeout=30)
+        rooms.append(room)
+
+    async def drain(communicator):
+        for _ in range(messages):
+            await communicator.receive_from(timeout=60)
+
+    async def write(communicator):
+        for i in range(messages):
+            await communicator.send_json_to({"message": i})
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(write(room[0]) for room in rooms),
+        *(drain(communicator) for room in rooms for communicator in room),
+    )
+    elapsed = time.perf_counter() - start
+    for room in rooms:
+        for communicator in room:
+            await communicator.disconnect()
+    deliveries = messages * sum(len(room) for room in rooms)
+    return deliveries, elapsed
+
+
+def worker(task):
+    """Runs the rooms of one server process, returns deliveries and seconds."""
+    shards, process, rooms, endpoints, messages = task
+    configure_layer("redis", [("127.0.0.1", BASE_PORT + i) for i in range(shards)])
+    room_codes = [
+        create_room(f"shards{shards}p{process}", f"room{i}", endpoints)
+        for i in range(rooms)
+    ]
+    return async_to_sync(broadcast)(room_codes, messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--rooms", type=int, default=20, help="per process")
+    parser.add_argument("--endpoints", type=int, default=10, help="per room")
+    parser.add_argument("--messages", type=int, default=100, help="per room")
+    args = parser.parse_args()
+
+    servers = start_redis(max(args.shards))
+    # Every process sets up django and its own test database on start
+    pool = multiprocessing.get_context("spawn").Pool(args.processes)
+    try:
+        for shards in args.shards:
+            tasks = [
+                (shards, process, args.rooms, args.endpoints, args.messages)
+                for process in range(args.processes)
+            ]
+            results = pool.map(worker, tasks)
+            deliveries = sum(result[0] for result in results)
+            elapsed = max(result[1] for result in results)
+            print(
+                json.dumps(
+                    {
+                        "shards": shards,
+                        "processes": args.processes,
+                        "rooms": args.rooms * args.processes,
+                        "deliveries": deliveries,
+                        "deliveries_per_sec": round(deliveries / elapsed, 1),
+                    }
+                )
+            )
+    finally:
+        pool.terminate()
+        for server in servers:
+            server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Measures webhook delivery throughput against a local stand-in webhook server.
+
+Compares the old inline requests.post per message with the WebhookDispatcher at
+different batch sizes. The stand-in server optionally sleeps to emulate a slow
+webhook target.
+
+Usage:
+    python benchmarks/webhook_benchmark.py --messages 2000 --batch-sizes 1 10 100
+"""
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from common import setup_django
+
+setup_django()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+
+from main.webhooks import WebhookDispatcher  # noqa: E402
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive
+    received = 0
+    delay = 0.0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        StandInHandler.received += len(body) if isinstance(body, list) else 1
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def inline(url, messages):
+    start = time.perf_counter()
+    for i in range(messages):
+        requests.post(url, data=json.dumps({"message": i}))
+    return time.perf_counter() - start
+
+
+def dispatched(url, messages, batch_size):
+    dispatcher = WebhookDispatcher(
+        queue_size=messages, batch_size=batch_size, batch_interval=0.05
+    )
+
+    async def run():
+        start = time.perf_counter()
+        for i in range(messages):
+            dispatcher.enqueue(1, url, {"message": i})
+        enqueued = time.perf_counter() - start
+        while dispatcher.delivered < messages:
+            await asyncio.sleep(0.001)
+        return enqueued, time.perf_counter() - start
+
+    return async_to_sync(run)()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--delay-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    StandInHandler.delay = args.delay_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/hook"
+
+    elapsed = inline(url, args.messages)
+    print(
+        json.dumps(
+            {
+                "mode": "inline",
+                "messages_per_sec": round(args.messages / elapsed, 1),
+                "hot_path_us_per_message": round(elapsed / args.messages * 1e6, 1),
+            }
+        )
+    )
+    for batch_size in args.batch_sizes:
+        StandInHandler.received = 0
+        enqueued, elapsed = dispatched(url, args.messages, batch_size)
+        assert StandInHandler.received == args.messages
+        print(
+            json.dumps(
+                {
+                    "mode": "dispatcher",
+                    "batch_size": batch_size,
+                    "messages_per_sec": round(args.messages / elapsed, 1),
+                    "hot_path_us_per_message": round(enqueued / args.messages * 1e6, 1),
+                }
+            )
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
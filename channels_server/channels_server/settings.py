@@ -56,6 +56,8 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "main.middleware.MetricsMiddleware",
+    "main.middleware.TenantMiddleware",
 ]
 
 ROOT_URLCONF = "channels_server.urls"
@@ -134,18 +136,165 @@ STATIC_ROOT = BASE_DIR / "static"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # Set the channel layer according to config - FOR PRODUCTION
-if config["USE_REDIS"]:
+USE_REDIS = config["USE_REDIS"]
+# One entry per shard - a redis:// url, a [host, port] pair or a sentinel
+# {"sentinels": [[host, port], ...], "master_name": name}; the room groups are
+# spread over the shards by a consistent hash of their names
+REDIS_HOSTS = [
+    tuple(host) if isinstance(host, list) else host
+    for host in config.get("REDIS_HOSTS", [("127.0.0.1", 6379)])
+]
+for host in REDIS_HOSTS:
+    if isinstance(host, dict) and "sentinels" in host:
+        host["sentinels"] = [tuple(sentinel) for sentinel in host["sentinels"]]
+# Join every room once per process and fan the broadcasts out in memory
+LOCAL_FANOUT = config.get("LOCAL_FANOUT", True)
+if USE_REDIS:
     CHANNEL_LAYERS = {
         "default": {
             "BACKEND": "channels_redis.core.RedisChannelLayer",
             "CONFIG": {
-                "hosts": [
-                    ("127.0.0.1", 6379)
-                ],  # This is the default configuration
+                "hosts": REDIS_HOSTS,
+                # Messages per channel before the channel is full
+                "capacity": config.get("REDIS_CAPACITY", 100),
+                # Seconds an undelivered message is kept
+                "expiry": config.get("REDIS_EXPIRY", 60),
+                # Seconds a channel stays in a group without leaving it
+                "group_expiry": config.get("REDIS_GROUP_EXPIRY", 86400),
             },
         },
     }
+    # Encrypts the messages in redis, needs the cryptography package
+    if config.get("REDIS_ENCRYPTION_KEYS"):
+        CHANNEL_LAYERS["default"]["CONFIG"]["symmetric_encryption_keys"] = config[
+            "REDIS_ENCRYPTION_KEYS"
+        ]
+    # Rooms broadcasting with a single redis PUBLISH - True for all the rooms,
+    # "per_room" for the rooms created with "pubsub": true
+    if config.get("REDIS_PUBSUB", False):
+        CHANNEL_LAYERS["pubsub"] = {
+            "BACKEND": "channels_redis.pubsub.RedisPubSubChannelLayer",
+            "CONFIG": {
+                "hosts": REDIS_HOSTS,
+                "symmetric_encryption_keys": config.get("REDIS_ENCRYPTION_KEYS"),
+            },
+        }
 else: # FOR DEVELOPMENT; NOT RECOMMENDED FOR PRODUCTION
     CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
 
+REDIS_PUBSUB = config.get("REDIS_PUBSUB", False)
+
 AUTH_USER_MODEL = "main.CustomUser"
+
+# Maximum number of endpoints created by one add_endpoints request
+MAX_BULK_ENDPOINTS = config.get("MAX_BULK_ENDPOINTS", 1000)
+
+# Maximum number of messages published by one broadcast request
+MAX_BROADCAST_MESSAGES = config.get("MAX_BROADCAST_MESSAGES", 10000)
+
+# Maximum limit of the paginated list_rooms and list_endpoints
+MAX_PAGE_SIZE = config.get("MAX_PAGE_SIZE", 1000)
+STREAM_CHUNK_SIZE = config.get("STREAM_CHUNK_SIZE", 500)  # Rows per ndjson query
+
+# Cache of resolved endpoint codes used on websocket connect
+ENDPOINT_CACHE_SIZE = config.get("ENDPOINT_CACHE_SIZE", 10000)  # Entries
+ENDPOINT_CACHE_TTL = config.get("ENDPOINT_CACHE_TTL", 300)  # Seconds
+
+# Cache of the tenants authenticated by the API-KEY header of the REST API
+TENANT_CACHE_SIZE = config.get("TENANT_CACHE_SIZE", 10000)  # Entries
+TENANT_CACHE_TTL = config.get("TENANT_CACHE_TTL", 30)  # Seconds
+
+# Room message history replayed to reconnecting clients (0 disables it)
+HISTORY_SIZE = config.get("HISTORY_SIZE", 100)  # Messages per room
+HISTORY_ROOM_BYTES = config.get("HISTORY_ROOM_BYTES", 256 * 1024)
+HISTORY_TENANT_BYTES = config.get("HISTORY_TENANT_BYTES", 4 * 1024 * 1024)
+HISTORY_TTL = config.get("HISTORY_TTL", 24 * 60 * 60)  # Seconds, redis only
+
+# Token bucket limits on the written messages, e.g. {"rate": 10, "burst": 20}
+# per endpoint, per room and per user; a missing scope is not limited
+RATE_LIMITS = {
+    "endpoint": config.get("RATE_LIMIT_ENDPOINT", None),
+    "room": config.get("RATE_LIMIT_ROOM", None),
+    "user": config.get("RATE_LIMIT_USER", None),
+}
+RATE_LIMIT_POLICY = config.get("RATE_LIMIT_POLICY", "drop")  # drop, close or delay
+RATE_LIMIT_MAX_DELAY = config.get("RATE_LIMIT_MAX_DELAY", 1)  # Seconds, then drop
+RATE_LIMIT_CLOSE_CODE = config.get("RATE_LIMIT_CLOSE_CODE", 4029)
+RATE_LIMIT_REDIS = config.get("RATE_LIMIT_REDIS", False)  # Share the buckets
+
+# Outbound queue of every reading connection - over the high watermark a slow
+# client loses its oldest frames down to the low watermark (drop_oldest), keeps
+# the latest frame of every sender (coalesce) or is disconnected (disconnect)
+OUTBOX_HIGH_WATERMARK = config.get("OUTBOX_HIGH_WATERMARK", 1000)  # Frames
+OUTBOX_LOW_WATERMARK = config.get("OUTBOX_LOW_WATERMARK", 500)  # Frames
+OUTBOX_POLICY = config.get("OUTBOX_POLICY", "drop_oldest")
+OUTBOX_CLOSE_CODE = config.get("OUTBOX_CLOSE_CODE", 4008)
+# daphne does not hold back the frames of a slow client, the queue only fills
+# for ack-mode clients with more unacknowledged frames than the window
+OUTBOX_ACK_WINDOW = config.get("OUTBOX_ACK_WINDOW", 100)  # Frames, 0 disables
+# Limits of the batches readers may ask for with ?batch=<ms>&batch_size=<frames>
+BATCH_MAX_DELAY = config.get("BATCH_MAX_DELAY", 1000)  # Milliseconds
+BATCH_MAX_SIZE = config.get("BATCH_MAX_SIZE", 1000)  # Frames, also the default
+
+# Presence - the identities connected to every room, refreshed by a heartbeat of
+# every process and expiring PRESENCE_TTL seconds after a process is gone
+PRESENCE = config.get("PRESENCE", True)
+PRESENCE_HEARTBEAT = config.get("PRESENCE_HEARTBEAT", 15)  # Seconds
+PRESENCE_TTL = config.get("PRESENCE_TTL", 45)  # Seconds
+PRESENCE_EVENTS = config.get("PRESENCE_EVENTS", False)  # Join/leave events to readers
+PRESENCE_EVENTS_INTERVAL = config.get("PRESENCE_EVENTS_INTERVAL", 1)  # Seconds
+
+# JSON codec - "auto" uses orjson when it is installed, "orjson" or "json"
+JSON_CODEC = config.get("JSON_CODEC", "auto")
+
+# Compression - clients of the "deflate" subprotocol receive the frames of at
+# least COMPRESSION_MIN_SIZE bytes compressed, every broadcast is compressed once
+COMPRESSION = config.get("COMPRESSION", False)
+COMPRESSION_MIN_SIZE = config.get("COMPRESSION_MIN_SIZE", 1024)  # Bytes
+COMPRESSION_LEVEL = config.get("COMPRESSION_LEVEL", 6)  # 1 (fastest) - 9 (smallest)
+
+# Inbound messages over MAX_MESSAGE_SIZE bytes close the connection before they
+# are parsed, 0 disables the limit. The ASGI server may not send 1009 itself.
+MAX_MESSAGE_SIZE = config.get("MAX_MESSAGE_SIZE", 1048576)  # Bytes
+MAX_MESSAGE_CLOSE_CODE = config.get("MAX_MESSAGE_CLOSE_CODE", 4009)
+
+# Logging - connects and disconnects are logged at DEBUG, rejections at INFO and
+# evictions at WARNING; a share of LOG_SAMPLE_RATE of the records below WARNING
+# is kept
+LOG_LEVEL = config.get("LOG_LEVEL", "INFO")
+LOG_SAMPLE_RATE = config.get("LOG_SAMPLE_RATE", 1.0)
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "filters": {
+        "sample": {"()": "main.log.SamplingFilter", "rate": LOG_SAMPLE_RATE},
+    },
+    "formatters": {
+        "simple": {"format": "%(asctime)s %(levelname)s %(name)s %(message)s"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "simple"},
+    },
+    "loggers": {
+        "main": {
+            "handlers": ["console"],
+            "level": LOG_LEVEL,
+            "filters": ["sample"],
+            "propagate": False,
+        },
+    },
+}
+
+# Serve the Prometheus metrics on /metrics - the labels name the users and rooms
+METRICS_ENABLED = config.get("METRICS_ENABLED", False)
+METRICS_TOKEN = config.get("METRICS_TOKEN", "")  # Required bearer token if set
+
+# Webhook delivery - messages are queued per room and posted in batches
+WEBHOOK_QUEUE_SIZE = config.get("WEBHOOK_QUEUE_SIZE", 1000)  # Messages per room
+WEBHOOK_BATCH_SIZE = config.get("WEBHOOK_BATCH_SIZE", 1)  # 1 - one object per POST
+WEBHOOK_BATCH_INTERVAL_MS = config.get("WEBHOOK_BATCH_INTERVAL_MS", 100)
+WEBHOOK_TIMEOUT = config.get("WEBHOOK_TIMEOUT", 5)  # Seconds
+WEBHOOK_MAX_RETRIES = config.get("WEBHOOK_MAX_RETRIES", 3)
+WEBHOOK_RETRY_BACKOFF = config.get("WEBHOOK_RETRY_BACKOFF", 0.5)  # Seconds
+WEBHOOK_POOL_SIZE = config.get("WEBHOOK_POOL_SIZE", 10)  # Keep-alive connections
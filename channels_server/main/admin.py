@@ -1,7 +1,8 @@
 from django.contrib import admin
-from .models import CustomUser, Room, Endpoint
+from .models import CustomUser, Room, Endpoint, WebhookDeadLetter
 
 # Register your models here.
 admin.site.register(CustomUser)
 admin.site.register(Room)
-admin.site.register(Endpoint)
\ No newline at end of file
+admin.site.register(Endpoint)
+admin.site.register(WebhookDeadLetter)
\ No newline at end of file
@@ -0,0 +1,148 @@
+"""In-process caches of records resolved from the database.
+
+The caches are per process, so every change made through the ORM invalidates the
+local entries (see signals.py) while the TTL bounds how long other processes
+may serve a stale record.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from django.conf import settings
+
+from .models import CustomUser, Endpoint, key_digest, key_lookup
+
+
+class LRUCache:
+    """A bounded least-recently-used cache with expiring entries."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_where(self, predicate):
+        """Removes all the entries whose value matches the predicate."""
+        with self._lock:
+            for key in [k for k, (v, _) in self._data.items() if predicate(v)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+@dataclass(frozen=True)
+class ResolvedEndpoint:
+    """Everything a consumer needs to know about an endpoint."""
+
+    id: int
+    code: str
+    permissions: int
+    identity: str
+    room_id: int
+    room_name: str
+    webhook: str
+    owner_id: int
+    username: str
+    room_pubsub: bool
+
+
+@dataclass(frozen=True)
+class Tenant:
+    """The user owning the rooms of an api key."""
+
+    id: int
+    username: str
+
+
+endpoint_cache = LRUCache(settings.ENDPOINT_CACHE_SIZE, settings.ENDPOINT_CACHE_TTL)
+# Keyed by the digest of the api key, unknown keys are not cached
+tenant_cache = LRUCache(settings.TENANT_CACHE_SIZE, settings.TENANT_CACHE_TTL)
+
+
+def resolve_endpoint(endpoint_code):
+    """Returns the ResolvedEndpoint for the code or None if it does not exist."""
+    resolved = endpoint_cache.get(endpoint_code)
+    if resolved is not None:
+        return resolved
+    return load_endpoint(endpoint_code)
+
+
+def load_endpoint(endpoint_code):
+    """Loads the endpoint from the database in one query and caches it."""
+    try:
+        endpoint = Endpoint.objects.select_related("room__owner").get(
+            **key_lookup("code", endpoint_code)
+        )
+    except Endpoint.DoesNotExist:
+        return None
+    if endpoint.code != endpoint_code:
+        return None
+    resolved = ResolvedEndpoint(
+        id=endpoint.id,
+        code=endpoint.code,
+        permissions=endpoint.permissions,
+        identity=endpoint.identity,
+        room_id=endpoint.room_id,
+        room_name=endpoint.room.name,
+        webhook=endpoint.room.webhook,
+        owner_id=endpoint.room.owner_id,
+        username=endpoint.room.owner.username,
+        room_pubsub=endpoint.room.pubsub,
+    )
+    endpoint_cache.set(endpoint_code, resolved)
+    return resolved
+
+
+def resolve_tenant(api_key):
+    """Returns the Tenant of the api key or None if no user has it.
+
+    The empty key is looked up like any other, it is the key of the default user.
+    """
+    digest = key_digest(api_key)
+    tenant = tenant_cache.get(digest)
+    if tenant is not None:
+        return tenant
+    user = (
+        CustomUser.objects.filter(**key_lookup("api_key", api_key))
+        .values("id", "username", "api_key")
+        .first()
+    )
+    if user is None or user["api_key"] != api_key:
+        return None
+    tenant = Tenant(id=user["id"], username=user["username"])
+    tenant_cache.set(digest, tenant)
+    return tenant
@@ -0,0 +1,49 @@
+"""JSON codec of the consumers, views and webhooks.
+
+JSON_CODEC selects orjson, the stdlib json or "auto" - orjson when it is
+installed. Both write compact UTF-8 json. dumps returns bytes, which the HTTP
+responses, zlib and redis take as they are; dumps_text returns str for the
+websocket text frames. The callers look the functions up on the module, so
+configure() switches the implementation everywhere.
+"""
+
+import json
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson.JSONDecodeError subclasses it, orjson.JSONEncodeError is a TypeError
+DecodeError = json.JSONDecodeError
+
+_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+
+def _json_dumps(obj):
+    return _encoder.encode(obj).encode()
+
+
+def _orjson_dumps_text(obj):
+    return orjson.dumps(obj).decode()
+
+
+def configure(name):
+    """Selects the "orjson", "json" or "auto" implementation."""
+    global NAME, loads, dumps, dumps_text
+    if name == "auto":
+        name = "json" if orjson is None else "orjson"
+    if name == "orjson":
+        if orjson is None:
+            raise ImportError("JSON_CODEC is orjson but orjson is not installed")
+        loads, dumps, dumps_text = orjson.loads, orjson.dumps, _orjson_dumps_text
+    elif name == "json":
+        loads, dumps, dumps_text = json.loads, _json_dumps, _encoder.encode
+    else:
+        raise ValueError(f"Unknown JSON_CODEC {name}")
+    NAME = name
+
+
+configure(settings.JSON_CODEC)
@@ -0,0 +1,36 @@
+"""zlib compression of the frames sent to the clients of the deflate subprotocol.
+
+The frames under COMPRESSION_MIN_SIZE bytes are not worth the CPU and stay text
+frames; larger ones are sent as binary frames in the zlib format, which browsers
+decompress with DecompressionStream("deflate").
+"""
+
+import zlib
+
+from django.conf import settings
+
+SUBPROTOCOL = "deflate"
+
+
+def compress_frame(data):
+    """Returns the compressed UTF-8 frame, None if it is sent uncompressed."""
+    if not settings.COMPRESSION:
+        return None
+    if len(data) < settings.COMPRESSION_MIN_SIZE:
+        return None
+    compressed = zlib.compress(data, settings.COMPRESSION_LEVEL)
+    if len(compressed) >= len(data):
+        return None
+    return compressed
+
+
+def exceeds(data, limit):
+    """Returns True if the text or bytes frame is over limit bytes.
+
+    Text is only encoded when its length in characters cannot decide.
+    """
+    if len(data) > limit:
+        return True
+    if isinstance(data, str) and len(data) * 4 > limit:
+        return len(data.encode()) > limit
+    return False
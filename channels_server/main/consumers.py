@@ -1,134 +1,460 @@
-import json
+import asyncio
+import logging
+import time
 from datetime import datetime, timezone
+from urllib.parse import parse_qs
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-from .models import Endpoint
+from channels.db import database_sync_to_async
+import msgpack
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from . import codec
+from .cache import endpoint_cache, load_endpoint
+from .compression import SUBPROTOCOL as DEFLATE, compress_frame, exceeds
+from .history import (
+    get_history,
+    parse_timestamp,
+    replay_frame,
+    select_after,
+    select_identities,
+    select_since,
+)
+from .fanout import get_fanout
+from .layers import room_layer_alias
+from .metrics import (
+    ack_lag,
+    active_connections,
+    connect_db_latency,
+    fanout_latency,
+    messages_sent,
+    rate_limited,
+)
+from .outbox import Outbox
+from .permissions import Permission
+from .publish import message_event, publish
+from .presence import get_tracker
+from .ratelimit import get_rate_limiter
+from .sequence import get_sequences
+from .webhooks import get_dispatcher
 
-import requests
+logger = logging.getLogger(__name__)
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
+# Plain ints keep the per-message permission tests off the enum machinery
+READ = int(Permission.READ)
+WRITE = int(Permission.WRITE)
+
+
+async def get_endpoint(endpoint_code):
+    """Returns the ResolvedEndpoint for the code or None.
+
+    Cached endpoints are returned without leaving the event loop.
+    """
+    endpoint = endpoint_cache.get(endpoint_code)
+    if endpoint is None:
+        start = time.perf_counter()
+        endpoint = await database_sync_to_async(load_endpoint)(endpoint_code)
+        connect_db_latency.observe(time.perf_counter() - start)
+    return endpoint
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
         self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
         self.room_group_name = f"chat_{self.room_name}"
 
         # Join room group
-        async_to_sync(self.channel_layer.group_add)(
-            self.room_group_name, self.channel_name
-        )
-        print(f"Connected to {self.room_name} room.")
-        print(f"Connected channel name: {self.channel_name}")
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        logger.debug("Connected %s to %s room.", self.channel_name, self.room_name)
 
-        self.accept()
+        await self.accept()
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         # Leave room group
-        async_to_sync(self.channel_layer.group_discard)(
+        await self.channel_layer.group_discard(
             self.room_group_name, self.channel_name
         )
-        print(f"Disconnected from {self.room_name} room.")
-        print(f"Disconnected channel name: {self.channel_name}")
+        logger.debug(
+            "Disconnected %s from %s room.", self.channel_name, self.room_name
+        )
 
     # Receive message from WebSocket
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        text_data_json = codec.loads(text_data)
         message = text_data_json["message"]
 
         # Send message to room group
-        async_to_sync(self.channel_layer.group_send)(
+        await self.channel_layer.group_send(
             self.room_group_name, {"type": "chat.message", "message": message}
         )
 
     # Receive message from room group
-    def chat_message(self, event):
+    async def chat_message(self, event):
         message = event["message"]
 
         # Send message to WebSocket
-        self.send(text_data=json.dumps({"message": message}))
+        await self.send(text_data=codec.dumps_text({"message": message}))
+
+
+class RoomConsumer(AsyncWebsocketConsumer):
+    room_group_name = None
+    outbox = None
 
+    async def __call__(self, scope, receive, send):
+        # The channel layer of the room has to be known before the consumer
+        # creates its channel, so the endpoint is resolved first
+        self.endpoint_code = scope["url_route"]["kwargs"]["endpoint_code"]
+        self.endpoint = await get_endpoint(self.endpoint_code)
+        if self.endpoint is not None:
+            self.channel_layer_alias = room_layer_alias(self.endpoint.room_pubsub)
+        await super().__call__(scope, receive, send)
 
-class RoomConsumer(WebsocketConsumer):
-    def connect(self):
-        self.endpoint_code = self.scope["url_route"]["kwargs"]["endpoint_code"]
+    async def connect(self):
         # Get room name and user from endpoint code
-        endpoint = Endpoint.objects.get(code=self.endpoint_code)
+        endpoint = self.endpoint
         # If the endpoint is not found, close the connection
         if endpoint is None:
-            self.close()
+            logger.info("Rejected unknown endpoint code")
+            await self.close()
+            return
 
-        self.permissions = endpoint.permissions
+        self.endpoint_id = endpoint.id
+        self.permissions = int(endpoint.permissions)
         self.endpoint_identity = endpoint.identity
-        self.room_name = endpoint.room.name
+        self.room_id = endpoint.room_id
+        self.room_name = endpoint.room_name
         # Get the room webhook address
-        self.room_webhook = endpoint.room.webhook
+        self.room_webhook = endpoint.webhook
         # Get the user name
-        self.username = endpoint.room.owner.username
+        self.username = endpoint.username
         # Get the room group name
         self.room_group_name = f"{self.username}_{self.room_name}"
 
-        # Join room group
-        async_to_sync(self.channel_layer.group_add)(
-            self.room_group_name, self.channel_name
+        # Buckets limiting the messages written by this endpoint
+        self.rate_limiter = get_rate_limiter()
+        if self.rate_limiter is not None:
+            keys = {
+                "endpoint": self.endpoint_id,
+                "room": self.room_group_name,
+                "user": self.username,
+            }
+            self.rate_limit_keys = {
+                scope: keys[scope] for scope in self.rate_limiter.limits
+            }
+
+        # Clients asking for the msgpack subprotocol exchange binary frames
+        subprotocols = self.scope.get("subprotocols", ())
+        self.binary = "msgpack" in subprotocols
+        # Clients of the deflate subprotocol get the large frames compressed
+        self.deflate = (
+            not self.binary and settings.COMPRESSION and DEFLATE in subprotocols
         )
-        print(
-            f"Connected endpoint_code {self.endpoint_code} to {self.room_name} room of user {self.username}."
+        # In ack mode the client acknowledges the sequence numbers it processed
+        query = parse_qs(self.scope["query_string"].decode())
+        self.ack_mode = query.get("ack", [""])[0] in ("1", "true")
+        self.delivered_seq = 0
+        self.acked_seq = None
+        # Readers may subscribe to the messages of some identities only
+        identities = [
+            identity
+            for value in query.get("identities", ())
+            for identity in value.split(",")
+            if identity
+        ]
+        self.identity_filter = frozenset(identities) if identities else None
+        # Readers may take the frames in batches of up to batch milliseconds
+        # or batch_size frames, keeping the latest state updates with coalesce
+        try:
+            batch_delay = int(query.get("batch", ["0"])[0])
+            batch_size = int(query.get("batch_size", [settings.BATCH_MAX_SIZE])[0])
+        except ValueError:
+            batch_delay, batch_size = 0, 1
+        self.batch_delay = max(0, min(batch_delay, settings.BATCH_MAX_DELAY)) / 1000
+        self.batch_size = max(1, min(batch_size, settings.BATCH_MAX_SIZE))
+        self.coalesce = bool(self.batch_delay) and (
+            query.get("coalesce", [""])[0] in ("1", "true")
         )
 
-        self.accept()
+        # Only readers join the room group, write-only endpoints never get the
+        # room messages delivered
+        if self.permissions & READ:
+            # Frames to the client are queued so a slow client cannot stall
+            # the consumer; the queue starts after the replay
+            self.outbox = Outbox(
+                self.send,
+                self.room_group_name,
+                settings.OUTBOX_HIGH_WATERMARK,
+                settings.OUTBOX_LOW_WATERMARK,
+                settings.OUTBOX_POLICY,
+                paused=True,
+                batch_delay=self.batch_delay,
+                batch_size=self.batch_size,
+                binary=self.binary,
+                # Batches are compressed as a whole
+                compress=self.deflate,
+                coalesce=self.coalesce,
+                # Without acknowledgements nothing holds the frames back
+                window=(settings.OUTBOX_ACK_WINDOW or None) if self.ack_mode else None,
+            )
+            # Join room group, once per process with the local fan-out
+            if settings.LOCAL_FANOUT:
+                await get_fanout(self.channel_layer_alias).join(
+                    self.room_group_name, self, self.identity_filter
+                )
+            else:
+                await self.channel_layer.group_add(
+                    self.room_group_name, self.channel_name
+                )
+        active_connections.inc(room=self.room_group_name)
+        if settings.PRESENCE:
+            await get_tracker().join(
+                self.room_group_name,
+                self.channel_name,
+                self.endpoint_identity,
+                self.channel_layer_alias,
+            )
+        logger.debug(
+            "Connected endpoint %s to %s room of user %s.",
+            self.endpoint_id,
+            self.room_name,
+            self.username,
+        )
+
+        if self.binary:
+            await self.accept("msgpack")
+        else:
+            await self.accept(DEFLATE if self.deflate else None)
+
+        if self.outbox is not None:
+            await self.replay(query)
+            self.outbox.resume()
+
+    async def replay(self, query):
+        """Sends the messages the client missed in a single frame.
+
+        The client passes the last sequence number or the timestamp it received.
+        In ack mode without either, everything after the last acked message is
+        replayed.
+        """
+        history = get_history()
+        if history is None:
+            return
+        since = parse_timestamp(query.get("since", [None])[0])
+        try:
+            last_seq = int(query["last_seq"][0])
+        except (KeyError, ValueError):
+            last_seq = None
+        if last_seq is None and since is None and self.ack_mode:
+            last_seq = await get_sequences().get_ack(
+                self.room_group_name, self.endpoint_id
+            )
+        if last_seq is None and since is None:
+            return
+        entries = await history.entries(self.username, self.room_group_name)
+        if last_seq is not None:
+            entries = select_after(entries, last_seq)
+        else:
+            entries = select_since(entries, since)
+        if self.identity_filter is not None:
+            entries = select_identities(entries, self.identity_filter)
+        if entries:
+            self.delivered_seq = codec.loads(entries[-1])["seq"]
+            # Live messages received meanwhile follow the replay, those published
+            # while joining are already part of it
+            self.outbox.discard_through(self.delivered_seq)
+            if self.binary:
+                messages = [codec.loads(entry) for entry in entries]
+                self.outbox.put_first(
+                    msgpack.packb({"type": "replay", "messages": messages})
+                )
+            else:
+                frame = replay_frame(entries)
+                if self.deflate and not self.batch_delay:
+                    frame = compress_frame(frame.encode()) or frame
+                self.outbox.put_first(frame)
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
+        # Rejected connections never joined a group
+        if self.room_group_name is None:
+            return
         # Leave room group
-        async_to_sync(self.channel_layer.group_discard)(
-            self.room_group_name, self.channel_name
+        if self.outbox is not None:
+            self.outbox.close()
+            if settings.LOCAL_FANOUT:
+                await get_fanout(self.channel_layer_alias).leave(
+                    self.room_group_name, self
+                )
+            else:
+                await self.channel_layer.group_discard(
+                    self.room_group_name, self.channel_name
+                )
+        if settings.PRESENCE:
+            await get_tracker().leave(
+                self.room_group_name,
+                self.channel_name,
+                self.endpoint_identity,
+                self.channel_layer_alias,
+            )
+        if self.ack_mode:
+            if self.acked_seq is not None:
+                await get_sequences().save_ack(
+                    self.room_group_name, self.endpoint_id, self.acked_seq
+                )
+            ack_lag.remove(room=self.room_group_name, endpoint=self.endpoint_id)
+        active_connections.dec(room=self.room_group_name)
+        logger.debug(
+            "Disconnected endpoint %s from %s room of user %s (code %s).",
+            self.endpoint_id,
+            self.room_name,
+            self.username,
+            close_code,
         )
-        print(f"Disconnected from {self.room_name} room.")
-        print(f"Disconnected channel name: {self.channel_name}")
-        self.close()
 
     # Receive message from WebSocket
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        # Oversized messages are refused before they are parsed
+        limit = settings.MAX_MESSAGE_SIZE
+        if limit and exceeds(text_data if bytes_data is None else bytes_data, limit):
+            logger.warning(
+                "Disconnecting endpoint %s of %s room sending an oversized message.",
+                self.endpoint_id,
+                self.room_group_name,
+            )
+            await self.close(code=settings.MAX_MESSAGE_CLOSE_CODE)
+            return
+        if bytes_data is not None:
+            text_data_json = msgpack.unpackb(bytes_data)
+        else:
+            text_data_json = codec.loads(text_data)
+        if "ack" in text_data_json:
+            self.acknowledge(text_data_json["ack"])
+            return
         message = text_data_json["message"]
+        # State updates may carry a key, superseding the previous update
+        key = text_data_json.get("key")
+        if not isinstance(key, str):
+            key = None
         # Add timestamp to the message using UTC timezone
         timestamp = datetime.now(timezone.utc).isoformat()
-        if "write" in self.permissions:
-            # Send message to room group
-            async_to_sync(self.channel_layer.group_send)(
-                self.room_group_name,
-                {
-                    "type": "room.message",
-                    "message": message,
-                    "identity": self.endpoint_identity,
-                    "timestamp": timestamp,
-                },
-            )
-            # Send the message as json to webhook adress
+        if self.permissions & WRITE:
+            if self.rate_limiter is not None and not await self.within_rate_limit():
+                return
+            seq = await get_sequences().next(self.room_group_name)
+            try:
+                event = message_event(
+                    self.room_group_name,
+                    self.endpoint_identity,
+                    message,
+                    seq,
+                    timestamp,
+                    key,
+                )
+            except TypeError:
+                # Binary values sent over msgpack cannot reach the json readers
+                return
+            # Store and send the message to the room group
+            await publish(self.channel_layer, self.username, event)
+            # Queue the message for delivery to the webhook adress
             if self.room_webhook:
-                # Send as a post request to the webhook
-                data_json = json.dumps(
+                get_dispatcher().enqueue(
+                    self.room_id,
+                    self.room_webhook,
                     {
                         "message": message,
                         "identity": self.endpoint_identity,
                         "endpoint_code": self.endpoint_code,
                         "room_name": self.room_name,
                         "timestamp": timestamp,
-                    }
+                        "seq": seq,
+                    },
                 )
-                # Send the data to the webhook
-                _ = requests.post(self.room_webhook, data=data_json)
             else:
                 # No webhook provided
                 pass
 
+    async def within_rate_limit(self):
+        """Takes a token for the message and applies the overflow policy.
+
+        Returns False if the message has to be dropped.
+        """
+        wait, scope = await self.rate_limiter.acquire(
+            self.rate_limit_keys, self.username
+        )
+        if not wait:
+            return True
+        policy = settings.RATE_LIMIT_POLICY
+        rate_limited.inc(scope=scope, policy=policy)
+        if policy == "delay":
+            # Hold the connection back until the buckets refill
+            while wait and wait <= settings.RATE_LIMIT_MAX_DELAY:
+                await asyncio.sleep(wait)
+                wait, scope = await self.rate_limiter.acquire(
+                    self.rate_limit_keys, self.username
+                )
+            return not wait
+        if policy == "close":
+            await self.close(code=settings.RATE_LIMIT_CLOSE_CODE)
+        return False
+
+    def acknowledge(self, seq):
+        """Records the sequence number the client processed."""
+        if not self.ack_mode or not isinstance(seq, int):
+            return
+        if self.acked_seq is None or seq > self.acked_seq:
+            self.acked_seq = seq
+            self.update_lag()
+            if self.outbox is not None:
+                self.outbox.acknowledge(seq)
 
-        
+    def update_lag(self):
+        acked = self.acked_seq or 0
+        ack_lag.set(
+            max(0, self.delivered_seq - acked),
+            room=self.room_group_name,
+            endpoint=self.endpoint_id,
+        )
 
     # Receive message from room group
-    def room_message(self, event):
-        if "read" in self.permissions:
-            # Extract the message from the event
-            message = event["message"]
-            identity = event["identity"]
-            timestamp = event["timestamp"]
-            # Send message to WebSocket
-            self.send(text_data=json.dumps({"message": message, "identity": identity, "timestamp": timestamp}))
+    async def room_message(self, event):
+        if self.identity_filter is not None and (
+            event["identity"] not in self.identity_filter
+        ):
+            return
+        if self.permissions & READ:
+            # Queue the pre-encoded message for the WebSocket
+            if self.binary:
+                frame = event["msgpack"]
+            elif self.batch_delay:
+                frame = event["text"]
+            else:
+                frame = (self.deflate and event.get("deflate")) or event["text"]
+            state = None
+            if self.coalesce and event.get("key") is not None:
+                state = (event["identity"], event["key"])
+            if not await self.deliver(frame, event["identity"], state, event["seq"]):
+                return
+            messages_sent.inc(room=self.room_group_name)
+            fanout_latency.observe(time.time() - event["sent"])
+            if self.ack_mode:
+                # Messages of concurrent writers may arrive out of seq order
+                self.delivered_seq = max(self.delivered_seq, event["seq"])
+                self.update_lag()
+
+    # Receive the batched join/leave events of the room
+    async def room_presence(self, event):
+        if self.permissions & READ:
+            await self.deliver(event["msgpack"] if self.binary else event["text"])
+
+    async def deliver(self, frame, key=None, state=None, seq=None):
+        """Queues the frame, disconnecting a reader too slow to take it.
+
+        Returns False if the reader was disconnected.
+        """
+        if self.outbox.put(frame, key, state, seq):
+            return True
+        logger.warning(
+            "Disconnecting slow endpoint %s of %s room.",
+            self.endpoint_id,
+            self.room_group_name,
+        )
+        await self.close(code=settings.OUTBOX_CLOSE_CODE)
+        return False
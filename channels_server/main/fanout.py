@@ -0,0 +1,128 @@
+"""Process-local fan-out of the room broadcasts.
+
+Instead of every connection joining the room group on the channel layer, the
+process joins every room once with a relay channel and hands the received
+events to its local consumers in memory. A broadcast then costs one channel
+layer delivery per process in the room rather than one per connection.
+
+The layers expire group members after group_expiry seconds, so the relay joins
+the group again with every consumer and every half of group_expiry.
+"""
+
+import asyncio
+import logging
+import weakref
+
+from channels.consumer import get_handler_name
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+
+class LocalFanout:
+    def __init__(self, channel_layer):
+        self.channel_layer = channel_layer
+        self.rooms = {}
+        self.channel_name = None
+        self._relay = None
+        self._refresh_task = None
+        self._start_lock = asyncio.Lock()
+        # Joins and leaves of a room run one at a time, so a leave cannot
+        # discard the group after a concurrent join added it
+        self._locks = weakref.WeakValueDictionary()
+
+    def _lock(self, group):
+        lock = self._locks.get(group)
+        if lock is None:
+            lock = self._locks[group] = asyncio.Lock()
+        return lock
+
+    async def _start(self):
+        async with self._start_lock:
+            if self._relay is None:
+                # A regular process-local channel - the redis layer receives
+                # all of them through one shared list per process
+                self.channel_name = await self.channel_layer.new_channel()
+                self._relay = asyncio.ensure_future(self._receive())
+                self._refresh_task = asyncio.ensure_future(self._refresh())
+
+    async def join(self, group, consumer, identities=None):
+        """Adds the consumer to the room, joining the group with it.
+
+        With identities the consumer only gets the messages of those senders.
+        """
+        await self._start()
+        async with self._lock(group):
+            await self.channel_layer.group_add(group, self.channel_name)
+            self.rooms.setdefault(group, {})[consumer] = identities
+
+    async def leave(self, group, consumer):
+        """Removes the consumer, leaving the group with the last one."""
+        async with self._lock(group):
+            members = self.rooms.get(group)
+            if members is None or consumer not in members:
+                return
+            del members[consumer]
+            if not members:
+                del self.rooms[group]
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def _refresh(self):
+        interval = getattr(self.channel_layer, "group_expiry", 86400) / 2
+        while True:
+            await asyncio.sleep(interval)
+            for group in list(self.rooms):
+                async with self._lock(group):
+                    if group not in self.rooms:
+                        continue
+                    try:
+                        await self.channel_layer.group_add(group, self.channel_name)
+                    except Exception:
+                        logger.exception("Relay group refresh of %s failed", group)
+
+    async def _receive(self):
+        while True:
+            try:
+                event = await self.channel_layer.receive(self.channel_name)
+            except Exception:
+                logger.exception("Relay channel receive failed")
+                await asyncio.sleep(1)
+                continue
+            members = self.rooms.get(event.get("room"))
+            if not members:
+                continue
+            handler = get_handler_name(event)
+            sender = event.get("identity")
+            # Consumers leaving during the fan-out must not change the loop
+            for consumer, identities in list(members.items()):
+                # Filtered out messages are skipped without a call
+                if identities is not None and sender is not None and (
+                    sender not in identities
+                ):
+                    continue
+                try:
+                    await getattr(consumer, handler)(event)
+                except Exception:
+                    logger.exception("Room event failed for %s", consumer)
+
+    def close(self):
+        for task in (self._relay, self._refresh_task):
+            if task is not None:
+                task.cancel()
+
+
+_fanouts = weakref.WeakKeyDictionary()
+
+
+def get_fanout(alias):
+    """Returns the fan-out of the channel layer alias in the running event loop."""
+    loop = asyncio.get_running_loop()
+    fanouts = _fanouts.setdefault(loop, {})
+    fanout = fanouts.get(alias)
+    channel_layer = get_channel_layer(alias)
+    # A changed layer (e.g. in tests) starts a new relay
+    if fanout is None or fanout.channel_layer is not channel_layer:
+        if fanout is not None:
+            fanout.close()
+        fanout = fanouts[alias] = LocalFanout(channel_layer)
+    return fanout
@@ -0,0 +1,188 @@
+"""Bounded per-room message history used to replay missed messages on connect.
+
+Every entry is the json frame sent to the readers, stored as text so that a
+replay only joins the stored strings. The history is capped per room by the
+number of messages and bytes, and per tenant (room owner) by bytes: when a
+tenant goes over its cap, the oldest messages of its largest room are evicted.
+With USE_REDIS the history lives in redis lists on the shard of the tenant,
+otherwise in the memory of the process.
+"""
+
+import threading
+import weakref
+from collections import deque
+from datetime import datetime
+
+from django.conf import settings
+
+from . import codec
+from .redis_client import get_shards
+
+
+def parse_timestamp(value):
+    """Parses an ISO timestamp sent by a client; returns None if invalid."""
+    try:
+        timestamp = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if timestamp.tzinfo is None:
+        return None
+    return timestamp
+
+
+def select_since(entries, since):
+    """Returns the entries sent after the since timestamp."""
+    return [
+        entry
+        for entry in entries
+        if datetime.fromisoformat(codec.loads(entry)["timestamp"]) > since
+    ]
+
+
+def select_after(entries, seq):
+    """Returns the entries with a sequence number above seq."""
+    return [entry for entry in entries if codec.loads(entry)["seq"] > seq]
+
+
+def select_identities(entries, identities):
+    """Returns the entries sent by the given identities."""
+    return [entry for entry in entries if codec.loads(entry)["identity"] in identities]
+
+
+def replay_frame(entries):
+    """Returns the single frame carrying the replayed entries."""
+    return '{"type": "replay", "messages": [' + ", ".join(entries) + "]}"
+
+
+class MemoryHistory:
+    def __init__(self):
+        self.rooms = {}
+        self.room_bytes = {}
+        self.tenant_rooms = {}
+        self.tenant_bytes = {}
+        self._lock = threading.Lock()
+
+    def _evict(self, tenant, room):
+        evicted = len(self.rooms[room].popleft())
+        self.room_bytes[room] -= evicted
+        self.tenant_bytes[tenant] -= evicted
+
+    async def append(self, tenant, room, entry):
+        size = len(entry)
+        if size > settings.HISTORY_ROOM_BYTES:
+            return
+        with self._lock:
+            entries = self.rooms.setdefault(room, deque())
+            entries.append(entry)
+            self.tenant_rooms.setdefault(tenant, set()).add(room)
+            self.room_bytes[room] = self.room_bytes.get(room, 0) + size
+            self.tenant_bytes[tenant] = self.tenant_bytes.get(tenant, 0) + size
+            while len(entries) > settings.HISTORY_SIZE or (
+                self.room_bytes[room] > settings.HISTORY_ROOM_BYTES
+            ):
+                self._evict(tenant, room)
+            while self.tenant_bytes[tenant] > settings.HISTORY_TENANT_BYTES:
+                largest = max(self.tenant_rooms[tenant], key=self.room_bytes.get)
+                self._evict(tenant, largest)
+
+    async def entries(self, tenant, room):
+        with self._lock:
+            return list(self.rooms.get(room, ()))
+
+    def clear(self):
+        with self._lock:
+            self.rooms.clear()
+            self.room_bytes.clear()
+            self.tenant_rooms.clear()
+            self.tenant_bytes.clear()
+
+
+# KEYS[1] - room list, KEYS[2] - tenant hash of bytes per room
+# ARGV - entry, max messages, room bytes cap, tenant bytes cap, ttl
+APPEND_SCRIPT = """
+local size = string.len(ARGV[1])
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('HINCRBY', KEYS[2], KEYS[1], size)
+local length = redis.call('LLEN', KEYS[1])
+local room_bytes = tonumber(redis.call('HGET', KEYS[2], KEYS[1]))
+while length > tonumber(ARGV[2]) or room_bytes > tonumber(ARGV[3]) do
+    room_bytes = room_bytes - string.len(redis.call('LPOP', KEYS[1]))
+    length = length - 1
+end
+redis.call('HSET', KEYS[2], KEYS[1], room_bytes)
+-- Sum the tenant rooms, forgetting the ones which expired
+local rooms = {}
+local tenant_bytes = 0
+local fields = redis.call('HGETALL', KEYS[2])
+for i = 1, #fields, 2 do
+    if redis.call('EXISTS', fields[i]) == 1 then
+        rooms[fields[i]] = tonumber(fields[i + 1])
+        tenant_bytes = tenant_bytes + rooms[fields[i]]
+    else
+        redis.call('HDEL', KEYS[2], fields[i])
+    end
+end
+while tenant_bytes > tonumber(ARGV[4]) do
+    local largest, largest_bytes = nil, -1
+    for name, bytes in pairs(rooms) do
+        if bytes > largest_bytes then
+            largest, largest_bytes = name, bytes
+        end
+    end
+    local evicted = string.len(redis.call('LPOP', largest))
+    rooms[largest] = largest_bytes - evicted
+    tenant_bytes = tenant_bytes - evicted
+    redis.call('HSET', KEYS[2], largest, rooms[largest])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+return length
+"""
+
+
+class RedisHistory:
+    def __init__(self, shards):
+        self.shards = shards
+        # The tenant cap spans all its rooms, so a tenant lives on one shard
+        self.append_script = shards.clients[0].register_script(APPEND_SCRIPT)
+
+    @staticmethod
+    def keys(tenant, room):
+        return [f"history:{tenant}:{room}", f"history_bytes:{tenant}"]
+
+    async def append(self, tenant, room, entry):
+        if len(entry) > settings.HISTORY_ROOM_BYTES:
+            return
+        await self.append_script(
+            keys=self.keys(tenant, room),
+            args=[
+                entry,
+                settings.HISTORY_SIZE,
+                settings.HISTORY_ROOM_BYTES,
+                settings.HISTORY_TENANT_BYTES,
+                settings.HISTORY_TTL,
+            ],
+            client=self.shards.get(tenant),
+        )
+
+    async def entries(self, tenant, room):
+        redis = self.shards.get(tenant)
+        entries = await redis.lrange(self.keys(tenant, room)[0], 0, -1)
+        return [entry.decode() for entry in entries]
+
+
+memory_history = MemoryHistory()
+_redis_histories = weakref.WeakKeyDictionary()
+
+
+def get_history():
+    """Returns the history backend, None if the history is disabled."""
+    if not settings.HISTORY_SIZE:
+        return None
+    if settings.USE_REDIS:
+        shards = get_shards()
+        history = _redis_histories.get(shards)
+        if history is None:
+            history = _redis_histories[shards] = RedisHistory(shards)
+        return history
+    return memory_history
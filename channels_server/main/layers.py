@@ -0,0 +1,24 @@
+"""Channel layer selection for the rooms.
+
+With REDIS_PUBSUB the "pubsub" layer carries the rooms broadcasting through
+redis pub/sub: every server process subscribes once per room and a broadcast
+is a single PUBLISH, instead of one redis operation per connection in the
+room. Either all the rooms (True) or the rooms created with "pubsub": true
+("per_room") use it.
+"""
+
+from channels import DEFAULT_CHANNEL_LAYER
+from django.conf import settings
+
+PUBSUB_CHANNEL_LAYER = "pubsub"
+
+
+def room_layer_alias(room_pubsub):
+    """Returns the CHANNEL_LAYERS alias carrying the group of a room."""
+    if PUBSUB_CHANNEL_LAYER not in settings.CHANNEL_LAYERS:
+        return DEFAULT_CHANNEL_LAYER
+    if settings.REDIS_PUBSUB is True or (
+        settings.REDIS_PUBSUB == "per_room" and room_pubsub
+    ):
+        return PUBSUB_CHANNEL_LAYER
+    return DEFAULT_CHANNEL_LAYER
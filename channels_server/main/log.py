@@ -0,0 +1,22 @@
+"""Logging helpers."""
+
+import logging
+import random
+
+
+class SamplingFilter(logging.Filter):
+    """Passes only a sample of the records below WARNING.
+
+    Connection events are logged at INFO/DEBUG for every socket; with many
+    sockets a rate below 1 keeps a representative share of them. Warnings and
+    errors always pass.
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        return random.random() < self.rate
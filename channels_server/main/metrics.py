@@ -0,0 +1,210 @@
+"""Process metrics in the Prometheus text exposition format.
+
+The metrics are kept in the memory of the process and served by the /metrics
+view; with several server processes every process is scraped on its own.
+"""
+
+import bisect
+import threading
+
+REGISTRY = []
+
+
+class Metric:
+    """Base of the metrics, holding one value per combination of labels."""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def collect(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            items = list(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self.values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            value = self.values.get(key, 0) - amount
+            if value:
+                self.values[key] = value
+            else:
+                # Drop the series, e.g. of a room without connections
+                self.values.pop(key, None)
+
+    def remove(self, **labels):
+        with self._lock:
+            self.values.pop(self._key(labels), None)
+
+
+class Histogram(Metric):
+    """Observations counted in cumulative buckets, e.g. latencies in seconds."""
+
+    type = "histogram"
+    DEFAULT_BUCKETS = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    )
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket, the +Inf count and the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def get(self, **labels):
+        """Returns the number of observations."""
+        counts = self.values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def collect(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        with self._lock:
+            items = [(key, list(counts)) for key, counts in self.values.items()]
+        names = self.labelnames + ("le",)
+        for key, counts in items:
+            cumulative = 0
+            bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                labels = format_labels(names, key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    """Returns all the registered metrics as text."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+active_connections = Gauge(
+    "room_active_connections",
+    "Websocket connections open per room",
+    ["room"],
+)
+messages_received = Counter(
+    "room_messages_received_total",
+    "Messages written to the rooms by the endpoints",
+    ["room"],
+)
+messages_sent = Counter(
+    "room_messages_sent_total",
+    "Room messages sent to the reading endpoints",
+    ["room"],
+)
+fanout_latency = Histogram(
+    "room_fanout_latency_seconds",
+    "Time from the broadcast of a message to its send to a reader",
+)
+connect_db_latency = Histogram(
+    "connect_db_latency_seconds",
+    "Time spent loading the endpoint from the database on connect",
+)
+webhook_latency = Histogram(
+    "webhook_latency_seconds",
+    "Time of a single webhook POST",
+)
+webhook_failures = Counter(
+    "webhook_failures_total",
+    "Failed webhook POSTs and messages dropped from full queues",
+    ["reason"],
+)
+http_request_latency = Histogram(
+    "http_request_latency_seconds",
+    "Time to respond to the REST requests per view",
+    ["view", "method"],
+)
+outbox_queued = Gauge(
+    "outbox_queued_frames",
+    "Frames queued for the websocket clients per room",
+    ["room"],
+)
+outbox_evicted = Counter(
+    "outbox_evicted_frames_total",
+    "Frames dropped from the queues of slow clients by overflow policy",
+    ["policy"],
+)
+ack_lag = Gauge(
+    "endpoint_ack_lag",
+    "Messages delivered to an endpoint but not acknowledged yet",
+    ["room", "endpoint"],
+)
+rate_limited = Counter(
+    "rate_limited_messages_total",
+    "Messages over the rate limits by limiting scope and policy",
+    ["scope", "policy"],
+)
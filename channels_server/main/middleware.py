@@ -0,0 +1,35 @@
+import time
+
+from django.utils.deprecation import MiddlewareMixin
+
+from .cache import resolve_tenant
+from .metrics import http_request_latency
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """Records the response time of every view in http_request_latency."""
+
+    def process_request(self, request):
+        request.metrics_start = time.perf_counter()
+
+    def process_response(self, request, response):
+        match = getattr(request, "resolver_match", None)
+        start = getattr(request, "metrics_start", None)
+        # Unresolved urls would add a series per requested path
+        if match is not None and start is not None:
+            http_request_latency.observe(
+                time.perf_counter() - start,
+                view=match.url_name or match.view_name,
+                method=request.method,
+            )
+        return response
+
+
+class TenantMiddleware(MiddlewareMixin):
+    """Authenticates the API-KEY header once per request.
+
+    request.tenant is the Tenant of the api key or None.
+    """
+
+    def process_request(self, request):
+        request.tenant = resolve_tenant(request.headers.get("API-KEY", ""))
@@ -0,0 +1,59 @@
+# Generated by Django 5.1.4 on 2026-10-18 15:18
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def digest(value):
+    if value is None:
+        return None
+    return hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+
+
+def fill_digests(apps, schema_editor):
+    CustomUser = apps.get_model("main", "CustomUser")
+    Endpoint = apps.get_model("main", "Endpoint")
+    for model, field in ((CustomUser, "api_key"), (Endpoint, "code")):
+        seen = set()
+        for row in model.objects.only(field).order_by("id").iterator():
+            value = digest(getattr(row, field))
+            # Duplicated keys were allowed before, only the oldest row keeps
+            # its key; the others cannot authenticate with it
+            if value in seen:
+                value = None
+            seen.add(value)
+            setattr(row, f"{field}_digest", value)
+            row.save(update_fields=[f"{field}_digest"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_webhookdeadletter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='api_key_digest',
+            field=models.CharField(editable=False, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='endpoint',
+            name='code_digest',
+            field=models.CharField(editable=False, max_length=32, null=True),
+        ),
+        migrations.RunPython(fill_digests, migrations.RunPython.noop),
+        # The digests carry the only index of the codes and api keys
+        migrations.AlterField(
+            model_name='customuser',
+            name='api_key_digest',
+            field=models.CharField(editable=False, max_length=32, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='endpoint',
+            name='code_digest',
+            field=models.CharField(editable=False, max_length=32, null=True, unique=True),
+        ),
+    ]
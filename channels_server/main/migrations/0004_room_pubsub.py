@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 15:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_key_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='pubsub',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,54 @@
+from django.db import migrations, models
+
+import main.models
+
+
+def to_bitmask(apps, schema_editor):
+    # Same substring semantics the consumers used on the old strings
+    Endpoint = apps.get_model("main", "Endpoint")
+    for endpoint in Endpoint.objects.only("permissions").iterator():
+        mask = 0
+        if "read" in endpoint.permissions:
+            mask |= 1
+        if "write" in endpoint.permissions:
+            mask |= 2
+        Endpoint.objects.filter(pk=endpoint.pk).update(permission_mask=mask)
+
+
+def to_names(apps, schema_editor):
+    Endpoint = apps.get_model("main", "Endpoint")
+    names = {0: "", 1: "read", 2: "write", 3: "readwrite"}
+    for mask, name in names.items():
+        Endpoint.objects.filter(permission_mask=mask).update(permissions=name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("main", "0004_room_pubsub"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="endpoint",
+            name="permission_mask",
+            field=main.models.PermissionField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(to_bitmask, to_names),
+        # A default lets the reverse migration add the names back
+        migrations.AlterField(
+            model_name="endpoint",
+            name="permissions",
+            field=models.CharField(default="", max_length=100),
+        ),
+        migrations.RemoveField(
+            model_name="endpoint",
+            name="permissions",
+        ),
+        migrations.RenameField(
+            model_name="endpoint",
+            old_name="permission_mask",
+            new_name="permissions",
+        ),
+    ]
@@ -1,10 +1,83 @@
 # Create your models here.
+import hashlib
+
 from django.contrib.auth.models import AbstractUser
+from django.core.exceptions import ValidationError
 from django.db import models
 
+from .permissions import LABELS, Permission
+
+
+def key_digest(value):
+    """Returns the fixed-width digest used to index endpoint codes and api keys."""
+    if value is None:
+        return None
+    return hashlib.blake2b(value.encode(), digest_size=16).hexdigest()
+
+
+def key_lookup(field, value):
+    """Returns the filter kwargs matching an endpoint code or an api key.
+
+    The digest column carries the only index, the callers compare the full value
+    of the row found.
+    """
+    return {f"{field}_digest": key_digest(value)}
+
+
+class PermissionField(models.PositiveSmallIntegerField):
+    """Endpoint permissions stored as a Permission bitmask.
+
+    The API names ("read", "write", "readwrite") are accepted on assignment.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault(
+            "choices", [(int(p), name) for p, name in LABELS.items() if name]
+        )
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs.pop("choices", None)
+        return name, path, args, kwargs
+
+    def from_db_value(self, value, expression, connection):
+        return None if value is None else Permission(value)
+
+    def to_python(self, value):
+        if value is None or isinstance(value, Permission):
+            return value
+        try:
+            if isinstance(value, str) and not value.isdigit():
+                return Permission.parse(value)
+            return Permission(int(value))
+        except ValueError as e:
+            raise ValidationError(str(e), code="invalid")
+
+    def get_prep_value(self, value):
+        if isinstance(value, str):
+            value = Permission.parse(value)
+        return super().get_prep_value(value)
+
 
 class CustomUser(AbstractUser):
+    # Unique and indexed through the fixed-width digest
     api_key = models.CharField(max_length=100, blank=True, null=True)
+    api_key_digest = models.CharField(
+        max_length=32, null=True, unique=True, editable=False
+    )
+
+    def validate_unique(self, exclude=None):
+        super().validate_unique(exclude)
+        if self.api_key is None:
+            return
+        users = CustomUser.objects.filter(**key_lookup("api_key", self.api_key))
+        if users.exclude(pk=self.pk).exists():
+            raise ValidationError({"api_key": "A user with this api key already exists."})
+
+    def save(self, *args, **kwargs):
+        self.api_key_digest = key_digest(self.api_key)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.username
@@ -14,18 +87,38 @@ class Room(models.Model):
     name = models.CharField(max_length=100)
     owner = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     webhook = models.CharField(max_length=100, blank=True, null=True, default='')
+    # Broadcast through the redis pub/sub layer (REDIS_PUBSUB: per_room)
+    pubsub = models.BooleanField(default=False)
 
     def __str__(self):
         return self.owner.username +"_"+self.name
 
 
 class Endpoint(models.Model):
+    # Unique and indexed through the fixed-width digest
     code = models.CharField(max_length=100)
-    permissions = models.CharField(max_length=100)
+    code_digest = models.CharField(max_length=32, null=True, unique=True, editable=False)
+    permissions = PermissionField()
     room = models.ForeignKey(Room, on_delete=models.CASCADE, default=None)
     identity = models.CharField(
         max_length=100
     )  # This is the identifiable information of the endpoint
 
+    def save(self, *args, **kwargs):
+        self.code_digest = key_digest(self.code)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return self.code
+
+
+class WebhookDeadLetter(models.Model):
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    webhook = models.CharField(max_length=100)
+    payload = models.TextField()  # The json payload that could not be delivered
+    error = models.CharField(max_length=200, blank=True, default="")
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.room} - {self.webhook} ({self.error})"
@@ -0,0 +1,212 @@
+"""Bounded outbound queue of a websocket connection.
+
+The consumer queues its frames in the outbox and a writer task sends them, so a
+client that cannot keep up never blocks the consumer. When the queue grows over
+the high watermark the overflow policy applies:
+
+- drop_oldest - the oldest frames are dropped down to the low watermark
+- coalesce - only the latest queued frame of every key (the sender identity) is
+  kept, then the oldest frames are dropped down to the low watermark
+- disconnect - the client is disconnected
+
+daphne hands the sent frames to the transport without backpressure, so the
+writer never waits for a slow client and the frames pile up in the transport
+instead of the queue. The queue only grows for clients acknowledging the
+sequence numbers they processed: with a window, no more than window frames are
+sent before the client acknowledges them and the rest wait in the queue.
+
+A batching outbox waits up to batch_delay seconds for batch_size frames and
+sends them as one array frame - a json array of the text frames or a msgpack
+array of the binary ones. With coalesce only the latest frame of every state
+key (a sender identity and the key of its message) is kept in a batch.
+"""
+
+import asyncio
+from collections import deque
+
+import msgpack
+
+from .compression import compress_frame
+from .metrics import outbox_evicted, outbox_queued
+
+POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+
+class Outbox:
+    def __init__(
+        self,
+        send,
+        room,
+        high_watermark,
+        low_watermark,
+        policy,
+        paused=False,
+        batch_delay=0,
+        batch_size=1,
+        binary=False,
+        compress=False,
+        coalesce=False,
+        window=None,
+    ):
+        self.send = send
+        self.room = room
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.policy = policy
+        self.frames = deque()
+        self.closed = False
+        # A paused outbox queues the frames until resume()
+        self.paused = paused
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self.binary = binary
+        self.compress = compress
+        self.coalesce = coalesce
+        self.window = window
+        # The sequence numbers sent and not acknowledged yet
+        self.unacked = deque()
+        self._ready = asyncio.Event()
+        self._full = asyncio.Event()
+        self._writer = asyncio.ensure_future(self._write())
+
+    def put(self, frame, key=None, state=None, seq=None):
+        """Queues the text or bytes frame without blocking.
+
+        The key groups the frames for the coalesce overflow policy and the
+        state key for the coalescing of batches. Frames with a seq count
+        against the window until acknowledged.
+        Returns False if the queue overflowed and the client has to be
+        disconnected.
+        """
+        if self.closed:
+            return True
+        self.frames.append((frame, key, state, seq))
+        outbox_queued.inc(room=self.room)
+        if self.batch_delay and len(self.frames) >= self.batch_size:
+            self._full.set()
+        if len(self.frames) > self.high_watermark:
+            if self.policy == "disconnect":
+                outbox_evicted.inc(len(self.frames), policy=self.policy)
+                self.close()
+                return False
+            if self.policy == "coalesce":
+                self._coalesce()
+            self._evict(len(self.frames) - self.low_watermark)
+        self._wake()
+        return True
+
+    def put_first(self, frame):
+        """Queues the frame ahead of the queued frames, e.g. a replay."""
+        if self.closed:
+            return
+        self.frames.appendleft((frame, None, None, None))
+        outbox_queued.inc(room=self.room)
+        self._wake()
+
+    def discard_through(self, seq):
+        """Drops the queued frames up to seq, e.g. those carried by a replay."""
+        kept = deque(item for item in self.frames if item[3] is None or item[3] > seq)
+        outbox_queued.dec(len(self.frames) - len(kept), room=self.room)
+        self.frames = kept
+
+    def resume(self):
+        self.paused = False
+        self._wake()
+
+    def acknowledge(self, seq):
+        """Opens the window by the frames up to the acknowledged seq."""
+        while self.unacked and self.unacked[0] <= seq:
+            self.unacked.popleft()
+        self._wake()
+
+    def _blocked(self):
+        return self.window is not None and len(self.unacked) >= self.window
+
+    def _wake(self):
+        if self.frames and not self.paused and not self._blocked():
+            self._ready.set()
+
+    def _sent(self, seq):
+        if self.window is not None and seq is not None:
+            self.unacked.append(seq)
+
+    def _coalesce(self):
+        latest = {}
+        for index, (_, key, _, _) in enumerate(self.frames):
+            if key is not None:
+                latest[key] = index
+        kept = deque(
+            item
+            for index, item in enumerate(self.frames)
+            if item[1] is None or latest[item[1]] == index
+        )
+        evicted = len(self.frames) - len(kept)
+        self.frames = kept
+        outbox_queued.dec(evicted, room=self.room)
+        outbox_evicted.inc(evicted, policy=self.policy)
+
+    def _evict(self, count):
+        if count <= 0:
+            return
+        for _ in range(count):
+            self.frames.popleft()
+        outbox_queued.dec(count, room=self.room)
+        outbox_evicted.inc(count, policy=self.policy)
+
+    def _batch(self):
+        """Pops the frames of the next batch and returns its array frame."""
+        items = [
+            self.frames.popleft() for _ in range(min(self.batch_size, len(self.frames)))
+        ]
+        outbox_queued.dec(len(items), room=self.room)
+        if self.coalesce:
+            latest = {item[2]: i for i, item in enumerate(items) if item[2]}
+            kept = [
+                item
+                for i, item in enumerate(items)
+                if item[2] is None or latest[item[2]] == i
+            ]
+            outbox_evicted.inc(len(items) - len(kept), policy="latest")
+            items = kept
+        frames = [item[0] for item in items]
+        for item in items:
+            self._sent(item[3])
+        if self.binary:
+            # The packed frames are the items of the msgpack array as they are
+            return msgpack.Packer().pack_array_header(len(frames)) + b"".join(frames)
+        text = "[" + ",".join(frames) + "]"
+        if self.compress:
+            return compress_frame(text.encode()) or text
+        return text
+
+    async def _write(self):
+        while True:
+            await self._ready.wait()
+            # Wait for a full batch, the batch of the first frame at most
+            if self.batch_delay and len(self.frames) < self.batch_size:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.batch_delay)
+                except asyncio.TimeoutError:
+                    pass
+            while self.frames and not self._blocked():
+                if self.batch_delay:
+                    frame = self._batch()
+                else:
+                    frame, _, _, seq = self.frames.popleft()
+                    outbox_queued.dec(room=self.room)
+                    self._sent(seq)
+                if isinstance(frame, bytes):
+                    await self.send(bytes_data=frame)
+                else:
+                    await self.send(text_data=frame)
+            self._ready.clear()
+
+    def close(self):
+        """Stops the writer and drops the queued frames."""
+        if self.closed:
+            return
+        self.closed = True
+        self._writer.cancel()
+        outbox_queued.dec(len(self.frames), room=self.room)
+        self.frames.clear()
@@ -0,0 +1,37 @@
+"""Endpoint permissions.
+
+The permissions are stored as a bitmask, so the consumers test them with a
+single integer operation per message. The API keeps the names read, write and
+readwrite.
+"""
+
+import enum
+
+
+class Permission(enum.IntFlag):
+    NONE = 0
+    READ = 1
+    WRITE = 2
+    READWRITE = READ | WRITE
+
+    @classmethod
+    def parse(cls, value):
+        """Returns the Permission for an API name; raises ValueError if invalid."""
+        try:
+            return NAMES[value]
+        except (KeyError, TypeError):
+            raise ValueError(
+                "Invalid permissions: The permissions should be read, write or readwrite"
+            ) from None
+
+    def __str__(self):
+        return LABELS[self]
+
+
+NAMES = {
+    "read": Permission.READ,
+    "write": Permission.WRITE,
+    "readwrite": Permission.READWRITE,
+}
+LABELS = {permission: name for name, permission in NAMES.items()}
+LABELS[Permission.NONE] = ""
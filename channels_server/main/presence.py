@@ -0,0 +1,235 @@
+"""Presence - the identities connected to every room.
+
+Every connection is a member of the presence set of its room (keyed like the
+room group, {username}_{room_name}) until it disconnects. Each server process
+refreshes the members of its connections with a heartbeat, so the members of a
+process that died expire after PRESENCE_TTL seconds. With USE_REDIS the sets are
+sorted sets scored by the expiry time on the shard of the room, otherwise they
+live in the memory of the process.
+
+With PRESENCE_EVENTS the readers of a room also receive the identities which
+joined and left it, batched every PRESENCE_EVENTS_INTERVAL seconds per process.
+"""
+
+import asyncio
+import logging
+import math
+import threading
+import time
+import weakref
+
+import msgpack
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import codec
+from .redis_client import get_shards
+
+logger = logging.getLogger(__name__)
+
+
+def member(connection, identity):
+    """Returns the presence member of a connection; channel names have no spaces."""
+    return f"{connection} {identity}"
+
+
+def identities(members):
+    """Returns the sorted distinct identities of the members."""
+    return sorted({m.split(" ", 1)[1] for m in members})
+
+
+class MemoryPresence:
+    def __init__(self):
+        self.rooms = {}
+        self._lock = threading.Lock()
+
+    async def refresh(self, rooms, ttl):
+        """Marks the members of every room as present for ttl seconds."""
+        expires = time.time() + ttl
+        with self._lock:
+            for room, members in rooms.items():
+                present = self.rooms.setdefault(room, {})
+                for m in members:
+                    present[m] = expires
+
+    async def remove(self, room, m):
+        with self._lock:
+            present = self.rooms.get(room)
+            if present is not None:
+                present.pop(m, None)
+                if not present:
+                    del self.rooms[room]
+
+    async def occupancy(self, rooms):
+        """Returns the identities present in every room."""
+        now = time.time()
+        with self._lock:
+            return {
+                room: identities(
+                    m for m, expires in self.rooms.get(room, {}).items() if expires > now
+                )
+                for room in rooms
+            }
+
+    def clear(self):
+        with self._lock:
+            self.rooms.clear()
+
+
+class RedisPresence:
+    def __init__(self, shards):
+        self.shards = shards
+
+    @staticmethod
+    def key(room):
+        return f"presence:{room}"
+
+    def by_shard(self, rooms):
+        shards = {}
+        for room in rooms:
+            shards.setdefault(self.shards.get(room), []).append(room)
+        return shards
+
+    async def refresh(self, rooms, ttl):
+        now = time.time()
+        for client, shard_rooms in self.by_shard(rooms).items():
+            async with client.pipeline(transaction=False) as pipe:
+                for room in shard_rooms:
+                    key = self.key(room)
+                    pipe.zadd(key, {m: now + ttl for m in rooms[room]})
+                    # Members of processes which stopped heartbeating
+                    pipe.zremrangebyscore(key, "-inf", now)
+                    pipe.expire(key, math.ceil(ttl))
+                await pipe.execute()
+
+    async def remove(self, room, m):
+        await self.shards.get(room).zrem(self.key(room), m)
+
+    async def occupancy(self, rooms):
+        now = time.time()
+        result = {}
+        for client, shard_rooms in self.by_shard(rooms).items():
+            async with client.pipeline(transaction=False) as pipe:
+                for room in shard_rooms:
+                    pipe.zrangebyscore(self.key(room), now, "+inf")
+                members = await pipe.execute()
+            for room, room_members in zip(shard_rooms, members):
+                result[room] = identities(m.decode() for m in room_members)
+        return {room: result[room] for room in rooms}
+
+
+memory_presence = MemoryPresence()
+_redis_presences = weakref.WeakKeyDictionary()
+
+
+def get_presence():
+    """Returns the presence backend."""
+    if settings.USE_REDIS:
+        shards = get_shards()
+        presence = _redis_presences.get(shards)
+        if presence is None:
+            presence = _redis_presences[shards] = RedisPresence(shards)
+        return presence
+    return memory_presence
+
+
+class PresenceTracker:
+    """The connections of this process: heartbeats their members and batches
+    the join/leave events of their rooms."""
+
+    def __init__(self):
+        self.rooms = {}
+        # The local connections of every identity of a room
+        self.connections = {}
+        self.pending = {}
+        self._heartbeat_task = None
+        self._events_task = None
+
+    async def join(self, room, connection, identity, alias):
+        m = member(connection, identity)
+        self.rooms.setdefault(room, {})[connection] = m
+        if self._heartbeat_task is None:
+            self._heartbeat_task = asyncio.ensure_future(self._heartbeat())
+        if settings.PRESENCE_EVENTS and self._events_task is None:
+            self._events_task = asyncio.ensure_future(self._flush_events())
+        await get_presence().refresh({room: [m]}, settings.PRESENCE_TTL)
+        counts = self.connections.setdefault(room, {})
+        counts[identity] = counts.get(identity, 0) + 1
+        # Only the first connection of the identity joins it
+        if counts[identity] == 1:
+            self.changed(room, alias, identity, 1)
+
+    async def leave(self, room, connection, identity, alias):
+        members = self.rooms.get(room)
+        if members is None or connection not in members:
+            return
+        m = members.pop(connection)
+        if not members:
+            del self.rooms[room]
+        counts = self.connections[room]
+        counts[identity] -= 1
+        if not counts[identity]:
+            del counts[identity]
+            if not counts:
+                del self.connections[room]
+            # The last connection of the identity leaves it
+            self.changed(room, alias, identity, -1)
+        await get_presence().remove(room, m)
+
+    def changed(self, room, alias, identity, change):
+        if not settings.PRESENCE_EVENTS:
+            return
+        _, changes = self.pending.setdefault(room, (alias, {}))
+        changes[identity] = changes.get(identity, 0) + change
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_HEARTBEAT)
+            rooms = {room: list(members.values()) for room, members in self.rooms.items()}
+            if not rooms:
+                continue
+            try:
+                await get_presence().refresh(rooms, settings.PRESENCE_TTL)
+            except Exception:
+                logger.exception("Presence heartbeat failed")
+
+    async def _flush_events(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_EVENTS_INTERVAL)
+            pending, self.pending = self.pending, {}
+            for room, (alias, changes) in pending.items():
+                # An identity joining and leaving within a batch cancels out
+                joined = sorted(i for i, change in changes.items() if change > 0)
+                left = sorted(i for i, change in changes.items() if change < 0)
+                if not joined and not left:
+                    continue
+                frame = {"type": "presence", "joined": joined, "left": left}
+                try:
+                    await get_channel_layer(alias).group_send(
+                        room,
+                        {
+                            "type": "room.presence",
+                            "room": room,
+                            "text": codec.dumps_text(frame),
+                            "msgpack": msgpack.packb(frame),
+                        },
+                    )
+                except Exception:
+                    logger.exception("Presence events of %s room failed", room)
+
+    def close(self):
+        for task in (self._heartbeat_task, self._events_task):
+            if task is not None:
+                task.cancel()
+
+
+_trackers = weakref.WeakKeyDictionary()
+
+
+def get_tracker():
+    """Returns the presence tracker of the running event loop."""
+    loop = asyncio.get_running_loop()
+    tracker = _trackers.get(loop)
+    if tracker is None:
+        tracker = _trackers[loop] = PresenceTracker()
+    return tracker
@@ -0,0 +1,54 @@
+"""Publishing of messages to the rooms, shared by the consumers of the writing
+endpoints and the broadcast view of the backend publishers.
+"""
+
+import time
+
+import msgpack
+
+from . import codec
+from .compression import compress_frame
+from .history import get_history
+from .metrics import messages_received
+
+
+def message_event(room, identity, message, seq, timestamp, key=None):
+    """Returns the room.message event of a message.
+
+    The frames are encoded once here and forwarded verbatim by every reader.
+    A key marks state updates superseded by the next message of the sender
+    with the same key.
+    Raises TypeError for messages json cannot encode (binary msgpack values).
+    """
+    frame = {
+        "message": message,
+        "identity": identity,
+        "timestamp": timestamp,
+        "seq": seq,
+    }
+    if key is not None:
+        frame["key"] = key
+    encoded = codec.dumps(frame)
+    return {
+        "type": "room.message",
+        "room": room,
+        "identity": identity,
+        "seq": seq,
+        "key": key,
+        # Text frames are str, decoded once for all the readers
+        "text": encoded.decode(),
+        "msgpack": msgpack.packb(frame),
+        "deflate": compress_frame(encoded),
+        "sent": time.time(),
+    }
+
+
+async def publish(channel_layer, username, event):
+    """Stores the message event in the room history and sends it to the room."""
+    room = event["room"]
+    messages_received.inc(room=room)
+    # Store the message for clients replaying the room history
+    history = get_history()
+    if history is not None:
+        await history.append(username, room, event["text"])
+    await channel_layer.group_send(room, event)
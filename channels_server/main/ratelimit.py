@@ -0,0 +1,154 @@
+"""Token bucket rate limits on the messages written to the rooms.
+
+RATE_LIMITS configures a bucket per endpoint, per room and per user (the room
+owner), each with a rate in messages per second and a burst size. A message is
+accepted only if every configured bucket has a token. The buckets live in the
+process by default; with RATE_LIMIT_REDIS they are shared by all the
+processes through a Lua script, on the shard of the user.
+"""
+
+import threading
+import time
+import weakref
+
+from django.conf import settings
+
+from .cache import LRUCache
+from .redis_client import get_shards
+
+SCOPES = ("endpoint", "room", "user")
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if now > self.updated:
+            elapsed = now - self.updated
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def wait(self):
+        """Returns the seconds until a token is available, 0 if it is now."""
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class MemoryRateLimiter:
+    def __init__(self, limits):
+        self.limits = limits
+        # Idle buckets are full again after burst / rate seconds
+        self.buckets = LRUCache(100000, 3600)
+        self._lock = threading.Lock()
+
+    async def acquire(self, keys, tenant=None):
+        """Takes a token from the bucket of every scope.
+
+        Returns (0, None) if the message is allowed, otherwise the seconds to
+        wait and the limiting scope; no tokens are taken then.
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            for scope, key in keys.items():
+                bucket = self.buckets.get((scope, key))
+                if bucket is None:
+                    limit = self.limits[scope]
+                    bucket = TokenBucket(limit["rate"], limit["burst"])
+                    self.buckets.set((scope, key), bucket)
+                bucket.refill(now)
+                buckets.append((scope, bucket))
+            wait, limited = max((bucket.wait(), scope) for scope, bucket in buckets)
+            if wait:
+                return wait, limited
+            for _, bucket in buckets:
+                bucket.tokens -= 1
+        return 0, None
+
+
+# KEYS - one hash per bucket; ARGV - rate and burst for every key
+# Returns 0 if allowed, otherwise {milliseconds to wait, index of the key}
+ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local tokens = {}
+local wait, limited = 0, 0
+for i = 1, #KEYS do
+    local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'updated')
+    local available = burst
+    if state[1] then
+        available = math.min(burst, tonumber(state[1]) + (now - tonumber(state[2])) * rate)
+    end
+    tokens[i] = available
+    if available < 1 and (1 - available) / rate > wait then
+        wait, limited = (1 - available) / rate, i
+    end
+end
+for i = 1, #KEYS do
+    local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+    if wait == 0 then
+        tokens[i] = tokens[i] - 1
+    end
+    redis.call('HSET', KEYS[i], 'tokens', tokens[i], 'updated', now)
+    redis.call('EXPIRE', KEYS[i], math.ceil(burst / rate) + 1)
+end
+if wait == 0 then
+    return 0
+end
+return {math.ceil(wait * 1000), limited}
+"""
+
+
+class RedisRateLimiter:
+    def __init__(self, shards, limits):
+        self.shards = shards
+        self.limits = limits
+        self.acquire_script = shards.clients[0].register_script(ACQUIRE_SCRIPT)
+
+    async def acquire(self, keys, tenant=None):
+        scopes = list(keys)
+        args = []
+        for scope in scopes:
+            args.extend([self.limits[scope]["rate"], self.limits[scope]["burst"]])
+        # The buckets of a connection all belong to one tenant, keeping the
+        # script on a single shard
+        result = await self.acquire_script(
+            keys=[f"ratelimit:{scope}:{keys[scope]}" for scope in scopes],
+            args=args,
+            client=self.shards.get(tenant),
+        )
+        if result == 0:
+            return 0, None
+        wait, index = result
+        return wait / 1000, scopes[index - 1]
+
+
+_memory_limiter = None
+_redis_limiters = weakref.WeakKeyDictionary()
+
+
+def get_rate_limiter():
+    """Returns the rate limiter, None if no rate limits are configured."""
+    global _memory_limiter
+    limits = {
+        scope: settings.RATE_LIMITS[scope]
+        for scope in SCOPES
+        if settings.RATE_LIMITS.get(scope)
+    }
+    if not limits:
+        return None
+    if settings.RATE_LIMIT_REDIS:
+        shards = get_shards()
+        limiter = _redis_limiters.get(shards)
+        if limiter is None or limiter.limits != limits:
+            limiter = _redis_limiters[shards] = RedisRateLimiter(shards, limits)
+        return limiter
+    if _memory_limiter is None or _memory_limiter.limits != limits:
+        _memory_limiter = MemoryRateLimiter(limits)
+    return _memory_limiter
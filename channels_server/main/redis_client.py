@@ -0,0 +1,62 @@
+"""Redis connections for the room state kept next to the channel layer.
+
+REDIS_HOSTS lists one entry per shard. The state of a room is kept on the shard
+picked by a consistent hash of its key, the same way the channel layer spreads
+the groups, so adding state does not funnel every room through one redis.
+"""
+
+import asyncio
+import binascii
+import weakref
+
+from django.conf import settings
+from redis import asyncio as aioredis
+
+_shards = weakref.WeakKeyDictionary()
+
+
+def shard_index(key, count):
+    """Maps the key to one of count shards through a 4096 slot crc32 ring."""
+    if count == 1:
+        return 0
+    slot = binascii.crc32(str(key).encode()) & 0xFFF
+    return int(slot / (4096 / count))
+
+
+def create_client(host):
+    """Returns a client for a REDIS_HOSTS entry.
+
+    An entry is a redis:// url, a (host, port) pair or a dict with either
+    "sentinels" and "master_name" or the keyword arguments of the client.
+    """
+    if isinstance(host, str):
+        return aioredis.Redis.from_url(host)
+    if isinstance(host, (tuple, list)):
+        return aioredis.Redis(host=host[0], port=host[1])
+    host = dict(host)
+    if "master_name" in host:
+        sentinel = aioredis.sentinel.Sentinel(
+            host.pop("sentinels"), sentinel_kwargs=host.pop("sentinel_kwargs", None)
+        )
+        return sentinel.master_for(host.pop("master_name"), **host)
+    if "address" in host:
+        return aioredis.Redis.from_url(host.pop("address"), **host)
+    return aioredis.Redis(**host)
+
+
+class RedisShards:
+    def __init__(self, hosts):
+        self.clients = [create_client(host) for host in hosts]
+
+    def get(self, key):
+        """Returns the client of the shard holding the key."""
+        return self.clients[shard_index(key, len(self.clients))]
+
+
+def get_shards():
+    """Returns the redis shards of the running event loop."""
+    loop = asyncio.get_running_loop()
+    shards = _shards.get(loop)
+    if shards is None:
+        shards = _shards[loop] = RedisShards(settings.REDIS_HOSTS)
+    return shards
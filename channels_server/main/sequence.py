@@ -0,0 +1,67 @@
+"""Per-room message sequence numbers and the acknowledged positions of endpoints.
+
+With USE_REDIS the sequence numbers come from INCR on a shared key, so they are
+monotonic across all the server processes. Acknowledged positions are saved
+when an endpoint disconnects and are used to replay what it did not ack.
+"""
+
+import threading
+import weakref
+
+from django.conf import settings
+
+from .redis_client import get_shards
+
+
+class MemorySequences:
+    def __init__(self):
+        self.sequences = {}
+        self.acks = {}
+        self._lock = threading.Lock()
+
+    async def next(self, room, count=1):
+        """Takes count sequence numbers of the room and returns the last one."""
+        with self._lock:
+            seq = self.sequences[room] = self.sequences.get(room, 0) + count
+        return seq
+
+    async def save_ack(self, room, endpoint_id, seq):
+        self.acks[room, endpoint_id] = seq
+
+    async def get_ack(self, room, endpoint_id):
+        return self.acks.get((room, endpoint_id))
+
+    def clear(self):
+        with self._lock:
+            self.sequences.clear()
+            self.acks.clear()
+
+
+class RedisSequences:
+    def __init__(self, shards):
+        self.shards = shards
+
+    async def next(self, room, count=1):
+        return await self.shards.get(room).incrby(f"seq:{room}", count)
+
+    async def save_ack(self, room, endpoint_id, seq):
+        await self.shards.get(room).hset(f"acks:{room}", endpoint_id, seq)
+
+    async def get_ack(self, room, endpoint_id):
+        seq = await self.shards.get(room).hget(f"acks:{room}", endpoint_id)
+        return None if seq is None else int(seq)
+
+
+memory_sequences = MemorySequences()
+_redis_sequences = weakref.WeakKeyDictionary()
+
+
+def get_sequences():
+    """Returns the sequence number backend."""
+    if settings.USE_REDIS:
+        shards = get_shards()
+        sequences = _redis_sequences.get(shards)
+        if sequences is None:
+            sequences = _redis_sequences[shards] = RedisSequences(shards)
+        return sequences
+    return memory_sequences
@@ -0,0 +1,27 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import endpoint_cache, tenant_cache
+from .models import CustomUser, Endpoint, Room, key_digest
+
+
+@receiver([post_save, post_delete], sender=Endpoint)
+def invalidate_endpoint(sender, instance, **kwargs):
+    # The code itself may have been changed, so match on the primary key too
+    endpoint_cache.delete(instance.code)
+    endpoint_cache.delete_where(lambda e: e.id == instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Room)
+def invalidate_room(sender, instance, **kwargs):
+    endpoint_cache.delete_where(lambda e: e.room_id == instance.pk)
+
+
+@receiver([post_save, post_delete], sender=CustomUser)
+def invalidate_user(sender, instance, **kwargs):
+    endpoint_cache.delete_where(lambda e: e.owner_id == instance.pk)
+    # A changed api key leaves the old one cached under its digest, and a new
+    # user may take over a key cached for another one
+    tenant_cache.delete_where(lambda t: t.id == instance.pk)
+    if instance.api_key:
+        tenant_cache.delete(key_digest(instance.api_key))
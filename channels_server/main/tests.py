@@ -1,12 +1,43 @@
+import asyncio
 import json
+import zlib
+from datetime import datetime, timezone
+from unittest import mock
+from urllib.parse import quote
+
+import msgpack
+import requests
 from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
 from channels.testing import WebsocketCommunicator
 from django.contrib.auth import get_user_model
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
 from django.test import TestCase, override_settings
 from django.urls import reverse
 
 from channels_server.asgi import application
-from .models import Endpoint, Room
+from . import codec
+from .cache import endpoint_cache, resolve_endpoint
+from .consumers import RoomConsumer
+from .fanout import LocalFanout
+from .history import MemoryHistory, memory_history
+from .metrics import (
+	Histogram,
+	ack_lag,
+	active_connections,
+	http_request_latency,
+	messages_sent,
+	outbox_evicted,
+	rate_limited,
+)
+from .models import Endpoint, Room, WebhookDeadLetter, key_digest
+from .outbox import Outbox
+from .permissions import Permission
+from .presence import get_presence, member, memory_presence
+from .redis_client import RedisShards, shard_index
+from .webhooks import WebhookDispatcher
 
 
 User = get_user_model()
@@ -47,6 +78,20 @@ class ViewTests(TestCase):
 		room.refresh_from_db()
 		self.assertEqual(room.webhook, "https://example.com/new")
 
+	def test_create_room_refuses_to_change_pubsub(self):
+		payload = json.dumps({"room_name": "alpha", "pubsub": True})
+		response = self.client.post(
+			reverse("create_room"), data=payload, content_type="application/json"
+		)
+		self.assertEqual(response.status_code, 400)
+		self.room.refresh_from_db()
+		self.assertFalse(self.room.pubsub)
+		payload = json.dumps({"room_name": "alpha", "pubsub": False, "webhook": "https://a.b"})
+		response = self.client.post(
+			reverse("create_room"), data=payload, content_type="application/json"
+		)
+		self.assertEqual(response.status_code, 200)
+
 	def test_list_rooms_returns_owned_rooms(self):
 		response = self.client.get(reverse("list_rooms"))
 		self.assertEqual(response.status_code, 200)
@@ -54,6 +99,122 @@ class ViewTests(TestCase):
 		self.assertIn("alpha", data)
 		self.assertEqual(data["alpha"]["owner"], self.user.username)
 
+	def test_list_rooms_runs_constant_queries(self):
+		for i in range(5):
+			Room.objects.create(name=f"room{i}", owner=self.user)
+		# Authentication and the rooms, regardless of the number of rooms
+		with self.assertNumQueries(2):
+			response = self.client.get(reverse("list_rooms"))
+		self.assertEqual(len(response.json()), 6)
+
+	def test_tenant_is_cached_until_the_api_key_changes(self):
+		self.client.get(reverse("list_rooms"))
+		with self.assertNumQueries(1):
+			response = self.client.get(reverse("list_rooms"))
+		self.assertIn("alpha", response.json())
+		self.user.api_key = "rotated-key"
+		self.user.save()
+		self.assertEqual(self.client.get(reverse("list_rooms")).status_code, 403)
+		response = self.client.get(reverse("list_rooms"), HTTP_API_KEY="rotated-key")
+		self.assertEqual(response.status_code, 200)
+
+	def test_requests_without_api_key_use_the_default_user(self):
+		default = User.objects.create(username="default", api_key="")
+		self.client.defaults.pop("HTTP_API_KEY", None)
+		payload = json.dumps({"room_name": "beta"})
+		response = self.client.post(
+			reverse("create_room"), data=payload, content_type="application/json"
+		)
+		self.assertEqual(response.status_code, 200)
+		self.assertTrue(Room.objects.filter(name="beta", owner=default).exists())
+
+	def test_presence_returns_the_occupancy_of_many_rooms(self):
+		self.addCleanup(memory_presence.clear)
+		Room.objects.create(name="beta", owner=self.user)
+		members = [member("conn1", "a"), member("conn2", "b"), member("conn3", "a")]
+		async_to_sync(memory_presence.refresh)({"alice_alpha": members}, 30)
+		async_to_sync(memory_presence.refresh)({"alice_beta": [member("conn4", "c")]}, -1)
+		response = self.client.get(reverse("presence"), {"rooms": "alpha,beta"})
+		self.assertEqual(
+			response.json(),
+			{
+				"rooms": {
+					"alpha": {"count": 2, "identities": ["a", "b"]},
+					"beta": {"count": 0, "identities": []},
+				}
+			},
+		)
+		response = self.client.get(reverse("presence"))
+		self.assertEqual(list(response.json()["rooms"]), ["alpha", "beta"])
+
+	@override_settings(MAX_PAGE_SIZE=2)
+	def test_presence_pages_through_all_the_rooms(self):
+		for name in ("beta", "gamma"):
+			Room.objects.create(name=name, owner=self.user)
+		first = self.client.get(reverse("presence")).json()
+		self.assertEqual(list(first["rooms"]), ["alpha", "beta"])
+		second = self.client.get(reverse("presence"), {"cursor": first["next_cursor"]}).json()
+		self.assertEqual(list(second["rooms"]), ["gamma"])
+		self.assertIsNone(second["next_cursor"])
+		response = self.client.get(reverse("presence"), {"rooms": "alpha,beta,gamma"})
+		self.assertEqual(response.status_code, 400)
+
+	def test_broadcast_rejects_unknown_rooms_and_invalid_messages(self):
+		payload = {"room_names": ["alpha", "missing"], "message": "hello"}
+		response = self.client.post(reverse("broadcast"), payload, content_type="application/json")
+		self.assertEqual(response.status_code, 404)
+		self.assertIn("missing", response.content.decode())
+		response = self.client.post(
+			reverse("broadcast"), {"messages": [{"room_name": "alpha"}]}, content_type="application/json"
+		)
+		self.assertEqual(response.status_code, 400)
+
+	def test_list_rooms_paginates_with_cursor(self):
+		for i in range(4):
+			Room.objects.create(name=f"room{i}", owner=self.user)
+		response = self.client.get(reverse("list_rooms"), {"limit": 3})
+		first = response.json()
+		self.assertEqual([r["room_name"] for r in first["rooms"]], ["alpha", "room0", "room1"])
+		response = self.client.get(
+			reverse("list_rooms"), {"limit": 3, "cursor": first["next_cursor"]}
+		)
+		second = response.json()
+		self.assertEqual([r["room_name"] for r in second["rooms"]], ["room2", "room3"])
+		self.assertIsNone(second["next_cursor"])
+		response = self.client.get(reverse("list_rooms"), {"limit": 0})
+		self.assertEqual(response.status_code, 400)
+
+	@override_settings(STREAM_CHUNK_SIZE=2)
+	def test_list_endpoints_streams_ndjson(self):
+		for i in range(5):
+			Endpoint.objects.create(
+				code=f"code{i}", permissions="read", room=self.room, identity=f"client{i}"
+			)
+		response = self.client.get(
+			reverse("list_endpoints", args=["alpha"]), {"format": "ndjson", "limit": 4}
+		)
+		self.assertEqual(response["Content-Type"], "application/x-ndjson")
+		lines = [json.loads(line) for line in b"".join(response).splitlines()]
+		self.assertEqual([line["identity"] for line in lines[:4]], [f"client{i}" for i in range(4)])
+		response = self.client.get(
+			reverse("list_endpoints", args=["alpha"]),
+			{"format": "ndjson", "cursor": lines[4]["next_cursor"]},
+		)
+		lines = [json.loads(line) for line in b"".join(response).splitlines()]
+		self.assertEqual(lines, [{"code": "code4", "permissions": "read", "identity": "client4"}])
+
+	def test_list_endpoints_paginated_queries(self):
+		for i in range(5):
+			Endpoint.objects.create(
+				code=f"code{i}", permissions="read", room=self.room, identity=f"client{i}"
+			)
+		# Authentication, the room and one page of endpoints
+		with self.assertNumQueries(3):
+			response = self.client.get(reverse("list_endpoints", args=["alpha"]), {"limit": 2})
+		data = response.json()
+		self.assertEqual(len(data["endpoints"]), 2)
+		self.assertIsNotNone(data["next_cursor"])
+
 	def test_add_endpoint_creates_endpoint_and_returns_code(self):
 		payload = json.dumps({"identity": "bot", "room_name": "alpha", "permissions": "readwrite"})
 		response = self.client.post(
@@ -65,6 +226,49 @@ class ViewTests(TestCase):
 		self.assertEqual(endpoint.room, self.room)
 		self.assertEqual(len(endpoint.code), 100)
 		self.assertEqual(endpoint.identity, "bot")
+		self.assertEqual(endpoint.permissions, Permission.READ | Permission.WRITE)
+		self.assertEqual(data["permissions"], "readwrite")
+
+	def test_add_endpoint_rejects_invalid_permissions(self):
+		payload = json.dumps({"identity": "bot", "room_name": "alpha", "permissions": "raed"})
+		response = self.client.post(
+			reverse("add_endpoint"), data=payload, content_type="application/json"
+		)
+		self.assertEqual(response.status_code, 400)
+		self.assertFalse(Endpoint.objects.exists())
+
+	def test_add_endpoints_creates_endpoints_in_bulk(self):
+		payload = json.dumps(
+			{
+				"room_name": "alpha",
+				"endpoints": [
+					{"identity": f"student{i}", "permissions": "read"} for i in range(20)
+				]
+				+ [{"permissions": "readwrite"}],
+			}
+		)
+		# Authentication, room lookup and one INSERT inside a savepoint
+		with self.assertNumQueries(5):
+			response = self.client.post(
+				reverse("add_endpoints"), data=payload, content_type="application/json"
+			)
+		self.assertEqual(response.status_code, 200)
+		endpoints = response.json()["endpoints"]
+		self.assertEqual(len(endpoints), 21)
+		self.assertEqual(endpoints[-1]["identity"], "Anonymous")
+		stored = Endpoint.objects.get(code=endpoints[0]["code"])
+		self.assertEqual(stored.identity, "student0")
+		self.assertEqual(stored.code_digest, key_digest(stored.code))
+
+	def test_add_endpoints_rejects_missing_permissions(self):
+		payload = json.dumps(
+			{"room_name": "alpha", "endpoints": [{"identity": "a"}, {"permissions": "read"}]}
+		)
+		response = self.client.post(
+			reverse("add_endpoints"), data=payload, content_type="application/json"
+		)
+		self.assertEqual(response.status_code, 400)
+		self.assertFalse(Endpoint.objects.exists())
 
 	def test_list_endpoints_and_delete_endpoint(self):
 		endpoint = Endpoint.objects.create(
@@ -86,6 +290,40 @@ class ViewTests(TestCase):
 		self.assertFalse(Room.objects.filter(name="alpha", owner=self.user).exists())
 
 
+class KeyLookupTests(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(
+			username="erin", password="pass", api_key="erin-key"
+		)
+		self.room = Room.objects.create(name="keys", owner=self.user, webhook="")
+		self.endpoint = Endpoint.objects.create(
+			code="keycode", permissions="read", room=self.room, identity="viewer"
+		)
+
+	def test_digests_are_stored_on_save(self):
+		self.assertEqual(self.user.api_key_digest, key_digest("erin-key"))
+		self.assertEqual(self.endpoint.code_digest, key_digest("keycode"))
+		self.assertEqual(len(self.endpoint.code_digest), 32)
+
+	def test_codes_and_api_keys_are_unique(self):
+		with self.assertRaises(IntegrityError):
+			Endpoint.objects.create(
+				code="keycode", permissions="read", room=self.room, identity="copy"
+			)
+
+	def test_api_keys_are_validated_unique(self):
+		with self.assertRaises(ValidationError):
+			User(username="copy", api_key="erin-key").validate_unique()
+
+	def test_digest_lookups_authenticate_and_resolve(self):
+		response = self.client.get(reverse("list_rooms"), HTTP_API_KEY="erin-key")
+		self.assertEqual(response.status_code, 200)
+		self.assertIn("keys", response.json())
+		response = self.client.get(reverse("list_rooms"), HTTP_API_KEY="wrong-key")
+		self.assertEqual(response.status_code, 403)
+		self.assertEqual(resolve_endpoint("keycode").identity, "viewer")
+
+
 @override_settings(
 	CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
 )
@@ -161,3 +399,836 @@ class RoomConsumerTests(TestCase):
 			await reader.disconnect()
 
 		async_to_sync(run_test)()
+
+	def test_unknown_endpoint_is_rejected(self):
+		async def run_test():
+			communicator = WebsocketCommunicator(application, "/ws/endpoint/doesnotexist/")
+			connected, _ = await communicator.connect()
+			self.assertFalse(connected)
+
+		async_to_sync(run_test)()
+
+	def test_reconnecting_reader_gets_missed_messages_replayed(self):
+		memory_history.clear()
+
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			connected, _ = await sender.connect()
+			self.assertTrue(connected)
+			await sender.send_json_to({"message": "first"})
+			first = await sender.receive_json_from()
+			await sender.send_json_to({"message": "second"})
+			await sender.receive_json_from()
+			await sender.send_json_to({"message": "third"})
+			await sender.receive_json_from()
+
+			since = quote(first["timestamp"])
+			reader = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.receiver.code}/?since={since}"
+			)
+			connected, _ = await reader.connect()
+			self.assertTrue(connected)
+			replay = await reader.receive_json_from()
+			self.assertEqual(replay["type"], "replay")
+			self.assertEqual([m["message"] for m in replay["messages"]], ["second", "third"])
+			self.assertEqual(replay["messages"][0]["identity"], "sender")
+
+			await sender.disconnect()
+			await reader.disconnect()
+
+		async_to_sync(run_test)()
+
+	def test_messages_published_while_joining_are_not_replayed_twice(self):
+		memory_history.clear()
+		entries = MemoryHistory.entries
+
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			await sender.connect()
+			await sender.send_json_to({"message": "missed"})
+			missed = await sender.receive_json_from()
+
+			async def publish_then_read(history, tenant, room):
+				# A message reaching the joined reader before the history is read
+				await sender.send_json_to({"message": "meanwhile"})
+				await sender.receive_json_from()
+				return await entries(history, tenant, room)
+
+			reader = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.receiver.code}/?last_seq={missed['seq'] - 1}"
+			)
+			with mock.patch.object(MemoryHistory, "entries", publish_then_read):
+				await reader.connect()
+				replay = await reader.receive_json_from()
+			self.assertEqual([m["message"] for m in replay["messages"]], ["missed", "meanwhile"])
+			self.assertTrue(await reader.receive_nothing())
+			await sender.disconnect()
+			await reader.disconnect()
+
+		async_to_sync(run_test)()
+
+	def test_broadcasts_carry_increasing_sequence_numbers(self):
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+			await sender.connect()
+			await receiver.connect()
+			await sender.send_json_to({"message": "one"})
+			await sender.send_json_to({"message": "two"})
+			first = await receiver.receive_json_from()
+			second = await receiver.receive_json_from()
+			self.assertEqual(second["seq"], first["seq"] + 1)
+			await sender.disconnect()
+			await receiver.disconnect()
+
+		async_to_sync(run_test)()
+
+	def test_unacked_messages_are_replayed_in_ack_mode(self):
+		memory_history.clear()
+
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			reader = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.receiver.code}/?ack=1"
+			)
+			await sender.connect()
+			await reader.connect()
+			for message in ("a", "b", "c"):
+				await sender.send_json_to({"message": message})
+			received = [await reader.receive_json_from() for _ in range(3)]
+			await reader.send_json_to({"ack": received[0]["seq"]})
+			await reader.receive_nothing()
+			lag = ack_lag.get(room="bob_chat", endpoint=self.receiver.id)
+			self.assertEqual(lag, 2)
+			await reader.disconnect()
+
+			reader = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.receiver.code}/?ack=1"
+			)
+			await reader.connect()
+			replay = await reader.receive_json_from()
+			self.assertEqual([m["message"] for m in replay["messages"]], ["b", "c"])
+			await reader.disconnect()
+			await sender.disconnect()
+
+		async_to_sync(run_test)()
+
+	def test_msgpack_subprotocol_exchanges_binary_frames(self):
+		async def run_test():
+			sender = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.sender.code}/", subprotocols=["msgpack"]
+			)
+			json_reader = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.receiver.code}/"
+			)
+			connected, subprotocol = await sender.connect()
+			self.assertTrue(connected)
+			self.assertEqual(subprotocol, "msgpack")
+			await json_reader.connect()
+
+			await sender.send_to(bytes_data=msgpack.packb({"message": {"x": [1, 2]}}))
+			packed = await sender.receive_from()
+			self.assertIsInstance(packed, bytes)
+			frame = msgpack.unpackb(packed)
+			self.assertEqual(frame["message"], {"x": [1, 2]})
+			self.assertEqual(frame["identity"], "sender")
+			payload = await json_reader.receive_json_from()
+			self.assertEqual(payload["message"], {"x": [1, 2]})
+			self.assertEqual(payload["seq"], frame["seq"])
+
+			await sender.disconnect()
+			await json_reader.disconnect()
+
+		async_to_sync(run_test)()
+
+	def test_readers_receive_the_same_encoded_frame(self):
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+			await sender.connect()
+			await receiver.connect()
+			await sender.send_json_to({"message": {"nested": ["value", 1]}})
+			sent_back = await sender.receive_from()
+			received = await receiver.receive_from()
+			self.assertEqual(sent_back, received)
+			self.assertEqual(json.loads(received)["message"], {"nested": ["value", 1]})
+			await sender.disconnect()
+			await receiver.disconnect()
+
+		async_to_sync(run_test)()
+
+	@override_settings(
+		RATE_LIMITS={"endpoint": {"rate": 0.1, "burst": 2}}, RATE_LIMIT_POLICY="drop"
+	)
+	def test_messages_over_the_endpoint_rate_are_dropped(self):
+		dropped = rate_limited.get(scope="endpoint", policy="drop")
+
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+			await sender.connect()
+			await receiver.connect()
+			for message in ("one", "two", "three"):
+				await sender.send_json_to({"message": message})
+			self.assertEqual((await receiver.receive_json_from())["message"], "one")
+			self.assertEqual((await receiver.receive_json_from())["message"], "two")
+			self.assertTrue(await receiver.receive_nothing())
+			await sender.disconnect()
+			await receiver.disconnect()
+
+		async_to_sync(run_test)()
+		self.assertEqual(rate_limited.get(scope="endpoint", policy="drop"), dropped + 1)
+
+	@override_settings(
+		RATE_LIMITS={"room": {"rate": 0.1, "burst": 1}}, RATE_LIMIT_POLICY="close"
+	)
+	def test_close_policy_disconnects_the_writer(self):
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			await sender.connect()
+			await sender.send_json_to({"message": "allowed"})
+			await sender.receive_json_from()
+			await sender.send_json_to({"message": "limited"})
+			closed = await sender.receive_output()
+			self.assertEqual(closed, {"type": "websocket.close", "code": 4029})
+			await sender.disconnect()
+
+		async_to_sync(run_test)()
+
+	@override_settings(
+		CHANNEL_LAYERS={
+			"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+			"pubsub": {"BACKEND": "channels.layers.InMemoryChannelLayer"},
+		},
+		REDIS_PUBSUB="per_room",
+	)
+	def test_pubsub_rooms_broadcast_on_the_pubsub_layer(self):
+		self.room.pubsub = True
+		self.room.save()
+
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+			await sender.connect()
+			await receiver.connect()
+			self.assertIn("bob_chat", get_channel_layer("pubsub").groups)
+			self.assertNotIn("bob_chat", get_channel_layer().groups)
+			await sender.send_json_to({"message": "published"})
+			self.assertEqual((await receiver.receive_json_from())["message"], "published")
+			await sender.disconnect()
+			await receiver.disconnect()
+
+		async_to_sync(run_test)()
+
+	def test_process_joins_the_room_group_once(self):
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+			await sender.connect()
+			await receiver.connect()
+			self.assertEqual(len(get_channel_layer().groups["bob_chat"]), 1)
+			await sender.send_json_to({"message": "relayed"})
+			self.assertEqual((await sender.receive_json_from())["message"], "relayed")
+			self.assertEqual((await receiver.receive_json_from())["message"], "relayed")
+			await sender.disconnect()
+			self.assertEqual(len(get_channel_layer().groups["bob_chat"]), 1)
+			await receiver.disconnect()
+			self.assertNotIn("bob_chat", get_channel_layer().groups)
+
+		async_to_sync(run_test)()
+
+	def test_fanout_serializes_joins_and_leaves_of_a_room(self):
+		async def run_test():
+			layer = get_channel_layer()
+			fanout = LocalFanout(layer)
+			discard = layer.group_discard
+
+			async def slow_discard(group, channel):
+				await asyncio.sleep(0.05)
+				await discard(group, channel)
+
+			first, second = object(), object()
+			await fanout.join("room", first)
+			with mock.patch.object(layer, "group_discard", slow_discard):
+				await asyncio.gather(fanout.leave("room", first), fanout.join("room", second))
+			self.assertIn(fanout.channel_name, layer.groups["room"])
+			await fanout.leave("room", second)
+			self.assertNotIn("room", layer.groups)
+			fanout.close()
+
+		async_to_sync(run_test)()
+
+	@override_settings(LOCAL_FANOUT=False)
+	def test_write_only_endpoint_does_not_join_the_group(self):
+		async def run_test():
+			writer = WebsocketCommunicator(application, f"/ws/endpoint/{self.writer_only.code}/")
+			reader = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+			await writer.connect()
+			await reader.connect()
+			self.assertEqual(len(get_channel_layer().groups["bob_chat"]), 1)
+			await reader.disconnect()
+			self.assertNotIn("bob_chat", get_channel_layer().groups)
+			await writer.disconnect()
+
+		async_to_sync(run_test)()
+
+	def test_identity_filter_selects_the_senders(self):
+		async def run_test():
+			filtered = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.receiver.code}/?identities=writer"
+			)
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			writer = WebsocketCommunicator(application, f"/ws/endpoint/{self.writer_only.code}/")
+			await filtered.connect()
+			await sender.connect()
+			await writer.connect()
+			await sender.send_json_to({"message": "skipped"})
+			self.assertEqual((await sender.receive_json_from())["message"], "skipped")
+			await writer.send_json_to({"message": "selected"})
+			payload = await filtered.receive_json_from()
+			self.assertEqual(payload["message"], "selected")
+			self.assertTrue(await filtered.receive_nothing())
+			await filtered.disconnect()
+			await sender.disconnect()
+			await writer.disconnect()
+
+		async_to_sync(run_test)()
+
+	@override_settings(COMPRESSION=True, COMPRESSION_MIN_SIZE=200)
+	def test_deflate_subprotocol_compresses_large_frames(self):
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			receiver = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.receiver.code}/", subprotocols=["deflate"]
+			)
+			await sender.connect()
+			_, subprotocol = await receiver.connect()
+			self.assertEqual(subprotocol, "deflate")
+			await sender.send_json_to({"message": "small"})
+			self.assertEqual((await receiver.receive_json_from())["message"], "small")
+			snapshot = {"state": ["value"] * 100}
+			await sender.send_json_to({"message": snapshot})
+			frame = await receiver.receive_output()
+			self.assertIn("bytes", frame)
+			self.assertEqual(json.loads(zlib.decompress(frame["bytes"]))["message"], snapshot)
+			await sender.disconnect()
+			await receiver.disconnect()
+
+		async_to_sync(run_test)()
+
+	@override_settings(MAX_MESSAGE_SIZE=64)
+	def test_oversized_message_closes_the_connection(self):
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+			await sender.connect()
+			await receiver.connect()
+			await sender.send_to(text_data=json.dumps({"message": "é" * 40}))
+			self.assertEqual((await sender.receive_output())["code"], 4009)
+			self.assertTrue(await receiver.receive_nothing())
+			await sender.disconnect()
+			await receiver.disconnect()
+
+		async_to_sync(run_test)()
+
+	def test_batching_reader_receives_array_frames(self):
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			receiver = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.receiver.code}/?batch=100&batch_size=2"
+			)
+			coalescing = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.receiver.code}/?batch=100&coalesce=1"
+			)
+			await sender.connect()
+			await receiver.connect()
+			await coalescing.connect()
+			await sender.send_json_to({"message": {"x": 1}, "key": "position"})
+			await sender.send_json_to({"message": "hello"})
+			await sender.send_json_to({"message": {"x": 2}, "key": "position"})
+			# Full batches are sent at once, the rest after the delay
+			batch = await receiver.receive_json_from()
+			self.assertEqual([m["message"] for m in batch], [{"x": 1}, "hello"])
+			batch = await receiver.receive_json_from()
+			self.assertEqual([m["message"] for m in batch], [{"x": 2}])
+			# Only the latest state update of the batch is kept
+			batch = await coalescing.receive_json_from()
+			self.assertEqual([m["message"] for m in batch], ["hello", {"x": 2}])
+			self.assertEqual(batch[1]["key"], "position")
+			await sender.disconnect()
+			await receiver.disconnect()
+			await coalescing.disconnect()
+
+		async_to_sync(run_test)()
+
+	def test_presence_tracks_the_connected_identities(self):
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			writer = WebsocketCommunicator(application, f"/ws/endpoint/{self.writer_only.code}/")
+			await sender.connect()
+			await writer.connect()
+			occupancy = await get_presence().occupancy(["bob_chat", "bob_other"])
+			self.assertEqual(occupancy, {"bob_chat": ["sender", "writer"], "bob_other": []})
+			await writer.disconnect()
+			occupancy = await get_presence().occupancy(["bob_chat"])
+			self.assertEqual(occupancy, {"bob_chat": ["sender"]})
+			await sender.disconnect()
+
+		async_to_sync(run_test)()
+
+	@override_settings(PRESENCE_EVENTS=True, PRESENCE_EVENTS_INTERVAL=0.05)
+	def test_readers_receive_batched_presence_events(self):
+		async def run_test():
+			receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			writer = WebsocketCommunicator(application, f"/ws/endpoint/{self.writer_only.code}/")
+			await receiver.connect()
+			await sender.connect()
+			await writer.connect()
+			joined = set()
+			while not {"sender", "writer"} <= joined:
+				event = await receiver.receive_json_from(timeout=2)
+				self.assertEqual(event["type"], "presence")
+				joined.update(event["joined"])
+			await writer.disconnect()
+			event = await receiver.receive_json_from(timeout=2)
+			self.assertEqual(event, {"type": "presence", "joined": [], "left": ["writer"]})
+			await sender.disconnect()
+			await receiver.disconnect()
+
+		async_to_sync(run_test)()
+
+	@override_settings(PRESENCE_EVENTS=True, PRESENCE_EVENTS_INTERVAL=0.05)
+	def test_presence_events_follow_the_last_connection_of_an_identity(self):
+		async def run_test():
+			receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+			first = WebsocketCommunicator(application, f"/ws/endpoint/{self.writer_only.code}/")
+			second = WebsocketCommunicator(application, f"/ws/endpoint/{self.writer_only.code}/")
+			await receiver.connect()
+			await first.connect()
+			await second.connect()
+			joined = []
+			while "writer" not in joined:
+				joined.extend((await receiver.receive_json_from(timeout=2))["joined"])
+			self.assertEqual(joined.count("writer"), 1)
+			await first.disconnect()
+			self.assertTrue(await receiver.receive_nothing(timeout=0.2))
+			await second.disconnect()
+			event = await receiver.receive_json_from(timeout=2)
+			self.assertEqual(event, {"type": "presence", "joined": [], "left": ["writer"]})
+			await receiver.disconnect()
+
+		async_to_sync(run_test)()
+
+	def test_broadcast_view_publishes_to_the_readers(self):
+		async def run_test():
+			receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+			await receiver.connect()
+			response = await self.async_client.post(
+				reverse("broadcast"),
+				{
+					"messages": [
+						{"room_name": "chat", "message": "first"},
+						{"room_names": ["chat", "chat"], "message": {"n": 2}, "identity": "backend"},
+					]
+				},
+				content_type="application/json",
+				headers={"API-KEY": "bob-key"},
+			)
+			self.assertEqual(response.status_code, 200)
+			first = await receiver.receive_json_from()
+			second = await receiver.receive_json_from()
+			self.assertEqual((first["message"], first["identity"]), ("first", "server"))
+			self.assertEqual((second["message"], second["identity"]), ({"n": 2}, "backend"))
+			self.assertEqual(second["seq"], first["seq"] + 1)
+			self.assertEqual(
+				response.json(), {"published": 2, "last_seq": {"chat": second["seq"]}}
+			)
+			self.assertTrue(await receiver.receive_nothing())
+			await receiver.disconnect()
+
+		async_to_sync(run_test)()
+
+	def stall_receiver(self, release):
+		"""Blocks the sends to the receiver endpoint until release is set."""
+		send = RoomConsumer.send
+
+		async def stalled_send(consumer, *args, **kwargs):
+			if consumer.endpoint_identity == "receiver":
+				await release.wait()
+			await send(consumer, *args, **kwargs)
+
+		return mock.patch.object(RoomConsumer, "send", stalled_send)
+
+	@override_settings(
+		OUTBOX_HIGH_WATERMARK=3, OUTBOX_LOW_WATERMARK=1, OUTBOX_POLICY="disconnect"
+	)
+	def test_stalled_reader_is_disconnected(self):
+		async def run_test():
+			with self.stall_receiver(asyncio.Event()):
+				sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+				receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+				await sender.connect()
+				await receiver.connect()
+				for i in range(5):
+					await sender.send_json_to({"message": i})
+				closed = await receiver.receive_output()
+				self.assertEqual(closed, {"type": "websocket.close", "code": 4008})
+				await sender.disconnect()
+				await receiver.disconnect()
+
+		async_to_sync(run_test)()
+
+	@override_settings(OUTBOX_ACK_WINDOW=2)
+	def test_ack_mode_reader_receives_a_window_of_messages(self):
+		async def run_test():
+			sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+			receiver = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.receiver.code}/?ack=1"
+			)
+			await sender.connect()
+			await receiver.connect()
+			for i in range(4):
+				await sender.send_json_to({"message": i})
+			received = [await receiver.receive_json_from() for _ in range(2)]
+			self.assertEqual([m["message"] for m in received], [0, 1])
+			self.assertTrue(await receiver.receive_nothing())
+			await receiver.send_json_to({"ack": received[-1]["seq"]})
+			received = [await receiver.receive_json_from() for _ in range(2)]
+			self.assertEqual([m["message"] for m in received], [2, 3])
+			await sender.disconnect()
+			await receiver.disconnect()
+
+		async_to_sync(run_test)()
+
+	@override_settings(
+		OUTBOX_HIGH_WATERMARK=3, OUTBOX_LOW_WATERMARK=1, OUTBOX_POLICY="drop_oldest"
+	)
+	def test_stalled_reader_loses_oldest_messages(self):
+		evicted = outbox_evicted.get(policy="drop_oldest")
+
+		async def run_test():
+			release = asyncio.Event()
+			with self.stall_receiver(release):
+				sender = WebsocketCommunicator(application, f"/ws/endpoint/{self.sender.code}/")
+				receiver = WebsocketCommunicator(application, f"/ws/endpoint/{self.receiver.code}/")
+				await sender.connect()
+				await receiver.connect()
+				for i in range(8):
+					await sender.send_json_to({"message": i})
+				for i in range(8):
+					await sender.receive_json_from()
+				self.assertTrue(await receiver.receive_nothing())
+				release.set()
+				received = []
+				while not await receiver.receive_nothing():
+					received.append((await receiver.receive_json_from())["message"])
+				await sender.disconnect()
+				await receiver.disconnect()
+			return received
+
+		received = async_to_sync(run_test)()
+		self.assertLess(len(received), 8)
+		self.assertEqual(received[-1], 7)
+		self.assertEqual(received, sorted(received))
+		self.assertGreater(outbox_evicted.get(policy="drop_oldest"), evicted)
+
+	def test_coalescing_outbox_keeps_latest_frame_per_sender(self):
+		async def run_test():
+			send = mock.AsyncMock()
+			outbox = Outbox(send, "room", 4, 2, "coalesce")
+			# The writer task has not started yet, the frames stay queued
+			for frame, key in [("a1", "a"), ("b1", "b"), ("a2", "a"), ("b2", "b"), ("a3", "a")]:
+				self.assertTrue(outbox.put(frame, key))
+			queued = [frame for frame, *_ in outbox.frames]
+			outbox.close()
+			return queued
+
+		self.assertEqual(async_to_sync(run_test)(), ["b2", "a3"])
+
+	def test_ack_window_holds_frames_back_until_acknowledged(self):
+		async def run_test():
+			send = mock.AsyncMock()
+			outbox = Outbox(send, "room", 3, 1, "drop_oldest", window=2)
+			for seq in range(1, 3):
+				outbox.put(f"m{seq}", seq=seq)
+			await asyncio.sleep(0.01)
+			# The window is full, the queue fills up and drops the oldest frames
+			for seq in range(3, 7):
+				self.assertTrue(outbox.put(f"m{seq}", seq=seq))
+			await asyncio.sleep(0.01)
+			sent = [c.kwargs["text_data"] for c in send.call_args_list]
+			self.assertEqual(sent, ["m1", "m2"])
+			outbox.acknowledge(2)
+			await asyncio.sleep(0.01)
+			sent = [c.kwargs["text_data"] for c in send.call_args_list]
+			outbox.close()
+			return sent
+
+		self.assertEqual(async_to_sync(run_test)(), ["m1", "m2", "m6"])
+
+
+class RedisShardTests(TestCase):
+	def test_rooms_are_spread_like_the_channel_layer_groups(self):
+		from channels_redis.utils import _consistent_hash
+
+		rooms = [f"user_room{i}" for i in range(200)]
+		for room in rooms:
+			self.assertEqual(shard_index(room, 3), _consistent_hash(room, 3))
+		self.assertEqual({shard_index(room, 3) for room in rooms}, {0, 1, 2})
+
+	def test_shards_are_created_from_urls_pairs_and_sentinels(self):
+		shards = RedisShards(
+			[
+				"redis://127.0.0.1:6380/1",
+				("127.0.0.1", 6381),
+				{"sentinels": [("127.0.0.1", 26379)], "master_name": "shard"},
+			]
+		)
+		self.assertEqual(len(shards.clients), 3)
+		self.assertIs(shards.get("room"), shards.clients[shard_index("room", 3)])
+
+
+class MessageHistoryTests(TestCase):
+	def append(self, history, tenant, room, message):
+		entry = json.dumps(
+			{
+				"message": message,
+				"identity": "sender",
+				"timestamp": datetime.now(timezone.utc).isoformat(),
+			}
+		)
+		async_to_sync(history.append)(tenant, room, entry)
+
+	def messages(self, history, tenant, room):
+		entries = async_to_sync(history.entries)(tenant, room)
+		return [json.loads(entry)["message"] for entry in entries]
+
+	@override_settings(HISTORY_SIZE=3)
+	def test_room_keeps_latest_messages(self):
+		history = MemoryHistory()
+		for i in range(5):
+			self.append(history, "alice", "alice_room", i)
+		self.assertEqual(self.messages(history, "alice", "alice_room"), [2, 3, 4])
+
+	@override_settings(HISTORY_SIZE=100, HISTORY_ROOM_BYTES=1000, HISTORY_TENANT_BYTES=1000)
+	def test_tenant_cap_evicts_oldest_messages(self):
+		history = MemoryHistory()
+		for i in range(5):
+			self.append(history, "alice", "alice_one", "x" * 100)
+		for i in range(5):
+			self.append(history, "alice", "alice_two", "y" * 100)
+		# The largest room gives up its oldest messages first
+		self.assertLessEqual(history.tenant_bytes["alice"], 1000)
+		one = self.messages(history, "alice", "alice_one")
+		two = self.messages(history, "alice", "alice_two")
+		self.assertTrue(one and two)
+		self.assertLessEqual(abs(len(one) - len(two)), 1)
+		# Other tenants are not affected
+		self.append(history, "bob", "bob_room", "z")
+		self.assertEqual(self.messages(history, "bob", "bob_room"), ["z"])
+
+
+class EndpointCacheTests(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(
+			username="dave", password="pass", api_key="dave-key"
+		)
+		self.room = Room.objects.create(name="cached", owner=self.user, webhook="")
+		self.endpoint = Endpoint.objects.create(
+			code="cachedcode", permissions="read", room=self.room, identity="viewer"
+		)
+
+	def test_resolved_endpoint_is_served_from_cache(self):
+		with self.assertNumQueries(1):
+			resolved = resolve_endpoint("cachedcode")
+		self.assertEqual(resolved.room_name, "cached")
+		self.assertEqual(resolved.username, "dave")
+		hits = endpoint_cache.hits
+		with self.assertNumQueries(0):
+			self.assertEqual(resolve_endpoint("cachedcode"), resolved)
+		self.assertEqual(endpoint_cache.hits, hits + 1)
+
+	def test_cache_is_invalidated_on_save_and_delete(self):
+		resolve_endpoint("cachedcode")
+		self.room.webhook = "https://example.com/hook"
+		self.room.save()
+		self.assertEqual(resolve_endpoint("cachedcode").webhook, "https://example.com/hook")
+
+		self.endpoint.permissions = "readwrite"
+		self.endpoint.save()
+		self.assertEqual(resolve_endpoint("cachedcode").permissions, Permission.READWRITE)
+
+		self.user.username = "david"
+		self.user.save()
+		self.assertEqual(resolve_endpoint("cachedcode").username, "david")
+
+		self.endpoint.delete()
+		self.assertIsNone(resolve_endpoint("cachedcode"))
+
+
+class WebhookDispatcherTests(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(
+			username="carol", password="pass", api_key="carol-key"
+		)
+		self.room = Room.objects.create(
+			name="hooks", owner=self.user, webhook="http://127.0.0.1:9/hook"
+		)
+
+	def test_messages_are_posted_in_batches(self):
+		dispatcher = WebhookDispatcher(batch_size=3, batch_interval=1)
+		response = mock.Mock(status_code=200)
+
+		async def run_test():
+			with mock.patch.object(dispatcher, "_post", return_value=response) as post:
+				for i in range(3):
+					self.assertTrue(
+						dispatcher.enqueue(self.room.id, self.room.webhook, {"message": i})
+					)
+				while dispatcher.delivered < 3:
+					await asyncio.sleep(0.01)
+			return post
+
+		post = async_to_sync(run_test)()
+		post.assert_called_once()
+		webhook, data = post.call_args.args
+		self.assertEqual(webhook, self.room.webhook)
+		self.assertEqual([item["message"] for item in json.loads(data)], [0, 1, 2])
+
+	def test_failed_delivery_is_dead_lettered(self):
+		dispatcher = WebhookDispatcher(batch_size=1, max_retries=1, retry_backoff=0.01)
+
+		async def run_test():
+			with mock.patch.object(
+				dispatcher, "_post", side_effect=requests.ConnectionError("refused")
+			) as post:
+				await dispatcher._deliver(self.room.id, self.room.webhook, [{"message": "lost"}])
+			return post
+
+		post = async_to_sync(run_test)()
+		self.assertEqual(post.call_count, 2)
+		dead_letter = WebhookDeadLetter.objects.get(room=self.room)
+		self.assertEqual(json.loads(dead_letter.payload), {"message": "lost"})
+		self.assertEqual(dead_letter.attempts, 2)
+		self.assertIn("refused", dead_letter.error)
+
+	def test_client_errors_are_dead_lettered_without_retries(self):
+		dispatcher = WebhookDispatcher(batch_size=1, max_retries=3, retry_backoff=0.01)
+
+		async def run_test(status):
+			response = mock.Mock(status_code=status)
+			with mock.patch.object(dispatcher, "_post", return_value=response) as post:
+				await dispatcher._deliver(self.room.id, self.room.webhook, [{"message": status}])
+			return post.call_count
+
+		self.assertEqual(async_to_sync(run_test)(404), 1)
+		self.assertEqual(async_to_sync(run_test)(429), 4)
+		self.assertEqual(async_to_sync(run_test)(503), 4)
+		self.assertEqual(WebhookDeadLetter.objects.get(payload='{"message":404}').error, "HTTP 404")
+
+	def test_dropped_messages_are_dead_lettered_in_one_insert(self):
+		dispatcher = WebhookDispatcher(queue_size=1, batch_size=1)
+		response = mock.Mock(status_code=200)
+
+		async def run_test():
+			with mock.patch.object(dispatcher, "_post", return_value=response):
+				with mock.patch.object(
+					dispatcher, "_dead_letter", wraps=dispatcher._dead_letter
+				) as dead_letter:
+					for i in range(5):
+						dispatcher.enqueue(self.room.id, self.room.webhook, {"message": i})
+					await dispatcher._overflow_task
+			return dead_letter
+
+		dead_letter = async_to_sync(run_test)()
+		dead_letter.assert_called_once()
+		self.assertEqual(dispatcher.dropped, 4)
+		self.assertEqual(
+			sorted(json.loads(d.payload)["message"] for d in WebhookDeadLetter.objects.all()),
+			[1, 2, 3, 4],
+		)
+
+
+class MetricsTests(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_user(
+			username="dave", password="pass", api_key="dave-key"
+		)
+		self.room = Room.objects.create(name="gauges", owner=self.user)
+		self.endpoint = Endpoint.objects.create(
+			code="metricscode", permissions="readwrite", room=self.room, identity="m"
+		)
+
+	def test_histogram_renders_cumulative_buckets(self):
+		histogram = Histogram("test_latency_seconds", "Test", ["view"], buckets=(0.1, 1))
+		histogram.observe(0.05, view="a")
+		histogram.observe(0.5, view="a")
+		histogram.observe(5, view="a")
+		lines = histogram.collect()
+		self.assertIn('test_latency_seconds_bucket{view="a",le="0.1"} 1', lines)
+		self.assertIn('test_latency_seconds_bucket{view="a",le="1"} 2', lines)
+		self.assertIn('test_latency_seconds_bucket{view="a",le="+Inf"} 3', lines)
+		self.assertIn('test_latency_seconds_count{view="a"} 3', lines)
+		self.assertEqual(histogram.get(view="a"), 3)
+
+	@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+	def test_connections_and_messages_are_counted(self):
+		room = "dave_gauges"
+		sent = messages_sent.get(room=room)
+
+		async def run_test():
+			communicator = WebsocketCommunicator(
+				application, f"/ws/endpoint/{self.endpoint.code}/"
+			)
+			await communicator.connect()
+			self.assertEqual(active_connections.get(room=room), 1)
+			await communicator.send_json_to({"message": "counted"})
+			await communicator.receive_json_from()
+			await communicator.disconnect()
+
+		async_to_sync(run_test)()
+		self.assertEqual(active_connections.get(room=room), 0)
+		self.assertEqual(messages_sent.get(room=room) - sent, 1)
+
+	def test_metrics_view_is_disabled_by_default(self):
+		self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+
+	@override_settings(METRICS_ENABLED=True, METRICS_TOKEN="scrape-token")
+	def test_metrics_view_requires_the_token(self):
+		self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+		response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer wrong")
+		self.assertEqual(response.status_code, 403)
+		response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer scrape-token")
+		self.assertEqual(response.status_code, 200)
+
+	@override_settings(METRICS_ENABLED=True)
+	def test_metrics_view_exports_request_latency(self):
+		self.client.get(reverse("list_rooms"), HTTP_API_KEY="dave-key")
+		self.assertGreater(http_request_latency.get(view="list_rooms", method="GET"), 0)
+		response = self.client.get(reverse("metrics"))
+		self.assertEqual(response.status_code, 200)
+		self.assertIn(
+			'http_request_latency_seconds_count{view="list_rooms",method="GET"}',
+			response.content.decode(),
+		)
+		self.assertIn("# TYPE room_active_connections gauge", response.content.decode())
+
+
+class CodecTests(TestCase):
+	def tearDown(self):
+		codec.configure(settings.JSON_CODEC)
+
+	def test_codecs_write_the_same_compact_json(self):
+		data = {"message": {"text": "zażółć", "values": [1, 2.5, None, True]}, "seq": 7}
+		names = ["json"] + (["orjson"] if codec.orjson is not None else [])
+		for name in names:
+			codec.configure(name)
+			self.assertEqual(
+				codec.dumps(data),
+				'{"message":{"text":"zażółć","values":[1,2.5,null,true]},"seq":7}'.encode(),
+			)
+			self.assertEqual(codec.dumps_text(data), codec.dumps(data).decode())
+			self.assertEqual(codec.loads(codec.dumps(data)), data)
+			with self.assertRaises(TypeError):
+				codec.dumps({"message": b"binary"})
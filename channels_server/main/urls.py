@@ -12,7 +12,11 @@ urlpatterns = [
     path("list_rooms/", views.list_rooms, name="list_rooms"),
     path("delete_room/<str:room_name>/", views.delete_room, name="delete_room"),
     path("add_endpoint/", views.add_endpoint, name="add_endpoint"),
+    path("add_endpoints/", views.add_endpoints, name="add_endpoints"),
     path("delete_endpoint/<str:room_name>/<str:endpoint_code>/", views.delete_endpoint, name="delete_endpoint"),
     path("list_endpoints/<str:room_name>/", views.list_endpoints, name="list_endpoints"),
+    path("broadcast/", views.broadcast, name="broadcast"),
+    path("presence/", views.presence, name="presence"),
+    path("metrics", views.metrics, name="metrics"),
 
 ]
\ No newline at end of file
@@ -1,18 +1,37 @@
 from django.shortcuts import render, get_object_or_404
-from .models import CustomUser, Room, Endpoint
+from .models import Room, Endpoint, key_digest, key_lookup
+from .permissions import Permission
 from django.http import (
     HttpResponseNotFound,
     HttpResponseForbidden,
     HttpResponseBadRequest,
     HttpResponse,
-    JsonResponse,
+    StreamingHttpResponse,
+    Http404,
 )
+import asyncio
+import hmac
+import logging
 import random
-import json
+from datetime import datetime, timezone
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from . import codec
+from .layers import room_layer_alias
+from .metrics import render as render_metrics
+from .presence import get_presence
+from .publish import message_event, publish
+from .sequence import get_sequences
 
 # Import csrf_exempt
 from django.views.decorators.csrf import csrf_exempt
 
+logger = logging.getLogger(__name__)
+
 
 # Create your views here.
 def index(request):
@@ -27,88 +46,178 @@ def room_bad(request, endpoint_code):
     return render(request, "main/room_bad.html", {"endpoint_code": endpoint_code})
 
 
-def get_user(api_key):
-    try:
-        return CustomUser.objects.get(api_key=api_key)
-    except CustomUser.DoesNotExist:
-        return None
+def generate_endpoint_code():
+    """Returns a random 100 character endpoint code."""
+    return "".join(
+        random.choices(
+            "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", k=100
+        )
+    )
+
 
 @csrf_exempt
 def create_room(request):
     if request.method != "POST":
         return HttpResponseNotFound("Invalid request method")
-    # Get the API KEY from header
-    api_key = request.headers.get("API-KEY", "")
-    print("API KEY '", api_key, "'", sep="")
-    user = get_user(api_key)
-    if user is None:
+    # The tenant of the API KEY header, resolved by the TenantMiddleware
+    tenant = request.tenant
+    if tenant is None:
+        logger.warning("create_room with an invalid API KEY")
         return HttpResponseForbidden("No/Invalid API KEY")
     
     # Get data from json
-    data = json.loads(request.body)
+    data = codec.loads(request.body)
 
     room_name = data.get("room_name", None)
     if room_name is None:
         return HttpResponseBadRequest("Invalid room name")
     webhook = data.get("webhook", '')
+    pubsub = data.get("pubsub", None)
+    if pubsub is not None and not isinstance(pubsub, bool):
+        return HttpResponseBadRequest("Invalid pubsub: expected true or false")
 
     # Check if the room already exists
-    if Room.objects.filter(name=room_name, owner=user).exists():
+    if Room.objects.filter(name=room_name, owner_id=tenant.id).exists():
         # If so modify the webhook
-        room = Room.objects.get(name=room_name, owner=user)
+        room = Room.objects.get(name=room_name, owner_id=tenant.id)
+        # The connected endpoints stay on the layer they joined, a changed
+        # layer would split the room
+        if pubsub is not None and pubsub != room.pubsub:
+            return HttpResponseBadRequest(
+                "The pubsub of an existing room cannot change, delete and recreate the room"
+            )
         room.webhook = webhook
         room.save()
         return HttpResponse("Room already exists. Webhook updated successfully.")
     # Create a new room
-    Room.objects.create(name=room_name, owner=user, webhook=webhook)
+    Room.objects.create(
+        name=room_name, owner_id=tenant.id, webhook=webhook, pubsub=bool(pubsub)
+    )
+    logger.info("Room %s created by user %s", room_name, tenant.username)
     return HttpResponse("Room created successfully")
 
 
 def delete_room(request, room_name):
     
-    # Get the API KEY from header
-    api_key = request.headers.get("API-KEY", "")
-    user = get_user(api_key)
-    if user is None:
+    # The tenant of the API KEY header, resolved by the TenantMiddleware
+    tenant = request.tenant
+    if tenant is None:
         return HttpResponseForbidden("No/Invalid API KEY")
 
     # Get the room or return 404
-    room = get_object_or_404(Room, name=room_name, owner=user)
+    room = get_object_or_404(Room, name=room_name, owner_id=tenant.id)
     # Delete the room
     room.delete()
     return HttpResponse("Room deleted successfully")
 
 
+def get_page(request):
+    """Returns the (cursor, limit) of the query string, None if not given.
+
+    Raises ValueError for invalid values.
+    """
+    cursor = request.GET.get("cursor", None)
+    limit = request.GET.get("limit", None)
+    if cursor is not None:
+        cursor = int(cursor)
+    if limit is not None:
+        limit = int(limit)
+        if not 0 < limit <= settings.MAX_PAGE_SIZE:
+            raise ValueError("Invalid limit")
+    return cursor, limit
+
+
+def keyset(queryset, cursor):
+    """Orders the queryset by the primary key, starting after the cursor."""
+    queryset = queryset.order_by("id")
+    if cursor is not None:
+        queryset = queryset.filter(id__gt=cursor)
+    return queryset
+
+
+def page_rows(queryset, limit, to_row):
+    """Returns the rows of one page and the cursor of the next page."""
+    rows = list(queryset[:limit])
+    next_cursor = rows[-1]["id"] if rows and len(rows) == limit else None
+    return [to_row(row) for row in rows], next_cursor
+
+
+def json_response(data):
+    """Returns the data as a json response encoded by the codec."""
+    return HttpResponse(codec.dumps(data), content_type="application/json")
+
+
+def ndjson_response(queryset, limit, to_row):
+    """Streams the rows as newline delimited json, one object per line.
+
+    The rows are fetched in chunks by primary key from an async iterator, so
+    the server never holds more than one chunk. With a limit, a full page
+    ends with a {"next_cursor": ...} line.
+    """
+
+    async def lines():
+        sent = 0
+        last_id = None
+        while limit is None or sent < limit:
+            size = settings.STREAM_CHUNK_SIZE
+            if limit is not None:
+                size = min(size, limit - sent)
+            chunk = queryset if last_id is None else queryset.filter(id__gt=last_id)
+            rows = await sync_to_async(list)(chunk[:size])
+            for row in rows:
+                yield codec.dumps(to_row(row)) + b"\n"
+            sent += len(rows)
+            if len(rows) < size:
+                break
+            last_id = rows[-1]["id"]
+        if limit is not None and sent == limit:
+            yield codec.dumps({"next_cursor": last_id}) + b"\n"
+
+    return StreamingHttpResponse(lines(), content_type="application/x-ndjson")
+
+
 def list_rooms(request):
-    # Get API KEY
-    api_key = request.headers.get("API-KEY", "")
-    user = get_user(api_key)
-    if user is None:
+    # The tenant of the API KEY header, resolved by the TenantMiddleware
+    tenant = request.tenant
+    if tenant is None:
         return HttpResponseForbidden("No/Invalid API KEY")
-    # Get all rooms for the user
-    rooms = Room.objects.filter(owner=user)
-    room_dict = {}
-    for room in rooms:
-        room_dict[room.name] = {
-            "webhook": room.webhook,
-            "room_name": room.name,
-            "owner": room.owner.username
+    try:
+        cursor, limit = get_page(request)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor or limit")
+    # Get the rooms for the user - the user is the owner of all of them
+    rooms = keyset(Room.objects.filter(owner_id=tenant.id), cursor).values(
+        "id", "name", "webhook", "pubsub"
+    )
+
+    def to_row(room):
+        return {
+            "webhook": room["webhook"],
+            "room_name": room["name"],
+            "owner": tenant.username,
+            "pubsub": room["pubsub"],
         }
-    return JsonResponse(room_dict)
+
+    if request.GET.get("format", None) == "ndjson":
+        return ndjson_response(rooms, limit, to_row)
+    rows, next_cursor = page_rows(rooms, limit, to_row)
+    if cursor is None and limit is None:
+        # Unpaginated listing keyed by the room name
+        return json_response({row["room_name"]: row for row in rows})
+    return json_response({"rooms": rows, "next_cursor": next_cursor})
 
 @csrf_exempt
 def add_endpoint(request):
     if request.method != "POST":
         return HttpResponseNotFound("Invalid request method")
-    # Get the API KEY from header
-    api_key = request.headers.get("API-KEY", "")
-    user = get_user(api_key)
-    if user is None:
+    # The tenant of the API KEY header, resolved by the TenantMiddleware
+    tenant = request.tenant
+    if tenant is None:
         return HttpResponseForbidden("No/Invalid API KEY")
     
 
     # Get data from json
-    data = json.loads(request.body)
+    data = codec.loads(request.body)
 
     # Get identity, room_name and permissions from the data
     identity = data.get("identity", "Anonymous")
@@ -118,75 +227,307 @@ def add_endpoint(request):
     # Check if the room name is valid
     if room_name is None:
         return HttpResponseBadRequest("Invalid room name")
-    if permissions is None:
-        return HttpResponseBadRequest("Invalid permissions: The permissions should be read, write or readwrite")
+    try:
+        permissions = Permission.parse(permissions)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
 
     # Get the room or return 404
-    room = get_object_or_404(Room, name=room_name, owner=user)
+    room = get_object_or_404(Room, name=room_name, owner_id=tenant.id)
 
     # Generate random 100 character code
-    endpoint_code = "".join(
-        random.choices(
-            "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789", k=100
-        )
-    )
+    endpoint_code = generate_endpoint_code()
 
     # Create a new endpoint
     Endpoint.objects.create(
         code=endpoint_code, permissions=permissions, room=room, identity=identity
     )
 
-    return JsonResponse(
-        {"code": endpoint_code, "permissions": permissions, "room_name": room_name, "identity": identity}
+    return json_response(
+        {"code": endpoint_code, "permissions": str(permissions), "room_name": room_name, "identity": identity}
     )
 
 
-def delete_endpoint(request, room_name, endpoint_code):
-    # Get the API KEY from header
-    api_key = request.headers.get("API-KEY", "")
-    user = get_user(api_key)
-    if user is None:
+@csrf_exempt
+def add_endpoints(request):
+    if request.method != "POST":
+        return HttpResponseNotFound("Invalid request method")
+    # The tenant of the API KEY header, resolved by the TenantMiddleware
+    tenant = request.tenant
+    if tenant is None:
         return HttpResponseForbidden("No/Invalid API KEY")
-    # Get the room or return 404
-    room = get_object_or_404(Room, name=room_name, owner=user)
-    # Get the endpoint or return 404
-    endpoint = get_object_or_404(Endpoint, code=endpoint_code, room=room)
-    # Delete the endpoint
-    endpoint.delete()
-    return HttpResponse("Endpoint deleted successfully")
 
+    # Get data from json
+    data = codec.loads(request.body)
+
+    room_name = data.get("room_name", None)
+    specs = data.get("endpoints", None)
+
+    # Check the room name and the list of endpoints
+    if room_name is None:
+        return HttpResponseBadRequest("Invalid room name")
+    if not isinstance(specs, list) or not specs:
+        return HttpResponseBadRequest("Invalid endpoints: expected a list of endpoints")
+    if len(specs) > settings.MAX_BULK_ENDPOINTS:
+        return HttpResponseBadRequest(
+            f"Too many endpoints: at most {settings.MAX_BULK_ENDPOINTS} per request"
+        )
+    permissions = []
+    for spec in specs:
+        try:
+            if not isinstance(spec, dict):
+                raise ValueError("Invalid endpoint: expected an object")
+            permissions.append(Permission.parse(spec.get("permissions", None)))
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
 
-def list_endpoints(request, room_name):
-    # Get the API KEY from header
-    api_key = request.headers.get("API-KEY", "")
-    user = get_user(api_key)
-    if user is None:
-        return HttpResponseForbidden("No/Invalid API KEY")
     # Get the room or return 404
-    room = get_object_or_404(Room, name=room_name, owner=user)
-    # Get all endpoints for the room
-    endpoints = Endpoint.objects.filter(room=room)
-    return JsonResponse(
+    room = get_object_or_404(Room, name=room_name, owner_id=tenant.id)
+
+    endpoints = []
+    for spec, permission in zip(specs, permissions):
+        code = generate_endpoint_code()
+        endpoints.append(
+            Endpoint(
+                code=code,
+                code_digest=key_digest(code),
+                permissions=permission,
+                room=room,
+                identity=spec.get("identity", "Anonymous"),
+            )
+        )
+    # Create all the endpoints in a single transaction
+    with transaction.atomic():
+        Endpoint.objects.bulk_create(endpoints)
+
+    return json_response(
         {
+            "room_name": room_name,
             "endpoints": [
                 {
                     "code": endpoint.code,
-                    "permissions": endpoint.permissions,
+                    "permissions": str(endpoint.permissions),
                     "identity": endpoint.identity,
                 }
                 for endpoint in endpoints
-            ]
+            ],
+        }
+    )
+
+
+def delete_endpoint(request, room_name, endpoint_code):
+    # The tenant of the API KEY header, resolved by the TenantMiddleware
+    tenant = request.tenant
+    if tenant is None:
+        return HttpResponseForbidden("No/Invalid API KEY")
+    # Get the endpoint of the tenant's room or return 404, in one query
+    endpoint = get_object_or_404(
+        Endpoint,
+        **key_lookup("code", endpoint_code),
+        room__name=room_name,
+        room__owner_id=tenant.id,
+    )
+    if endpoint.code != endpoint_code:
+        raise Http404
+    # Delete the endpoint
+    endpoint.delete()
+    return HttpResponse("Endpoint deleted successfully")
+
+
+def list_endpoints(request, room_name):
+    # The tenant of the API KEY header, resolved by the TenantMiddleware
+    tenant = request.tenant
+    if tenant is None:
+        return HttpResponseForbidden("No/Invalid API KEY")
+    try:
+        cursor, limit = get_page(request)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor or limit")
+    # Get the room or return 404
+    room = get_object_or_404(Room, name=room_name, owner_id=tenant.id)
+    # Get the endpoints for the room
+    endpoints = keyset(Endpoint.objects.filter(room=room), cursor).values(
+        "id", "code", "permissions", "identity"
+    )
+
+    def to_row(endpoint):
+        return {
+            "code": endpoint["code"],
+            "permissions": str(endpoint["permissions"]),
+            "identity": endpoint["identity"],
+        }
+
+    if request.GET.get("format", None) == "ndjson":
+        return ndjson_response(endpoints, limit, to_row)
+    rows, next_cursor = page_rows(endpoints, limit, to_row)
+    if cursor is None and limit is None:
+        return json_response({"endpoints": rows})
+    return json_response({"endpoints": rows, "next_cursor": next_cursor})
+
+def broadcast_items(data):
+    """Returns the (room names, identity, message, key) of the broadcast request.
+
+    Raises ValueError for invalid requests.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Invalid request: expected an object")
+    items = data["messages"] if "messages" in data else [data]
+    if not isinstance(items, list) or not items:
+        raise ValueError("Invalid messages: expected a list of messages")
+    if len(items) > settings.MAX_BROADCAST_MESSAGES:
+        raise ValueError(
+            f"Too many messages: at most {settings.MAX_BROADCAST_MESSAGES} per request"
+        )
+    parsed = []
+    for item in items:
+        if not isinstance(item, dict) or "message" not in item:
+            raise ValueError("Invalid message: expected an object with a message")
+        room_names = item.get("room_names", [item.get("room_name")])
+        if not isinstance(room_names, list) or not room_names or not all(
+            isinstance(name, str) for name in room_names
+        ):
+            raise ValueError("Invalid room name")
+        identity = item.get("identity", "server")
+        if not isinstance(identity, str):
+            raise ValueError("Invalid identity")
+        key = item.get("key")
+        if key is not None and not isinstance(key, str):
+            raise ValueError("Invalid key")
+        # A room listed twice gets the message once, in the order of the list
+        room_names = list(dict.fromkeys(room_names))
+        parsed.append((room_names, identity, item["message"], key))
+    return parsed
+
+
+@csrf_exempt
+async def broadcast(request):
+    """Publishes one or many messages to one or many rooms of the tenant."""
+    if request.method != "POST":
+        return HttpResponseNotFound("Invalid request method")
+    # The tenant of the API KEY header, resolved by the TenantMiddleware
+    tenant = request.tenant
+    if tenant is None:
+        return HttpResponseForbidden("No/Invalid API KEY")
+    try:
+        items = broadcast_items(codec.loads(request.body))
+    except codec.DecodeError:
+        return HttpResponseBadRequest("Invalid json")
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    # The messages of every room, in the order of the request
+    by_room = {}
+    for room_names, identity, message, key in items:
+        for name in room_names:
+            by_room.setdefault(name, []).append((identity, message, key))
+    rooms = {
+        room["name"]: room["pubsub"]
+        async for room in Room.objects.filter(
+            owner_id=tenant.id, name__in=list(by_room)
+        ).values("name", "pubsub")
+    }
+    missing = [name for name in by_room if name not in rooms]
+    if missing:
+        return HttpResponseNotFound(f"Unknown rooms: {', '.join(missing)}")
+
+    timestamp = datetime.now(timezone.utc).isoformat()
+
+    async def publish_room(name, messages):
+        group = f"{tenant.username}_{name}"
+        channel_layer = get_channel_layer(room_layer_alias(rooms[name]))
+        # One sequence number range for all the messages of the room
+        last_seq = await get_sequences().next(group, len(messages))
+        for seq, (identity, message, key) in enumerate(
+            messages, last_seq - len(messages) + 1
+        ):
+            event = message_event(group, identity, message, seq, timestamp, key)
+            await publish(channel_layer, tenant.username, event)
+        return name, last_seq
+
+    # The rooms are published concurrently, the messages of a room in order
+    last_seqs = await asyncio.gather(
+        *(publish_room(name, messages) for name, messages in by_room.items())
+    )
+    logger.info(
+        "Broadcast %d messages to %d rooms of user %s",
+        sum(len(messages) for messages in by_room.values()),
+        len(by_room),
+        tenant.username,
+    )
+    return json_response(
+        {
+            "published": sum(len(messages) for messages in by_room.values()),
+            "last_seq": dict(last_seqs),
         }
     )
 
+
+async def presence(request):
+    """Returns the identities connected to many rooms of the tenant at once."""
+    # The tenant of the API KEY header, resolved by the TenantMiddleware
+    tenant = request.tenant
+    if tenant is None:
+        return HttpResponseForbidden("No/Invalid API KEY")
+    # The rooms are given as ?rooms=a&rooms=b or ?rooms=a,b, otherwise all of
+    # them are listed in pages of up to MAX_PAGE_SIZE rooms
+    room_names = [
+        name for value in request.GET.getlist("rooms") for name in value.split(",") if name
+    ]
+    page = None
+    if not room_names:
+        try:
+            cursor, limit = get_page(request)
+        except ValueError:
+            return HttpResponseBadRequest("Invalid cursor or limit")
+        limit = limit or settings.MAX_PAGE_SIZE
+        rooms = keyset(Room.objects.filter(owner_id=tenant.id), cursor).values("id", "name")
+        rows = [row async for row in rooms[:limit]]
+        room_names = [row["name"] for row in rows]
+        page = {"next_cursor": rows[-1]["id"] if len(rows) == limit else None}
+    elif len(room_names) > settings.MAX_PAGE_SIZE:
+        return HttpResponseBadRequest(
+            f"Too many rooms: at most {settings.MAX_PAGE_SIZE} per request"
+        )
+    groups = {f"{tenant.username}_{name}": name for name in room_names}
+    occupancy = await get_presence().occupancy(list(groups))
+    data = {
+        "rooms": {
+            groups[group]: {"count": len(identities), "identities": identities}
+            for group, identities in occupancy.items()
+        }
+    }
+    if page is not None:
+        data.update(page)
+    return json_response(data)
+
+
 @csrf_exempt
 def webhook(request):
     if request.method == "POST":
         # Get the data as json - the request is asgi request
-        _ = json.loads(request.body)
+        _ = codec.loads(request.body)
         # print(_)
         return HttpResponse("Webhook received", status=200)
     else:
         return HttpResponseNotFound("Invalid request method")
 
-        
\ No newline at end of file
+        
+
+
+def metrics(request):
+    """Serves the process metrics in the Prometheus text format.
+
+    The room labels name every tenant, so with METRICS_TOKEN set the scraper has
+    to send it as a bearer token.
+    """
+    if not settings.METRICS_ENABLED:
+        return HttpResponseNotFound("Metrics are disabled")
+    if settings.METRICS_TOKEN:
+        expected = f"Bearer {settings.METRICS_TOKEN}"
+        if not hmac.compare_digest(
+            request.headers.get("Authorization", "").encode(), expected.encode()
+        ):
+            return HttpResponseForbidden("No/Invalid metrics token")
+    return HttpResponse(
+        render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
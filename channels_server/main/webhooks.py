@@ -0,0 +1,216 @@
+"""Asynchronous, batched delivery of room messages to room webhooks.
+
+The consumers only enqueue messages. Every room gets a bounded queue drained by
+a worker task which groups messages into batches, posts them over a pooled
+keep-alive HTTP session and retries request errors, 5xx and 429 responses with
+exponential backoff. Messages that
+cannot be delivered are stored as WebhookDeadLetter rows; the messages dropped
+from full queues are buffered and stored with one bulk insert per flush.
+
+With WEBHOOK_BATCH_SIZE set to 1 every message is posted as a single json
+object (the original format), otherwise each POST carries a json list.
+"""
+
+import asyncio
+import logging
+import time
+import weakref
+
+import requests
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import IntegrityError
+from requests.adapters import HTTPAdapter
+
+from . import codec
+from .metrics import webhook_failures, webhook_latency
+from .models import Room, WebhookDeadLetter
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookDispatcher:
+    def __init__(
+        self,
+        queue_size=None,
+        batch_size=None,
+        batch_interval=None,
+        timeout=None,
+        max_retries=None,
+        retry_backoff=None,
+        pool_size=None,
+        idle_timeout=60,
+    ):
+        self.queue_size = queue_size or settings.WEBHOOK_QUEUE_SIZE
+        self.batch_size = batch_size or settings.WEBHOOK_BATCH_SIZE
+        if batch_interval is None:
+            batch_interval = settings.WEBHOOK_BATCH_INTERVAL_MS / 1000
+        self.batch_interval = batch_interval
+        self.timeout = timeout or settings.WEBHOOK_TIMEOUT
+        if max_retries is None:
+            max_retries = settings.WEBHOOK_MAX_RETRIES
+        self.max_retries = max_retries
+        if retry_backoff is None:
+            retry_backoff = settings.WEBHOOK_RETRY_BACKOFF
+        self.retry_backoff = retry_backoff
+        self.idle_timeout = idle_timeout
+
+        # Keep-alive connections shared by all the rooms
+        pool_size = pool_size or settings.WEBHOOK_POOL_SIZE
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.queues = {}
+        self.workers = {}
+        # (room id, webhook, payload) dropped from the full queues
+        self.overflow = []
+        self._overflow_task = None
+        self.delivered = 0
+        self.dropped = 0
+
+    def enqueue(self, room_id, webhook, payload):
+        """Queues the payload for the room webhook without blocking.
+
+        Returns False if the room queue is full and the payload was dropped.
+        """
+        queue = self.queues.get(room_id)
+        if queue is None:
+            queue = self.queues[room_id] = asyncio.Queue(self.queue_size)
+        worker = self.workers.get(room_id)
+        if worker is None or worker.done():
+            self.workers[room_id] = asyncio.ensure_future(self._work(room_id, queue))
+        try:
+            queue.put_nowait((webhook, payload))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            webhook_failures.inc(reason="queue_full")
+            self.overflow.append((room_id, webhook, payload))
+            if self._overflow_task is None or self._overflow_task.done():
+                self._overflow_task = asyncio.ensure_future(self._flush_overflow())
+            return False
+        return True
+
+    async def _flush_overflow(self):
+        # Payloads dropped while a flush runs are stored by the next one
+        while self.overflow:
+            rows, self.overflow = self.overflow, []
+            try:
+                await self._dead_letter(rows, "Queue full", 0)
+            except Exception:
+                logger.exception("Dead lettering %d dropped messages failed", len(rows))
+
+    async def _work(self, room_id, queue):
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    # Idle room - release the queue, enqueue starts a new worker
+                    del self.queues[room_id]
+                    del self.workers[room_id]
+                    return
+                continue
+            batch = [item]
+            # Collect up to batch_size messages or until the interval passes
+            if self.batch_size > 1:
+                deadline = asyncio.get_running_loop().time() + self.batch_interval
+                while len(batch) < self.batch_size:
+                    remaining = deadline - asyncio.get_running_loop().time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+            # The webhook may change while messages are queued
+            by_webhook = {}
+            for webhook, payload in batch:
+                by_webhook.setdefault(webhook, []).append(payload)
+            for webhook, payloads in by_webhook.items():
+                await self._deliver(room_id, webhook, payloads)
+
+    async def _deliver(self, room_id, webhook, payloads):
+        if self.batch_size > 1:
+            data = codec.dumps(payloads)
+        else:
+            data = codec.dumps(payloads[0])
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(self.retry_backoff * 2 ** (attempt - 1))
+            start = time.perf_counter()
+            try:
+                response = await sync_to_async(self._post, thread_sensitive=False)(
+                    webhook, data
+                )
+            except requests.RequestException as e:
+                webhook_failures.inc(reason="request_error")
+                error = str(e)
+                continue
+            finally:
+                webhook_latency.observe(time.perf_counter() - start)
+            if response.status_code < 400:
+                self.delivered += len(payloads)
+                return
+            webhook_failures.inc(reason="http_status")
+            error = f"HTTP {response.status_code}"
+            # Client errors other than rate limiting fail the same way again
+            if response.status_code < 500 and response.status_code != 429:
+                break
+        logger.warning(
+            "Dead lettering %d messages of room %s: %s", len(payloads), room_id, error
+        )
+        await self._dead_letter(
+            [(room_id, webhook, payload) for payload in payloads],
+            error,
+            self.max_retries + 1,
+        )
+
+    def _post(self, webhook, data):
+        return self.session.post(
+            webhook,
+            data=data,
+            headers={"Content-Type": "application/json"},
+            timeout=self.timeout,
+        )
+
+    @database_sync_to_async
+    def _dead_letter(self, rows, error, attempts):
+        """Stores the (room id, webhook, payload) rows in one bulk insert."""
+        dead_letters = [
+            WebhookDeadLetter(
+                room_id=room_id,
+                webhook=webhook,
+                payload=codec.dumps_text(payload),
+                error=(error or "")[:200],
+                attempts=attempts,
+            )
+            for room_id, webhook, payload in rows
+        ]
+        try:
+            WebhookDeadLetter.objects.bulk_create(dead_letters)
+        except IntegrityError:
+            # Rooms were deleted in the meantime, store the rest
+            rooms = set(
+                Room.objects.filter(
+                    id__in={d.room_id for d in dead_letters}
+                ).values_list("id", flat=True)
+            )
+            WebhookDeadLetter.objects.bulk_create(
+                [d for d in dead_letters if d.room_id in rooms]
+            )
+
+
+_dispatchers = weakref.WeakKeyDictionary()
+
+
+def get_dispatcher():
+    """Returns the dispatcher of the running event loop."""
+    loop = asyncio.get_running_loop()
+    dispatcher = _dispatchers.get(loop)
+    if dispatcher is None:
+        dispatcher = _dispatchers[loop] = WebhookDispatcher()
+    return dispatcher
@@ -17,34 +17,25 @@ def setup_demo(url):
         print("Default room created")
         print(response.text)
 
-    # Create two endpoints for the default room
+    # Create two endpoints for the default room in one request
     json_data = {
-        "identity": "endpoint1",
-        "permissions": "readwrite",
         "room_name": "default",
+        "endpoints": [
+            {"identity": "endpoint1", "permissions": "readwrite"},
+            {"identity": "endpoint2", "permissions": "readwrite"},
+        ],
     }
     response = requests.post(
-        url + "/add_endpoint/", json=json_data, 
+        url + "/add_endpoints/", json=json_data,
     )
     if response.status_code != 200:
         print("Error - check url, server and api key")
         return
 
-    # Get the endpoint code
-    endpoint_code1 = response.json()["code"]
-
-    # Create the second endpoint
-    json_data = {
-        "identity": "endpoint2",
-        "permissions": "readwrite",
-        "room_name": "default",
-    }
-    response = requests.post(
-        url + "/add_endpoint/", json=json_data, 
-    )
-
-    # Get the endpoint code
-    endpoint_code2 = response.json()["code"]
+    # Get the endpoint codes
+    endpoint_code1, endpoint_code2 = [
+        endpoint["code"] for endpoint in response.json()["endpoints"]
+    ]
 
     # Print the room urls for the setup
     print(f"Room URL for endpoint1: {url}/room/{endpoint_code1}/")